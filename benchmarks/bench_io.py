@@ -0,0 +1,60 @@
+#-------------------------------------------------------------------------------
+# Name:        bench_io.py
+# Purpose:     Benchmark of make_perpendicular() and remove_self_intersects()
+#              on GeoPackage tables through the chunked flow_io layer, at a
+#              range of chunk sizes.  A chunk size of 1 approximates the former
+#              row-at-a-time cursor loops.  Does not require arcpy.
+# Author:      Research Planning, Inc.
+#
+# Usage:       python benchmarks/bench_io.py [N [N ...]]
+#
+#-------------------------------------------------------------------------------
+
+import os, sys, time, math, shutil, tempfile, numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import flow_area, flow_gpkg, flow_io
+
+CHUNK_SIZES = [1, 1000, flow_io.CHUNK_SIZE]
+
+def random_lines(count, vertices=20, seed=0):
+    # Random walks of the given number of vertices, each with its own DWUNIQUE
+    rng = numpy.random.RandomState(seed)
+    start = rng.uniform(0, 100000, (count, 1, 2))
+    angle = numpy.cumsum(rng.uniform(-0.5, 0.5, (count, vertices - 1)), axis=1) + rng.uniform(0, 2 * math.pi, (count, 1))
+    steps = 10.0 * numpy.dstack((numpy.cos(angle), numpy.sin(angle)))
+    return numpy.concatenate((start, start + numpy.cumsum(steps, axis=1)), axis=1)
+
+def setup(path, count):
+    conn = flow_gpkg.connect(path)
+    lines = random_lines(count)
+    flow_gpkg.create_table(conn, 'lines', 'MULTILINESTRING', [('DWUNIQUE', 'TEXT')])
+    flow_gpkg.insert_rows(conn, 'lines', ['DWUNIQUE'], (([line], str(i)) for i, line in enumerate(lines.tolist())))
+    flow_gpkg.create_table(conn, 'points', 'POINT')
+    flow_gpkg.insert_rows(conn, 'points', [], ((tuple(pt),) for pt in lines[:, 0].tolist()))
+    conn.close()
+
+def run(count):
+    folder = tempfile.mkdtemp()
+    results = []
+    try:
+        gpkg = os.path.join(folder, 'bench.gpkg')
+        setup(gpkg, count)
+        for chunk_size in CHUNK_SIZES:
+            t0 = time.time()
+            flow_area.make_perpendicular(os.path.join(gpkg, 'lines'), 200, 'cutlines', True, chunk_size=chunk_size)
+            perpendicular_time = time.time() - t0
+            t0 = time.time()
+            flow_area.remove_self_intersects(os.path.join(gpkg, 'cutlines'), os.path.join(gpkg, 'points'), 'DWUNIQUE', 'cutlines_filt', chunk_size=chunk_size)
+            filter_time = time.time() - t0
+            results.append((chunk_size, perpendicular_time, filter_time))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+if __name__ == '__main__':
+    sizes = [int(float(arg)) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    print("{0:>10} {1:>10} {2:>20} {3:>20}".format("lines", "chunk", "perpendicular (s)", "self intersects (s)"))
+    for count in sizes:
+        for chunk_size, perpendicular_time, filter_time in run(count):
+            print("{0:>10} {1:>10} {2:>20.4f} {3:>20.4f}".format(count, chunk_size, perpendicular_time, filter_time))
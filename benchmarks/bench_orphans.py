@@ -0,0 +1,94 @@
+#-------------------------------------------------------------------------------
+# Name:        bench_orphans.py
+# Purpose:     Benchmark and parity check of orphan polygon merging on synthetic
+#              polygon meshes.  Runs the former selection chain (select by
+#              location, dissolve, merge) and the edge graph merge of
+#              flow_orphans.py through the shapely backend, with both Thiessen
+#              conflict policies, and compares the outputs.  Exits non-zero if
+#              they differ.  Does not require arcpy.
+# Author:      Research Planning, Inc.
+#
+# Usage:       python benchmarks/bench_orphans.py [N [N ...]]
+#
+#-------------------------------------------------------------------------------
+
+import os, sys, time, shutil, tempfile, numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import flow_gpkg, flow_shapely
+
+def make_mesh(path, rows, seed=0):
+    # A brick-pattern mesh of rows x rows cells of 100 x 50 map units.  Every other row is offset by half a brick, so each
+    # brick's long edges meet two bricks of the next row at a vertex present on one side only.  Cells are keyed on
+    # 2 x 2 blocks; random flowline stubs leave about a third of the cells orphaned, and random split points mark others.
+    rng = numpy.random.RandomState(seed)
+    cells = []
+    keys = []
+    centres = []
+    for r in range(rows):
+        shift = 50.0 if r % 2 else 0.0
+        for c in range(rows):
+            x0, y0 = c * 100.0 + shift, r * 50.0
+            cells.append([[[(x0, y0), (x0 + 100, y0), (x0 + 100, y0 + 50), (x0, y0 + 50), (x0, y0)]]])
+            keys.append((r // 2) * rows + c // 2)
+            centres.append((x0 + 50.0, y0 + 25.0))
+    centres = numpy.array(centres)
+    wet = centres[rng.uniform(size=len(cells)) < 0.65]
+    lines = [[[(x - 10, y), (x + 10, y)]] for x, y in wet.tolist()]
+    splits = centres[rng.uniform(size=len(cells)) < 0.1] + 20.0
+    conn = flow_gpkg.connect(path)
+    flow_gpkg.create_table(conn, 'cells', 'MULTIPOLYGON', [('FID_key', 'LONG')])
+    flow_gpkg.insert_rows(conn, 'cells', ['FID_key'], zip(cells, keys))
+    flow_gpkg.create_table(conn, 'flowlines', 'MULTILINESTRING')
+    flow_gpkg.insert_rows(conn, 'flowlines', [], ((line,) for line in lines))
+    flow_gpkg.create_table(conn, 'splits', 'POINT')
+    flow_gpkg.insert_rows(conn, 'splits', [], ((tuple(pt),) for pt in splits.tolist()))
+    conn.close()
+
+def run_selections(gp, thiessen):
+    steps = [("NEW_SELECTION", "INTERSECT", "flowlines", True),
+             ("NEW_SELECTION", "SHARE_A_LINE_SEGMENT_WITH", "cells", False)]
+    if thiessen:
+        steps.append(("REMOVE_FROM_SELECTION", "INTERSECT", "splits", False))
+    gp.select_by_location("cells", steps, "cells_sel", "cells_unsel")
+    gp.dissolve("cells_sel", "cells_orphans", "FID_key")
+    gp.merge(["cells_unsel", "cells_orphans"], "merged_selections")
+
+def run_graph(gp, thiessen):
+    gp.merge_orphans("cells", "flowlines", "splits", "FID_key", thiessen, "merged_graph")
+
+def summary(gp, table):
+    # Sorted (key, rounded area) of every output feature
+    t = gp.read(table)
+    return sorted((row[0], round(geom.area, 3)) for geom, row in zip(t.geoms, t.values))
+
+def run(rows):
+    folder = tempfile.mkdtemp()
+    results = []
+    try:
+        path = os.path.join(folder, 'mesh.gpkg')
+        make_mesh(path, rows)
+        gp = flow_shapely.ShapelyBackend()
+        gp.use_workspace(path)
+        for thiessen in (True, False):
+            t0 = time.time()
+            run_selections(gp, thiessen)
+            selections_time = time.time() - t0
+            t0 = time.time()
+            run_graph(gp, thiessen)
+            graph_time = time.time() - t0
+            same = summary(gp, "merged_selections") == summary(gp, "merged_graph")
+            results.append((thiessen, selections_time, graph_time, same))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+if __name__ == '__main__':
+    sizes = [int(float(arg)) for arg in sys.argv[1:]] or [20, 50, 100]
+    failed = False
+    print("{0:>10} {1:>9} {2:>16} {3:>16} {4:>8}".format("cells", "thiessen", "selections (s)", "edge graph (s)", "same"))
+    for rows in sizes:
+        for thiessen, selections_time, graph_time, same in run(rows):
+            print("{0:>10} {1:>9} {2:>16.4f} {3:>16.4f} {4:>8}".format(rows * rows, str(thiessen), selections_time, graph_time, str(same)))
+            failed = failed or not same
+    sys.exit(1 if failed else 0)
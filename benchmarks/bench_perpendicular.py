@@ -0,0 +1,59 @@
+#-------------------------------------------------------------------------------
+# Name:        bench_perpendicular.py
+# Purpose:     Micro-benchmark of the scalar cutline helpers against the batch
+#              flow_geom.perpendicular_cutlines() generator used by
+#              make_perpendicular().  Does not require arcpy.
+# Author:      Research Planning, Inc.
+#
+# Usage:       python benchmarks/bench_perpendicular.py [N [N ...]]
+#
+#-------------------------------------------------------------------------------
+
+import os, sys, time, math, numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import flow_geom
+from flow_geom import add_subtract_radians, cart_to_polar, polar_to_cart
+
+def scalar_cutlines(segments, distance, start):
+    # The per-row computation make_perpendicular() performed before batching
+    cutlines = []
+    for startx, starty, endx, endy in segments:
+        polarcoor = cart_to_polar((startx,starty), (endx,endy))
+        ends = add_subtract_radians(polarcoor[1])
+        firstend = polar_to_cart((float(distance),float(ends[0])))
+        secondend = polar_to_cart((float(distance),float(ends[1])))
+        if start:
+            midx, midy = startx, starty
+        else:
+            midx, midy = endx, endy
+        cutlines.append([[midx + firstend[0], midy + firstend[1]], [midx, midy], [midx + secondend[0], midy + secondend[1]]])
+    return cutlines
+
+def random_segments(count, seed=0):
+    rng = numpy.random.RandomState(seed)
+    start = rng.uniform(0, 100000, (count, 2))
+    angle = rng.uniform(0, 2 * math.pi, count)
+    end = start + 10.0 * numpy.column_stack((numpy.cos(angle), numpy.sin(angle)))
+    return numpy.hstack((start, end))
+
+def run(count, distance=2000, start=True):
+    segments = random_segments(count)
+
+    t0 = time.time()
+    scalar = scalar_cutlines(segments.tolist(), distance, start)
+    scalar_time = time.time() - t0
+
+    t0 = time.time()
+    batch = flow_geom.perpendicular_cutlines(segments[:, 0:2], segments[:, 2:4], distance, start)
+    batch_time = time.time() - t0
+
+    maxdiff = float(numpy.abs(numpy.array(scalar) - batch).max())
+    return scalar_time, batch_time, maxdiff
+
+if __name__ == '__main__':
+    sizes = [int(float(arg)) for arg in sys.argv[1:]] or [1000, 100000, 1000000]
+    print("{0:>10} {1:>12} {2:>12} {3:>9} {4:>12}".format("lines", "scalar (s)", "batch (s)", "speedup", "max diff"))
+    for count in sizes:
+        scalar_time, batch_time, maxdiff = run(count)
+        print("{0:>10} {1:>12.4f} {2:>12.4f} {3:>8.1f}x {4:>12.3g}".format(count, scalar_time, batch_time, scalar_time / max(batch_time, 1e-9), maxdiff))
@@ -0,0 +1,140 @@
+#-------------------------------------------------------------------------------
+# Name:        bench_scaling.py
+# Purpose:     Scaling benchmark of flow_area() on synthetic scenes from
+#              flow_synth.py.  Times every stage (including make_perpendicular,
+#              remove_self_intersects, the Thiessen stage and the final
+#              dissolve) over a sweep of scene sizes along one axis, fits each
+#              stage's scaling exponent (the slope of log time against log
+#              size), and saves or checks a JSON baseline.  Exits non-zero when
+#              a stage regresses past the threshold.  Runs with the shapely
+#              backend; does not require arcpy or network access.
+# Author:      Research Planning, Inc.
+#
+# Usage:       python benchmarks/bench_scaling.py [axis [sizes [baseline.json [threshold]]]]
+#
+#              axis is one of AXES (default bodies) and sizes a comma-separated
+#              list (default the axis's own).  A baseline that does not exist
+#              yet is written; one that exists is checked against.  Use - for
+#              no baseline.
+#
+#-------------------------------------------------------------------------------
+#
+# A stage regresses when its time at the largest size exceeds the baseline's by more than threshold (a fraction,
+# default 0.5), or its exponent exceeds the baseline's by more than EXPONENT_SLACK.  Times are only checked for stages
+# taking MIN_TIME seconds or more at the largest size in the baseline, and exponents for stages doing so at every size,
+# as shorter times are mostly noise.
+
+import os, sys, math, json, time, shutil, tempfile, numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import flow_area, flow_report
+import flow_synth
+
+# axis: (default sizes, function of size returning (flow_synth.scene() arguments, flow_area() arguments))
+AXES = {
+    'bodies': ([4, 8, 16, 32], lambda size: ({'bodies': size}, {})),                       # polygon count
+    'reaches': ([2, 4, 8, 16], lambda size: ({'bodies': 2, 'reaches': size}, {})),        # flowline, endpoint and cutline count
+    'density': ([1, 2, 4, 8], lambda size: ({'bodies': 2, 'spacing': 80.0 / size}, {})),  # input vertex density
+    'densify': ([1, 2, 4, 8], lambda size: ({'bodies': 2}, {'densify_spacing': 40.0 / size})),  # Thiessen seed density
+}
+REPEATS = 3
+MIN_TIME = 0.1
+EXPONENT_SLACK = 0.3
+
+def run(scene_args, flow_args, seed=0):
+    # Return (scene counts, {stage: wall seconds}) of the best of REPEATS runs of flow_area on a new scene.  Stages run
+    # more than once in a run (make_perpendicular) are summed.
+    best = None
+    for repeat in range(REPEATS):
+        folder = tempfile.mkdtemp()
+        stdout = sys.stdout
+        try:
+            tables = flow_synth.scene(seed=seed, **scene_args)
+            inputs = flow_synth.write_scene(os.path.join(folder, 'scene.gpkg'), tables)
+            report = flow_report.RunReport()
+            sys.stdout = open(os.devnull, 'w')
+            t0 = time.time()
+            flow_area.flow_area(*(inputs + [True]), backend="shapely", output_features="flow_area_out", report=report, raise_errors=True, **flow_args)
+            total = time.time() - t0
+        finally:
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+                sys.stdout = stdout
+            shutil.rmtree(folder, ignore_errors=True)
+        times = {'total': total}
+        for record in report.records:
+            times[record['stage']] = times.get(record['stage'], 0.0) + record['wall_s']
+        if best is None or total < best[1]['total']:
+            best = (flow_synth.counts(tables), times)
+    return best
+
+def exponent(sizes, times):
+    # Least squares slope of log time against log size, or None if fewer than two sizes have a measurable time
+    points = [(math.log(size), math.log(t)) for size, t in zip(sizes, times) if t is not None and t > 0]
+    if len(points) < 2:
+        return None
+    return float(numpy.polyfit([p[0] for p in points], [p[1] for p in points], 1)[0])
+
+def sweep(axis, sizes, seed=0):
+    results = [run(*AXES[axis][1](size), seed=seed) for size in sizes]
+    stages = []
+    for counts, times in results:
+        stages.extend(stage for stage in sorted(times) if stage not in stages)
+    times = dict((stage, [result[1].get(stage) for result in results]) for stage in stages)
+    return {'axis': axis, 'sizes': sizes, 'seed': seed, 'counts': [result[0] for result in results],
+            'stages': times, 'exponents': dict((stage, exponent(sizes, times[stage])) for stage in stages)}
+
+def regressions(baseline, result, threshold):
+    # List of messages for the stages of result that regressed against baseline
+    found = []
+    for stage, base_times in sorted(baseline['stages'].items()):
+        if stage not in result['stages'] or base_times[-1] is None or base_times[-1] < MIN_TIME:
+            continue
+        now = result['stages'][stage][-1]
+        if now is not None and now > base_times[-1] * (1.0 + threshold):
+            found.append("{0}: {1:.3f} s at size {2}, baseline {3:.3f} s".format(stage, now, result['sizes'][-1], base_times[-1]))
+        base_exp, now_exp = baseline['exponents'].get(stage), result['exponents'].get(stage)
+        if None in base_times or min(base_times) < MIN_TIME:
+            continue
+        if base_exp is not None and now_exp is not None and now_exp > base_exp + EXPONENT_SLACK:
+            found.append("{0}: scaling exponent {1:.2f}, baseline {2:.2f}".format(stage, now_exp, base_exp))
+    return found
+
+def print_result(result):
+    sizes = result['sizes']
+    print("axis {0}: ".format(result['axis']) + ", ".join("size {0} = {1}".format(size, counts) for size, counts in zip(sizes, result['counts'])))
+    print("{0:<55}".format("stage") + "".join("{0:>10}".format(size) for size in sizes) + "{0:>10}".format("exponent"))
+    for stage in sorted(result['stages']):
+        cells = ["{0:>10.3f}".format(t) if t is not None else "{0:>10}".format("-") for t in result['stages'][stage]]
+        power = result['exponents'][stage]
+        print("{0:<55}".format(stage) + "".join(cells) + ("{0:>10.2f}".format(power) if power is not None else "{0:>10}".format("-")))
+
+if __name__ == '__main__':
+    args = sys.argv[1:] + [None] * 4
+    axis = args[0] or 'bodies'
+    if axis not in AXES:
+        print("Unknown axis '{0}', expected one of {1}".format(axis, ", ".join(sorted(AXES))))
+        sys.exit(2)
+    sizes = [int(size) for size in args[1].split(',')] if args[1] else AXES[axis][0]
+    baseline_path = args[2] if args[2] != '-' else None
+    threshold = float(args[3]) if args[3] else 0.5
+    result = sweep(axis, sizes)
+    print_result(result)
+    if not baseline_path:
+        sys.exit(0)
+    if not os.path.exists(baseline_path):
+        with open(baseline_path, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print("Baseline written to " + baseline_path)
+        sys.exit(0)
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline['axis'] != axis or baseline['sizes'] != sizes:
+        print("Baseline {0} is for axis {1} sizes {2}".format(baseline_path, baseline['axis'], baseline['sizes']))
+        sys.exit(2)
+    found = regressions(baseline, result, threshold)
+    for message in found:
+        print("REGRESSION " + message)
+    if not found:
+        print("No stage regressed past {0:.0%} of baseline {1}".format(threshold, baseline_path))
+    sys.exit(1 if found else 0)
@@ -0,0 +1,182 @@
+#-------------------------------------------------------------------------------
+# Name:        compare_backends.py
+# Purpose:     Regression comparison of the flow_area backends.  Builds shared
+#              fixtures as GeoPackages, runs flow_area() with the shapely
+#              backend and, where arcpy is available, the arcpy backend on
+#              copies of the same fixtures, and compares the area assigned to
+#              each DWUNIQUE.  The lake is also run in geographic coordinates
+#              (WGS 84), and its areas compared with the projected lake's,
+#              and the filling of islands under 1 square kilometer is
+#              compared between projected and geographic coordinates.
+#              Exits non-zero if the backends or the two lakes disagree.
+# Author:      Research Planning, Inc.
+#
+# Usage:       python benchmarks/compare_backends.py [tolerance]
+#
+#-------------------------------------------------------------------------------
+
+import os, sys, math, time, shutil, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import flow_area, flow_gpkg, flow_io, flow_backend
+
+INPUTS = ('nhdar', 'flowlines', 'upstr', 'dnstr', 'all_flowlines')
+FIXTURES = ('river', 'lake', 'lake_geographic')
+WGS84 = ('WGS 84', 4326, 'EPSG', 4326, 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],'
+         'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]', None)
+# Longitude and latitude of the geographic lake's (0, 0): on the equator, where degrees of longitude and latitude are
+# the same length, so that cutlines perpendicular in degrees are perpendicular on the ground and the lake keeps its shape
+ORIGIN = (-80.0, 0.0)
+
+def degree_scale():
+    # Meters per degree of longitude and of latitude at ORIGIN
+    return flow_io.METERS_PER_DEGREE * math.cos(math.radians(ORIGIN[1])), flow_io.METERS_PER_DEGREE
+
+def _table(conn, table, geometry_type, fields, rows, srs=None):
+    # srs: None for projected meters, or a spatial_ref_sys() row of a geographic system to convert the rows to
+    if srs is not None:
+        sx, sy = degree_scale()
+        project = lambda pt: (ORIGIN[0] + pt[0] / sx, ORIGIN[1] + pt[1] / sy)
+        convert = {'POINT': project,
+                   'MULTILINESTRING': lambda geom: [[project(pt) for pt in part] for part in geom],
+                   'MULTIPOLYGON': lambda geom: [[[project(pt) for pt in ring] for ring in polygon] for polygon in geom]}[geometry_type]
+        rows = [(convert(row[0]),) + tuple(row[1:]) for row in rows]
+    flow_gpkg.create_table(conn, table, geometry_type, fields, srs if srs is not None else -1)
+    flow_gpkg.insert_rows(conn, table, [name for name, ftype in fields], rows)
+
+def make_fixture(path, name):
+    # Fixtures in projected meters.  "river": a straight reach split into two flowlines; "lake": a lake with an island,
+    # fed by two tributaries and drained by one outlet; "lake_geographic": the lake in WGS 84 longitude and latitude,
+    # scaled about ORIGIN.
+    conn = flow_gpkg.connect(path)
+    fl_fields = [('DWUNIQUE', 'TEXT'), ('FCode', 'LONG')]
+    srs = WGS84 if name == 'lake_geographic' else None
+    if name == 'river':
+        _table(conn, 'nhdar', 'MULTIPOLYGON', [], [([[[(0, -100), (1000, -100), (1000, 100), (0, 100), (0, -100)]]],)])
+        lines = [([[(0, 0), (250, 20), (500, 0)]], 'A', 55800), ([[(500, 0), (750, -20), (1000, 0)]], 'B', 55800),
+                 ([[(1000, 0), (1500, 0)]], 'C', 46006)]
+        ups, downs = [(0, 0), (500, 0)], [(500, 0), (1000, 0)]
+    else:
+        lake = [(0, 0), (2000, 0), (2000, 1500), (0, 1500), (0, 0)]
+        island = [(900, 600), (1100, 600), (1100, 800), (900, 800), (900, 600)]
+        _table(conn, 'nhdar', 'MULTIPOLYGON', [], [([[lake, island]],)], srs)
+        lines = [([[(0, 400), (700, 700), (1000, 1000)]], 'T1', 55800), ([[(0, 1200), (600, 1100), (1000, 1000)]], 'T2', 55800),
+                 ([[(1000, 1000), (1500, 700), (2000, 500)]], 'OUT', 55800), ([[(-500, 400), (0, 400)]], 'S1', 46006)]
+        ups, downs = [(0, 400), (0, 1200), (1000, 1000)], [(1000, 1000), (2000, 500)]
+    _table(conn, 'flowlines', 'MULTILINESTRING', fl_fields, lines, srs)
+    _table(conn, 'all_flowlines', 'MULTILINESTRING', fl_fields, lines, srs)
+    _table(conn, 'upstr', 'POINT', [], [(pt,) for pt in ups], srs)
+    _table(conn, 'dnstr', 'POINT', [], [(pt,) for pt in downs], srs)
+    conn.close()
+
+def areas_gpkg(path, table):
+    # Area of each DWUNIQUE, in square meters about ORIGIN for geographic tables
+    import shapely
+    conn = flow_gpkg.connect(path)
+    areas = {}
+    for row in conn.execute('SELECT geom, DWUNIQUE FROM "{0}"'.format(table)):
+        areas[row[1]] = areas.get(row[1], 0.0) + shapely.from_wkb(flow_gpkg.wkb_from_blob(row[0])).area
+    conn.close()
+    if flow_io.is_geographic(os.path.join(path, table)):
+        sx, sy = degree_scale()
+        areas = dict((key, area * sx * sy) for key, area in areas.items())
+    return areas
+
+def run_shapely(folder, name, intermediates="temp"):
+    path = os.path.join(folder, "{0}_{1}.gpkg".format(name, intermediates))
+    make_fixture(path, name)
+    inputs = [os.path.join(path, table) for table in INPUTS]
+    # cutline_distance is in the units of the data: the default 2000 meters, in degrees for the geographic lake
+    cutline_distance = 2000.0 / degree_scale()[1] if name == 'lake_geographic' else 2000
+    t0 = time.time()
+    flow_area.flow_area(*(inputs + [True]), cutline_distance=cutline_distance, backend="shapely", output_features="flow_area_out", intermediates=intermediates)
+    return time.time() - t0, areas_gpkg(path, "flow_area_out")
+
+def run_arcpy(folder, name):
+    import arcpy
+    source = os.path.join(folder, name + "_source.gpkg")
+    make_fixture(source, name)
+    gdb = arcpy.CreateFileGDB_management(folder, name + ".gdb").getOutput(0)
+    for table in INPUTS:
+        arcpy.CopyFeatures_management(os.path.join(source, "main." + table), os.path.join(gdb, table))
+    layers = []
+    for table in INPUTS:
+        arcpy.MakeFeatureLayer_management(os.path.join(gdb, table), name + "_" + table)
+        layers.append(name + "_" + table)
+    t0 = time.time()
+    flow_area.flow_area(*(layers + [True]), backend="arcpy", output_features="flow_area_out")
+    elapsed = time.time() - t0
+    areas = {}
+    with arcpy.da.SearchCursor(os.path.join(gdb, "flow_area_out"), ['SHAPE@AREA', 'DWUNIQUE']) as rows:
+        for row in rows:
+            areas[row[1]] = areas.get(row[1], 0.0) + row[0]
+    return elapsed, areas
+
+def filled_area(folder, srs):
+    # Area in square meters of a 4 km square lake with a 1.44 and a 0.64 square kilometer island after the backend's
+    # eliminate_polygon_part() fills islands under 1 square kilometer, as flow_area() does: 14.56 square kilometers
+    path = os.path.join(folder, "islands_{0}.gpkg".format("geographic" if srs else "projected"))
+    conn = flow_gpkg.connect(path)
+    lake = [(0, 0), (4000, 0), (4000, 4000), (0, 4000), (0, 0)]
+    large = [(500, 500), (1700, 500), (1700, 1700), (500, 1700), (500, 500)]
+    small = [(2500, 2500), (3300, 2500), (3300, 3300), (2500, 3300), (2500, 2500)]
+    _table(conn, 'nhdar', 'MULTIPOLYGON', [], [([[lake, large, small]],)], srs)
+    conn.close()
+    gp = flow_backend.make_backend("shapely")
+    gp.eliminate_polygon_part(os.path.join(path, 'nhdar'), os.path.join(path, 'nhdar_elim'), 1000000, 99.0)
+    area = sum(geom.area for geom in gp.read(os.path.join(path, 'nhdar_elim')).geoms)
+    if srs:
+        sx, sy = degree_scale()
+        area *= sx * sy
+    return area
+
+def compare(expected, actual, tolerance):
+    # Largest relative difference in area over all DWUNIQUEs
+    worst = 0.0
+    for key in set(expected) | set(actual):
+        a, b = expected.get(key, 0.0), actual.get(key, 0.0)
+        worst = max(worst, abs(a - b) / max(a, b, 1e-9))
+    return worst
+
+if __name__ == '__main__':
+    tolerance = float(sys.argv[1]) if len(sys.argv) > 1 else 0.01
+    try:
+        import arcpy
+        have_arcpy = True
+    except ImportError:
+        have_arcpy = False
+    folder = tempfile.mkdtemp()
+    failed = False
+    try:
+        results = {}
+        for name in FIXTURES:
+            shapely_time, shapely_areas = run_shapely(folder, name)
+            results[name] = shapely_areas
+            print("{0}: shapely {1:.2f} s, {2} DWUNIQUE, areas {3}".format(name, shapely_time, len(shapely_areas), sorted((k, round(v)) for k, v in shapely_areas.items())))
+            if not shapely_areas:
+                print("{0}: shapely backend produced no output".format(name))
+                failed = True
+            if name == 'lake_geographic':
+                # The intermediates must keep the coordinate system, whichever store holds them
+                for intermediates in ("memory", "keep"):
+                    stored_areas = run_shapely(folder, name, intermediates)[1]
+                    worst = compare(shapely_areas, stored_areas, tolerance)
+                    print("{0}: intermediates {1}, largest relative area difference {2:.4f}".format(name, intermediates, worst))
+                    failed = failed or worst > tolerance
+                worst = compare(results['lake'], shapely_areas, tolerance)
+                print("{0}: largest relative area difference from lake {1:.4f}".format(name, worst))
+                failed = failed or worst > tolerance
+            if have_arcpy:
+                arcpy_time, arcpy_areas = run_arcpy(folder, name)
+                worst = compare(arcpy_areas, shapely_areas, tolerance)
+                print("{0}: arcpy {1:.2f} s, largest relative area difference {2:.4f}".format(name, arcpy_time, worst))
+                failed = failed or worst > tolerance
+        projected, geographic = filled_area(folder, None), filled_area(folder, WGS84)
+        worst = compare({'lake': projected}, {'lake': geographic}, tolerance)
+        print("islands: {0:.0f} m2 left projected, {1:.0f} m2 geographic, largest relative area difference {2:.4f}".format(projected, geographic, worst))
+        failed = failed or worst > tolerance or abs(projected - 14560000.0) > 1.0
+        if not have_arcpy:
+            print("arcpy not available; shapely backend run only")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,149 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_synth.py
+# Purpose:     Seeded generators of synthetic flow_area inputs: braided-river
+#              and lake polygons, artificial-path flowlines (FCode 55800) with
+#              DWUNIQUE, and upstream/downstream endpoint sets, at configurable
+#              sizes.  Written as GeoPackage tables in projected meters, so
+#              they can be run through the shapely backend without arcpy.
+# Author:      Research Planning, Inc.
+#
+# Usage:       python benchmarks/flow_synth.py output.gpkg [bodies [reaches [spacing [seed]]]]
+#
+#-------------------------------------------------------------------------------
+#
+# A scene is a row of water bodies, alternately a braided river and a lake, body_spacing (3000 m by default) apart.  Its
+# size is controlled by
+#   bodies:     number of water bodies (polygon count)
+#   reaches:    reaches per river and tributaries per lake (flowline, endpoint and cutline count)
+#   spacing:    vertex spacing of polygon outlines and flowlines in meters (vertex density)
+# Rivers run west to east along a meandering centreline, split into reaches at junctions.  Every other reach flows
+# round an island (a hole in the river polygon) in two braids.  Lakes are drained by one outlet and fed by tributaries
+# that meet it at a junction.  Flowlines start and end on the polygon outline or at junctions, which are both upstream
+# and downstream points, as in the compare_backends.py fixtures.
+
+import os, sys, math, numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import flow_gpkg
+
+INPUTS = ('nhdar', 'flowlines', 'upstr', 'dnstr', 'all_flowlines')
+BODY_SPACING = 3000.0
+
+def _samples(length, spacing):
+    # Parameters 0..1 of points about spacing apart along a length, including both ends
+    return numpy.linspace(0.0, 1.0, max(int(math.ceil(length / spacing)), 1) + 1)
+
+def _xy(x, y):
+    return list(zip(x.tolist(), y.tolist()))
+
+def braided_river(body, x0, y0, reaches, spacing, rng, reach_length=500.0, width=200.0):
+    # Return (rings, lines, ups, downs) of a river of the given number of reaches starting at (x0, y0).  rings is the
+    # river outline followed by its islands; lines are (line, DWUNIQUE) pairs.
+    length = reaches * reach_length
+    amplitude = rng.uniform(0.2, 0.5) * width
+    wavelength = rng.uniform(3.0, 6.0) * reach_length
+    phase = rng.uniform(0, 2 * math.pi)
+    def centre(x):
+        return y0 + amplitude * numpy.sin(2 * math.pi * (x - x0) / wavelength + phase)
+
+    x = x0 + length * _samples(length, spacing)
+    top, bottom = centre(x) + width / 2.0, centre(x) - width / 2.0
+    rings = [_xy(x, bottom) + _xy(x[::-1], top[::-1]) + [(float(x[0]), float(bottom[0]))]]
+    lines = []
+    junctions = [x0 + r * reach_length for r in range(reaches + 1)]
+    for r in range(reaches):
+        start, end = junctions[r], junctions[r + 1]
+        t = _samples(reach_length, spacing)
+        x = start + reach_length * t
+        if r % 2 == 0:
+            lines.append(([_xy(x, centre(x))], "B{0}R{1}".format(body, r)))
+            continue
+        # An island over the middle of the reach, with a braid on each side midway between island and bank
+        half_height = rng.uniform(0.1, 0.2) * width
+        island_t = _samples(0.6 * reach_length, spacing)[:-1]
+        island_x = start + reach_length * (0.2 + 0.6 * island_t)
+        island_h = half_height * numpy.sin(math.pi * island_t)
+        island_x = numpy.concatenate((island_x, island_x[::-1][:-1]))
+        island_y = centre(island_x) + numpy.concatenate((-island_h, island_h[::-1][:-1]))
+        rings.append(_xy(island_x, island_y) + [(float(island_x[0]), float(island_y[0]))])
+        offset = (half_height + width / 2.0) / 2.0 * numpy.sin(math.pi * t)
+        lines.append(([_xy(x, centre(x) - offset)], "B{0}R{1}S".format(body, r)))
+        lines.append(([_xy(x, centre(x) + offset)], "B{0}R{1}N".format(body, r)))
+    points = [(float(jx), float(centre(numpy.array([jx]))[0])) for jx in junctions]
+    return rings, lines, points[:-1], points[1:]
+
+def lake(body, cx, cy, tributaries, spacing, rng, radius=600.0):
+    # Return (rings, lines, ups, downs) of a lake centred on (cx, cy) with an outlet to the east and the given number of
+    # tributaries entering from the other sides
+    phases = rng.uniform(0, 2 * math.pi, 2)
+    theta = 2 * math.pi * _samples(2 * math.pi * radius, spacing)
+    r = radius * (1.0 + 0.08 * numpy.sin(3 * theta + phases[0]) + 0.05 * numpy.sin(5 * theta + phases[1]))
+    x, y = cx + r * numpy.cos(theta), cy + r * numpy.sin(theta)
+    x[-1], y[-1] = x[0], y[0]
+    rings = [_xy(x, y)]
+    junction = (cx + 0.25 * radius, cy)
+    def line(start, end, wiggle):
+        length = math.hypot(end[0] - start[0], end[1] - start[1])
+        t = _samples(length, spacing)
+        # An S-shaped meander that dies away towards the junction, so tributaries do not cross as they converge
+        offset = wiggle * length * numpy.sin(2 * math.pi * t) * (1.0 - t) ** 2
+        nx, ny = -(end[1] - start[1]) / length, (end[0] - start[0]) / length
+        return [_xy(start[0] + (end[0] - start[0]) * t + nx * offset, start[1] + (end[1] - start[1]) * t + ny * offset)]
+    outlet = (float(x[0]), float(y[0]))
+    lines = [(line(junction, outlet, 0.02), "B{0}OUT".format(body))]
+    ups = []
+    # Tributaries enter at outline vertices spread over the western two thirds of the lake
+    vertices = len(theta) - 1
+    for k in range(tributaries):
+        angle = math.pi / 3 + (4 * math.pi / 3) * (k + 0.5) / tributaries
+        start = (float(x[int(round(angle / (2 * math.pi) * vertices)) % vertices]), float(y[int(round(angle / (2 * math.pi) * vertices)) % vertices]))
+        lines.append((line(start, junction, rng.uniform(-0.1, 0.1)), "B{0}T{1}".format(body, k)))
+        ups.append(start)
+    return rings, lines, ups + [junction], [junction, outlet]
+
+def scene(bodies=2, reaches=3, spacing=20.0, seed=0, body_spacing=BODY_SPACING):
+    # Dictionary of input name to rows for flow_area: nhdar rows are (polygon,), flowline rows (line, DWUNIQUE, FCode)
+    # and point rows ((x, y),).  Each body's outflow also continues downstream as a stream flowline (FCode 46006).
+    # body_spacing is the distance between the starts of consecutive bodies; bodies overlap below reaches * 500 m.
+    rng = numpy.random.RandomState(seed)
+    tables = dict((name, []) for name in INPUTS)
+    for body in range(bodies):
+        x0 = body * body_spacing
+        if body % 2 == 0:
+            rings, lines, ups, downs = braided_river(body, x0, 0.0, reaches, spacing, rng)
+        else:
+            rings, lines, ups, downs = lake(body, x0 + 1000.0, 0.0, reaches, spacing, rng)
+        tables['nhdar'].append(([rings],))
+        end = downs[-1]
+        lines = [(line, dwunique, 55800) for line, dwunique in lines] + [([[end, (end[0] + 500.0, end[1])]], "B{0}STREAM".format(body), 46006)]
+        tables['flowlines'].extend(lines)
+        tables['all_flowlines'].extend(lines)
+        tables['upstr'].extend((pt,) for pt in ups)
+        tables['dnstr'].extend((pt,) for pt in downs)
+    return tables
+
+def write_scene(path, tables):
+    conn = flow_gpkg.connect(path)
+    geometry_types = {'nhdar': 'MULTIPOLYGON', 'flowlines': 'MULTILINESTRING', 'all_flowlines': 'MULTILINESTRING', 'upstr': 'POINT', 'dnstr': 'POINT'}
+    for name in INPUTS:
+        fields = [('DWUNIQUE', 'TEXT'), ('FCode', 'LONG')] if geometry_types[name] == 'MULTILINESTRING' else []
+        flow_gpkg.create_table(conn, name, geometry_types[name], fields)
+        flow_gpkg.insert_rows(conn, name, [field for field, ftype in fields], tables[name])
+    conn.close()
+    return [os.path.join(path, name) for name in INPUTS]
+
+def counts(tables):
+    # Polygon, flowline, endpoint and vertex counts of a scene
+    polygon_vertices = sum(len(ring) for row in tables['nhdar'] for polygon in row[0] for ring in polygon)
+    line_vertices = sum(len(part) for row in tables['flowlines'] for part in row[0])
+    return {'polygons': len(tables['nhdar']), 'flowlines': len(tables['flowlines']),
+            'endpoints': len(tables['upstr']) + len(tables['dnstr']), 'vertices': polygon_vertices + line_vertices}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python flow_synth.py output.gpkg [bodies [reaches [spacing [seed]]]]")
+        sys.exit(1)
+    args = sys.argv[2:] + [None] * 4
+    tables = scene(int(args[0] or 2), int(args[1] or 3), float(args[2] or 20.0), int(args[3] or 0))
+    write_scene(sys.argv[1], tables)
+    print(counts(tables))
@@ -0,0 +1,59 @@
+#-------------------------------------------------------------------------------
+# Name:        parity_labels.py
+# Purpose:     Parity check of labelling cracked polygons by their Thiessen
+#              polygon (flow_area label_cells=True) against the former spatial
+#              join to the flowlines crossing their outlines (label_cells=False)
+#              on the compare_backends.py fixtures, with both Thiessen conflict
+#              policies.  Reports the area per DWUNIQUE, the area labelled more
+#              than once and the time of each run, and exits non-zero if any
+#              DWUNIQUE's area differs by more than the tolerance.  Uses the
+#              shapely backend; does not require arcpy.
+# Author:      Research Planning, Inc.
+#
+# Usage:       python benchmarks/parity_labels.py [tolerance]
+#
+#-------------------------------------------------------------------------------
+
+import os, sys, time, shutil, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import flow_area, flow_gpkg
+from compare_backends import INPUTS, make_fixture, areas_gpkg, compare
+
+def overlap_gpkg(path, table):
+    # Area covered by more than one output feature
+    import shapely
+    conn = flow_gpkg.connect(path)
+    geoms = [shapely.from_wkb(flow_gpkg.wkb_from_blob(row[0])) for row in conn.execute('SELECT geom FROM "{0}"'.format(table))]
+    conn.close()
+    return sum(geom.area for geom in geoms) - shapely.union_all(geoms).area if geoms else 0.0
+
+def run(folder, name, thiessen, label_cells):
+    path = os.path.join(folder, "{0}_{1}_{2}.gpkg".format(name, thiessen, label_cells))
+    make_fixture(path, name)
+    inputs = [os.path.join(path, table) for table in INPUTS]
+    t0 = time.time()
+    flow_area.flow_area(*(inputs + [thiessen]), backend="shapely", output_features="flow_area_out", label_cells=label_cells)
+    return time.time() - t0, areas_gpkg(path, "flow_area_out"), overlap_gpkg(path, "flow_area_out")
+
+if __name__ == '__main__':
+    tolerance = float(sys.argv[1]) if len(sys.argv) > 1 else 0.02
+    folder = tempfile.mkdtemp()
+    failed = False
+    results = []
+    try:
+        for name in ('river', 'lake'):
+            for thiessen in (True, False):
+                join_time, join_areas, join_overlap = run(folder, name, thiessen, False)
+                cells_time, cells_areas, cells_overlap = run(folder, name, thiessen, True)
+                worst = compare(join_areas, cells_areas, tolerance)
+                failed = failed or worst > tolerance
+                results.append((name, thiessen, join_time, cells_time, worst, join_overlap, cells_overlap, join_areas, cells_areas))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    for name, thiessen, join_time, cells_time, worst, join_overlap, cells_overlap, join_areas, cells_areas in results:
+        print("{0} (thiessen {1}): join {2:.2f} s, cells {3:.2f} s, largest relative area difference {4:.4f}, overlapping area {5:.0f} / {6:.0f}".format(
+            name, thiessen, join_time, cells_time, worst, join_overlap, cells_overlap))
+        for key in sorted(set(join_areas) | set(cells_areas)):
+            print("    {0:<10} join {1:>12.0f}   cells {2:>12.0f}".format(key, join_areas.get(key, 0.0), cells_areas.get(key, 0.0)))
+    sys.exit(1 if failed else 0)
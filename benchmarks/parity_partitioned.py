@@ -0,0 +1,66 @@
+#-------------------------------------------------------------------------------
+# Name:        parity_partitioned.py
+# Purpose:     Parity check of flow_parallel.flow_area_partitioned() against a
+#              single flow_area() run on synthetic scenes from flow_synth.py,
+#              with both Thiessen conflict policies.  The "close" scenes put the
+#              water bodies within cutline and Thiessen reach of each other, so
+#              each partition depends on its halo of neighbouring water bodies;
+#              in the "apart" scene every partition runs on one water body.
+#              Reports the time of each run and exits non-zero if any DWUNIQUE's
+#              area differs by more than the tolerance.  Uses the shapely
+#              backend; does not require arcpy.
+# Author:      Research Planning, Inc.
+#
+# Usage:       python benchmarks/parity_partitioned.py [workers [tolerance]]
+#
+#-------------------------------------------------------------------------------
+
+import os, sys, time, shutil, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import flow_area, flow_parallel
+import flow_synth
+from compare_backends import areas_gpkg, compare
+
+# name: flow_synth.scene() arguments
+SCENES = [
+    ('spread', {'bodies': 4}),
+    ('apart', {'bodies': 8, 'body_spacing': 10000.0}),
+    ('close', {'bodies': 4, 'body_spacing': 1700.0}),
+    ('close_long', {'bodies': 3, 'reaches': 5, 'body_spacing': 2700.0, 'seed': 1}),
+]
+
+def run(folder, name, scene_args, thiessen, workers):
+    # Run both ways on copies of the same scene; returns (single time, partitioned time, single areas, partitioned areas)
+    tables = flow_synth.scene(**scene_args)
+    single = os.path.join(folder, "{0}_{1}_single.gpkg".format(name, thiessen))
+    partitioned = os.path.join(folder, "{0}_{1}_partitioned.gpkg".format(name, thiessen))
+    t0 = time.time()
+    flow_area.flow_area(*(flow_synth.write_scene(single, tables) + [thiessen]), backend="shapely", output_features="flow_area_out", raise_errors=True)
+    single_time = time.time() - t0
+    t0 = time.time()
+    flow_parallel.flow_area_partitioned(*(flow_synth.write_scene(partitioned, tables) + [thiessen]), workers=workers, backend="shapely", output_features="flow_area_out")
+    partitioned_time = time.time() - t0
+    return single_time, partitioned_time, areas_gpkg(single, "flow_area_out"), areas_gpkg(partitioned, "flow_area_out")
+
+if __name__ == '__main__':
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    tolerance = float(sys.argv[2]) if len(sys.argv) > 2 else 0.001
+    folder = tempfile.mkdtemp()
+    failed = False
+    results = []
+    try:
+        for name, scene_args in SCENES:
+            for thiessen in (True, False):
+                single_time, partitioned_time, single_areas, partitioned_areas = run(folder, name, scene_args, thiessen, workers)
+                worst = compare(single_areas, partitioned_areas, tolerance)
+                failed = failed or worst > tolerance
+                results.append((name, thiessen, single_time, partitioned_time, worst, single_areas, partitioned_areas))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    for name, thiessen, single_time, partitioned_time, worst, single_areas, partitioned_areas in results:
+        print("{0} (thiessen {1}): single {2:.2f} s, partitioned {3:.2f} s, largest relative area difference {4:.6f}".format(
+            name, thiessen, single_time, partitioned_time, worst))
+        for key in sorted(set(single_areas) | set(partitioned_areas)):
+            print("    {0:<10} single {1:>12.0f}   partitioned {2:>12.0f}".format(key, single_areas.get(key, 0.0), partitioned_areas.get(key, 0.0)))
+    sys.exit(1 if failed else 0)
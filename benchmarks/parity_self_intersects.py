@@ -0,0 +1,94 @@
+#-------------------------------------------------------------------------------
+# Name:        parity_self_intersects.py
+# Purpose:     Parity check of the indexed flow_geom.filter_self_intersects()
+#              pass against the literal nested-loop semantics of the former
+#              remove_self_intersects() cursor loops, written with the same
+#              flow_geom primitives, on seeded synthetic cutline scenes.
+#              Reports the time of each and exits non-zero on any difference
+#              in the output rows or their order.  Does not require arcpy.
+# Author:      Research Planning, Inc.
+#
+# Usage:       python benchmarks/parity_self_intersects.py [scenes [lines]]
+#
+#-------------------------------------------------------------------------------
+
+import os, sys, time, numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import flow_geom
+from flow_geom import lines_disjoint, lines_equal, cut_line, point_on_line
+
+def nested_loops(lines, ids, points, tolerance=0.0):
+    # The former loops, one row and point at a time: each line is compared with every line (including itself), the last
+    # overlapping line with the same ID that is not identical cuts it, and a row is written for every point it touches
+    output = []
+    overlaps = []
+    for line, line_id in zip(lines, ids):
+        cutlines = None
+        for other, other_id in zip(lines, ids):
+            if not lines_disjoint(other, line, tolerance):
+                if not lines_equal(other, line, tolerance) and line_id == other_id:
+                    overlaps.append((other_id, line_id))
+                    cutlines = cut_line(line, other, tolerance)
+        for piece in ([line] if cutlines is None else cutlines):
+            for pt in points:
+                if point_on_line(pt, piece, tolerance):
+                    output.append((piece, line_id))
+    return output, overlaps
+
+def make_scene(seed, count):
+    # Perpendicular-style cutlines (end, midpoint, end) crowded into a small area so that many cross, drawn from a few
+    # IDs, with some exact and reversed duplicates.  Points are the midpoints of most lines plus a few points on other
+    # lines' ends and in open space.
+    rng = numpy.random.RandomState(seed)
+    lines = []
+    ids = []
+    for i in range(count):
+        if lines and rng.uniform() < 0.1:
+            k = rng.randint(len(lines))
+            part = lines[k][0] if rng.uniform() < 0.5 else list(reversed(lines[k][0]))
+            lines.append([part])
+            ids.append(ids[k])
+            continue
+        mid = rng.uniform(0, 100, 2)
+        angle = rng.uniform(0, numpy.pi)
+        half = rng.uniform(5, 40)
+        dx, dy = half * numpy.cos(angle), half * numpy.sin(angle)
+        lines.append([[(mid[0] - dx, mid[1] - dy), (mid[0], mid[1]), (mid[0] + dx, mid[1] + dy)]])
+        ids.append("ID{0}".format(rng.randint(max(count // 4, 1))))
+    points = [line[0][1] for line in lines if rng.uniform() < 0.8]
+    points += [line[0][0] for line in lines if rng.uniform() < 0.1]
+    points += [tuple(pt) for pt in rng.uniform(0, 100, (max(count // 10, 1), 2)).tolist()]
+    return lines, ids, points
+
+def run(seed, count, tolerance=0.001):
+    lines, ids, points = make_scene(seed, count)
+    overlaps = []
+    t0 = time.time()
+    indexed = flow_geom.filter_self_intersects(lines, ids, points, tolerance, report=lambda a, b: overlaps.append((a, b)))
+    indexed_time = time.time() - t0
+    t0 = time.time()
+    expected, expected_overlaps = nested_loops(lines, ids, points, tolerance)
+    loops_time = time.time() - t0
+    return indexed == expected and overlaps == expected_overlaps, len(expected), indexed_time, loops_time
+
+if __name__ == '__main__':
+    scenes = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    largest = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    mismatches = []
+    rows = 0
+    indexed_total, loops_total = 0.0, 0.0
+    for seed in range(scenes):
+        count = 5 + seed % (largest - 4)
+        same, written, indexed_time, loops_time = run(seed, count)
+        rows += written
+        indexed_total += indexed_time
+        loops_total += loops_time
+        if not same:
+            mismatches.append((seed, count))
+    print("{0} scenes, {1} output rows: indexed {2:.3f} s, nested loops {3:.3f} s".format(scenes, rows, indexed_total, loops_total))
+    for seed, count in mismatches:
+        print("MISMATCH seed {0} ({1} lines)".format(seed, count))
+    if not mismatches:
+        print("No mismatches")
+    sys.exit(1 if mismatches else 0)
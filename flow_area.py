@@ -8,50 +8,10 @@
 #
 #-------------------------------------------------------------------------------
 
-import os, sys, arcpy, traceback, math
-from arcpy import env
+import os, sys, traceback, math, numpy
+import flow_geom, flow_store, flow_report, flow_io, flow_backend
 
-def add_subtract_radians(theta):
-    return (theta + 1.57079632679, theta - 1.57079632679)
-
-def distance(x1, y1, x2, y2):
-    return float(math.pow(((math.pow((x2-x1),2)) + (math.pow((y2 - y1),2))),.5))
-
-def cart_to_polar(xy1, xy2):
-    try:
-        x1, y1, x2, y2 = float(xy1[0]), float(xy1[1]), float(xy2[0]), float(xy2[1])
-        xdistance, ydistance = x2 - x1, y2 - y1
-        distance = math.pow(((math.pow((x2 - x1),2)) + (math.pow((y2 - y1),2))),.5)
-        if xdistance == 0:
-            if y2 > y1:
-                theta = math.pi/2
-            else:
-                theta = (3*math.pi)/2
-        elif ydistance == 0:
-            if x2 > x1:
-                theta = 0
-            else:
-                theta = math.pi
-        else:
-            theta = math.atan(ydistance/xdistance)
-            if xdistance > 0 and ydistance < 0:
-                theta = 2*math.pi + theta
-            if xdistance < 0 and ydistance > 0:
-                theta = math.pi + theta
-            if xdistance < 0 and ydistance < 0:
-                theta = math.pi + theta
-        return [distance, theta]
-    except:
-        print"      Cutline - Error in CartesianToPolar()"
-
-def polar_to_cart(polarcoords):
-    r = polarcoords[0]
-    theta = polarcoords[1]
-    x = r * math.cos(theta)
-    y = r * math.sin(theta)
-    return [x, y]
-
-def remove_self_intersects(input_features, intersect_points, id_field, output_features):
+def remove_self_intersects(input_features, intersect_points, id_field, output_features, report=None, chunk_size=flow_io.CHUNK_SIZE):
     # Function to remove portions of features from supplied feature class that 1.) intersect, 2.) are not identical, 3.) have the same ID field, and 4.) do not overlap a supplied set of points.
     #
     # ARGUMENTS:
@@ -59,121 +19,124 @@ def remove_self_intersects(input_features, intersect_points, id_field, output_fe
     # intersect_points:     Feature class or layer containing points to check against. Portions of intersecting features will be retained if they intersect with these points.
     # id_field:             Attribute field containing ID field to check against.  Only intersecting features with same ID will be split and checked against point feature class.
     # output_features:      Feature class output name
-
-    desc = arcpy.Describe(input_features)
-    spatialRef = desc.spatialReference
-    workspace = desc.path
-    arcpy.CreateFeatureclass_management(workspace, output_features, "POLYLINE", input_features,"","", spatialRef)
-    with arcpy.da.InsertCursor(output_features, ['SHAPE@', 'DWUNIQUE']) as cursor:
-        for row in arcpy.da.SearchCursor(input_features, ('SHAPE@', str(id_field))):
-            val = True
-            cutlines = []
-            for row2 in arcpy.da.SearchCursor(input_features, ('SHAPE@', str(id_field))):
-                if not row2[0].disjoint(row[0]):
-                    if not row2[0].equals(row[0]) and row[1] == row2[1]:
-                        arcpy.AddMessage( '  Cutline {0} overlaps {1}.  Splitting...'.format(str(row2[1]), str(row[1])))
-                        cutlines = row[0].cut(row2[0])
-                        val = False
-            if val:
-                for point in arcpy.da.SearchCursor(intersect_points, ('SHAPE@')):
-                    if not point[0].disjoint(row[0]):
-                        cursor.insertRow([row[0],row[1]])
-            else:
-                for cutline in cutlines:
-                    for point in arcpy.da.SearchCursor(intersect_points, ('SHAPE@')):
-                        if not point[0].disjoint(cutline):
-                            cursor.insertRow([cutline,row[1]])
-
-def make_perpendicular(input_lines, distance, output_features, start):
+    # report:               Optional flow_report.RunReport to record stage timings in
+    # chunk_size:           Number of features read or written per flow_io chunk
+
+    if report is None:
+        report = flow_report.RunReport()
+    report.begin("remove_self_intersects", [input_features, intersect_points])
+    workspace, spatialRef, tolerance = flow_io.describe(input_features)
+
+    # Read cutlines and split points into memory once, a chunk at a time; candidate pairs are found through a spatial index in flow_geom
+    report.begin("read")
+    lines = []
+    ids = []
+    for chunk in flow_io.read_chunks(input_features, [str(id_field)], chunk_size):
+        lines.extend(chunk.lines())
+        ids.extend(chunk.attributes[str(id_field)])
+    points = []
+    for chunk in flow_io.read_chunks(intersect_points, (), chunk_size):
+        points.extend(chunk.points())
+    line_counts = (len(lines), sum(len(part) for line in lines for part in line))
+    report.end([line_counts, (len(points), len(points))])
+
+    def log_overlap(cutter_id, line_id):
+        flow_io.add_message( '  Cutline {0} overlaps {1}.  Splitting...'.format(str(cutter_id), str(line_id)))
+    report.begin("filter", [line_counts, (len(points), len(points))])
+    output_rows = flow_geom.filter_self_intersects(lines, ids, points, tolerance, log_overlap)
+    output_counts = (len(output_rows), sum(len(part) for line, lineid in output_rows for part in line))
+    report.end([output_counts])
+
+    report.begin("write", [output_counts])
+    with flow_io.open_writer(flow_io.output_path(workspace, output_features), "POLYLINE", [('DWUNIQUE', 'TEXT', 50)], spatialRef, input_features) as writer:
+        for i in range(0, len(output_rows), chunk_size):
+            rows = output_rows[i:i + chunk_size]
+            writer.write(flow_io.FeatureChunk.from_lines([line for line, lineid in rows], {'DWUNIQUE': [lineid for line, lineid in rows]}))
+    report.end([output_counts])
+    report.end([output_counts])
+
+def make_perpendicular(input_lines, distance, output_features, start, report=None, chunk_size=flow_io.CHUNK_SIZE):
     # Function to generate perpendicular cutlines at start or stop of polyline features, and copy to newly created feature class.
     #
     # ARGUMENTS:
     # input_lines:          Feature class or layer containing lines for which to generate perpendicular cutlines.  Presumes DWUNIQUE exists as text field
-    # distance:             Distance in horizontal units of input feature class
+    # distance:             Cutline half-length in horizontal units of input feature class.  Either a scalar, or a sequence with one length per input line in cursor order
     # output_features:      Feature class output name
     # start:                Boolean indicating whether to generate perpendicular cutline at beginning/start or end/stop point of line. True indicates beginning/start, False indicates end/stop
+    # report:               Optional flow_report.RunReport to record stage timings in
+    # chunk_size:           Number of lines read, cut and written per flow_io chunk
 
     # Setup environment and get spatial reference of input
-    desc = arcpy.Describe(input_lines)
-    spatialRef = desc.spatialReference
-    workspace = desc.path
-
-    # Get the input line features geometry and DWUNIQUE as a python list.
-    rows = arcpy.da.SearchCursor(input_lines, ('SHAPE@', 'DWUNIQUE'))
-    listofpointgeometry = []
-    listofids = []
-    for row in rows:
-        feat = row[0]
-        partnum = 0
-        partcount = feat.partCount
-        thisrecordsgeometry = []
-        while partnum < partcount:
-            part = feat.getPart(partnum)
-            pnt = part.next()
-            pntcount = 0
-            while pnt:
-                thetuple = [pnt.X, pnt.Y]
-                thisrecordsgeometry.append(thetuple)
-                pnt = part.next()
-                pntcount += 1
-            partnum += 1
-        if start:
-            startnode = [thisrecordsgeometry[0][0], thisrecordsgeometry[0][1]]
-            endnode = [thisrecordsgeometry[1][0], thisrecordsgeometry[1][1]]
-        else:
-            startnode = [thisrecordsgeometry[-2][0], thisrecordsgeometry[-2][1]]
-            endnode = [thisrecordsgeometry[-1][0], thisrecordsgeometry[-1][1]]
-        listofpointgeometry.append([startnode,endnode])
-        listofids.append(str(row[1]))
-
-    # Create the feature class to store the new geometry....
-    arcpy.CreateFeatureclass_management(workspace, output_features, "POLYLINE", "","","", spatialRef)
-    arcpy.AddField_management(output_features, "DWUNIQUE", "TEXT", 50)
-
-    # Cursor through points, make cutlines and add features to destination feature class
-    array = arcpy.Array()
-    pnt = arcpy.Point()
-    with arcpy.da.InsertCursor(output_features, ['SHAPE@', 'DWUNIQUE']) as cursor:
-        for pt in listofpointgeometry:
-            lind = listofpointgeometry.index(pt)
-            startx = pt[0][0]
-            starty = pt[0][1]
-            endx = pt[1][0]
-            endy = pt[1][1]
-            #get a theta
-            polarcoor = cart_to_polar((startx,starty), (endx,endy))
-            #Add and subtract the 90 degrees in radians from the line...
-            ends = add_subtract_radians(polarcoor[1])
-            firstend = polar_to_cart((float(distance),float(ends[0])))
-            secondend = polar_to_cart((float(distance),float(ends[1])))
-            if start:
-                firstx2 = startx + firstend[0]
-                firsty2 = starty + firstend[1]
-                secondx2 = startx + secondend[0]
-                secondy2 = starty + secondend[1]
-                midx = startx
-                midy = starty
-            else:
-                firstx2 = endx + firstend[0]
-                firsty2 = endy + firstend[1]
-                secondx2 = endx + secondend[0]
-                secondy2 = endy + secondend[1]
-                midx = endx
-                midy = endy
-            pnt.X, pnt.Y = firstx2 , firsty2
-            array.add(pnt)
-            pnt.X, pnt.Y = midx , midy
-            array.add(pnt)
-            pnt.X, pnt.Y = secondx2 , secondy2
-            array.add(pnt)
-            polyline = arcpy.Polyline(array)
-            cursor.insertRow([polyline,listofids[lind]])
-            array.removeAll()
-    del cursor
-
-
-
-def flow_area(input_nhd_area_polys, input_flow_lines, input_upstr_pts, input_dnstr_pts, input_all_flow_lines, thiessen):
+    if report is None:
+        report = flow_report.RunReport()
+    report.begin("make_perpendicular", [input_lines])
+    workspace, spatialRef, tolerance = flow_io.describe(input_lines)
+    distance = numpy.asarray(distance, dtype=float)
+
+    # Stream the lines a chunk at a time: take the two vertices at the start or end of each line, make all of the chunk's
+    # cutlines in one pass and write them to the destination feature class with DWUNIQUE
+    count = 0
+    with flow_io.open_writer(flow_io.output_path(workspace, output_features), "POLYLINE", [('DWUNIQUE', 'TEXT', 50)], spatialRef) as writer:
+        for chunk in flow_io.read_chunks(input_lines, ['DWUNIQUE'], chunk_size):
+            first, second = chunk.first_segments() if start else chunk.last_segments()
+            cutlines = flow_geom.perpendicular_cutlines(first, second, distance if distance.ndim == 0 else distance[count:count + len(chunk)], start)
+            writer.write(flow_io.FeatureChunk.from_lines(cutlines, {'DWUNIQUE': [str(lineid) for lineid in chunk.attributes['DWUNIQUE']]}))
+            count += len(chunk)
+    report.end([(count, 3 * count)])
+
+
+
+def thiessen_spacing(dataset, bbox, spacing):
+    # Densify spacing in meters converted to the coordinate units of dataset, as make_thiessen() uses it, for data within bbox
+    meters = flow_io.meters_per_unit(dataset)
+    if meters:
+        return float(spacing) / meters
+    if flow_io.is_geographic(dataset) and bbox is not None:
+        # A degree of longitude shortens towards the poles; densify with separate spacings along each axis
+        latitude = math.radians(min(abs(bbox[1] + bbox[3]) / 2.0, 89.0))
+        return (float(spacing) / (flow_io.METERS_PER_DEGREE * math.cos(latitude)), float(spacing) / flow_io.METERS_PER_DEGREE)
+    return float(spacing)
+
+def make_thiessen(input_lines, extent_features, spacing, output_features, chunk_size=flow_io.CHUNK_SIZE):
+    # Function to densify flowlines, convert their vertices to points and generate Thiessen polygons clipped to an extent, all in memory.
+    #
+    # ARGUMENTS:
+    # input_lines:          List of feature classes or layers containing flowlines, in priority order.  Vertices of later inputs that coincide with vertices of earlier inputs are discarded
+    # extent_features:      Feature class or layer whose extent the Thiessen polygons are clipped to
+    # spacing:              Densify spacing in meters.  Converted to the units of projected data, and to degrees of longitude and latitude at the middle of the extent for geographic data; data with an unknown coordinate system is taken to be in meters
+    # output_features:      Feature class output name.  Each polygon carries the DWUNIQUE of the flowline its vertex came from, where available
+    # chunk_size:           Number of features read or written per flow_io chunk
+
+    workspace, spatialRef, tolerance = flow_io.describe(input_lines[0])
+    bbox = flow_io.extent(extent_features)
+    spacing = thiessen_spacing(input_lines[0], bbox, spacing)
+
+    sources = []
+    for lines_fc in input_lines:
+        fields = ['DWUNIQUE'] if 'DWUNIQUE' in flow_io.field_names(lines_fc) else []
+        lines = []
+        labels = []
+        for chunk in flow_io.read_chunks(lines_fc, fields, chunk_size):
+            values = chunk.attributes.get('DWUNIQUE', [None] * len(chunk))
+            for line, label in zip(chunk.lines(), values):
+                if not line:
+                    continue
+                lines.append(line)
+                labels.append(str(label) if label is not None else None)
+        sources.append((lines, labels))
+
+    # flow_thiessen needs SciPy, which ArcMap's Python 2 does not always have; importing it here keeps the rest of this module usable without it
+    import flow_thiessen
+    cells = flow_thiessen.thiessen_cells(sources, spacing, bbox, tolerance)
+
+    with flow_io.open_writer(flow_io.output_path(workspace, output_features), "POLYGON", [('DWUNIQUE', 'TEXT', 50)], spatialRef) as writer:
+        for i in range(0, len(cells), chunk_size):
+            rows = cells[i:i + chunk_size]
+            writer.write(flow_io.FeatureChunk.from_rings([[ring] for ring, label in rows], {'DWUNIQUE': [label for ring, label in rows]}))
+
+def flow_area(input_nhd_area_polys, input_flow_lines, input_upstr_pts, input_dnstr_pts, input_all_flow_lines, thiessen, cutline_distance=2000, densify_spacing=10, intermediates="temp", output_features="pf_swpt_nhdar_all_fl_clip", report=None, backend=None, raise_errors=False, label_cells=True, count_vertices=False, resume=None):
+    store = None
+    gp = None
     try:
         # ARGUMENTS:
         # input_nhd_area_polys: Feature layer containing NHD area polgyons that may contain upstream-downstream flowlines
@@ -182,156 +145,207 @@ def flow_area(input_nhd_area_polys, input_flow_lines, input_upstr_pts, input_dns
         # input_dnstr_pts:      Feature layer containing downstream termination points for upstream-downstream flowlines that may intersect NHD area polgyons
         # input_all_flow_lines: Feature layer containing all flowlines (including non-upstream-downstream) that may intersect NHD area polgyons
         # thiessen:             Boolean indicating whether to preserve thiessen-derived breaks when in conflict with cutline-derived. True preserves thiessen-derived, False preserves cutline-derived
+        # cutline_distance:     Half-length of perpendicular cutlines in horizontal units of input feature classes
+        # densify_spacing:      Spacing in meters of the flowline vertices that seed the Thiessen polygons
+        # intermediates:        Where to keep pf_swpt_* intermediates: one of the flow_store modes "temp", "memory", "namespace" or "keep", or an open flow_store.IntermediateStore
+        # output_features:      Output feature class name, created in the workspace of input_nhd_area_polys
+        # report:               Optional flow_report.RunReport to record per-stage timings in.  By default a report with feature counts is kept and summarized in the messages
+        # count_vertices:       Boolean indicating whether the default report also counts the vertices of each stage's inputs and outputs.  Counting reads every geometry, so it is off by default
+        # resume:               Optional names of the stages an earlier run completed with the same intermediates store ("namespace" or "keep").  The leading stages among them whose outputs are still in the store are skipped, and the run carries on from the first stage that is not
+        # backend:              Geoprocessing backend: "arcpy", "shapely" or a flow_backend.Backend.  By default shapely for GeoPackage inputs and arcpy otherwise
+        # raise_errors:         Boolean indicating whether to re-raise errors after reporting them, so that callers such as flow_batch.py can record them.  By default they are only reported
+        # label_cells:          Boolean indicating how cracked polygons get their DWUNIQUE.  True labels each with the DWUNIQUE of the flowline its Thiessen polygon was seeded from and dissolves by it directly.  False restores the former one-to-many spatial join to the flowlines crossing each polygon's outline (CROSSED_BY_THE_OUTLINE_OF) followed by a dissolve
 
         # Setup workspace and environment
-        arcpy.env.qualifiedFieldNames = False
-        arcpy.env.overwriteOutput = True
-        desc = arcpy.Describe(input_nhd_area_polys)
-        arcpy.env.workspace = desc.path
-        arcpy.AddMessage("  Input workspace: "+str(desc.path))
+        gp = flow_backend.make_backend(backend, input_nhd_area_polys)
+        workspace = flow_io.describe(input_nhd_area_polys)[0]
+        gp.add_message("  Input workspace: "+str(workspace))
+        if isinstance(intermediates, flow_store.IntermediateStore):
+            store = intermediates
+        else:
+            store = flow_store.make_store(workspace, intermediates).open()
+        gp.use_workspace(store.workspace)
+        pf = store.name
+        if report is None:
+            report = flow_report.RunReport(counter=lambda dataset: gp.count(dataset, count_vertices))
+        report.attach(store)
+        gp.add_message("  Intermediate workspace: "+str(store.workspace))
+
+        # Stages run unless they and every stage before them completed in an earlier run
+        completed = set(resume or ())
+        resuming = [bool(completed)]
+        def run(stage, outputs):
+            if resuming[0] and stage in completed and all(gp.exists(output) for output in outputs):
+                gp.add_message("  Skipping {0}, completed by an earlier run".format(stage))
+                return False
+            resuming[0] = False
+            return True
 
         # Extract only Artificial paths from input flowlines
-        arcpy.AddMessage("  Filtering flowlines to extract only artificial paths...")
-        arcpy.SelectLayerByAttribute_management(input_flow_lines, "CLEAR_SELECTION")
-        arcpy.SelectLayerByAttribute_management(in_layer_or_view=input_flow_lines, selection_type="NEW_SELECTION", where_clause="FCode = 55800")
-        arcpy.CopyFeatures_management(input_flow_lines, "pf_swpt_all_fl_filt")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_all_fl_filt",out_layer="pf_swpt_all_fl_filt")
-        arcpy.SelectLayerByAttribute_management(input_all_flow_lines, "CLEAR_SELECTION")
-        arcpy.SelectLayerByAttribute_management(in_layer_or_view=input_all_flow_lines, selection_type="NEW_SELECTION", where_clause="FCode = 55800")
-        arcpy.CopyFeatures_management(input_all_flow_lines, "pf_swpt_nhdfl6mi_filt")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_nhdfl6mi_filt",out_layer="pf_swpt_nhdfl6mi_filt")
+        if run("filter_flowlines", [pf("pf_swpt_all_fl_filt"), pf("pf_swpt_nhdfl6mi_filt")]):
+            report.begin("filter_flowlines", [input_flow_lines, input_all_flow_lines])
+            gp.add_message("  Filtering flowlines to extract only artificial paths...")
+            gp.clear_selection(input_flow_lines)
+            gp.clear_selection(input_all_flow_lines)
+            gp.select(input_flow_lines, "FCode = 55800", pf("pf_swpt_all_fl_filt"))
+            gp.select(input_all_flow_lines, "FCode = 55800", pf("pf_swpt_nhdfl6mi_filt"))
+            report.end([pf("pf_swpt_all_fl_filt"), pf("pf_swpt_nhdfl6mi_filt")])
 
         # Merge upstream and downstream flowline endpoints
-        arcpy.AddMessage("  Merging flowline endpoints...")
-        arcpy.Merge_management(inputs=str(input_upstr_pts)+";"+str(input_dnstr_pts), output="pf_swpt_splitpnt_ends", field_mappings="")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_splitpnt_ends",out_layer="pf_swpt_splitpnt_ends")
+        if run("merge_endpoints", [pf("pf_swpt_splitpnt_ends")]):
+            report.begin("merge_endpoints", [input_upstr_pts, input_dnstr_pts])
+            gp.add_message("  Merging flowline endpoints...")
+            gp.merge([input_upstr_pts, input_dnstr_pts], pf("pf_swpt_splitpnt_ends"))
+            report.end([pf("pf_swpt_splitpnt_ends")])
 
         # Dissolve all NHD Area polygons and remove islands
-        arcpy.SelectLayerByAttribute_management(input_nhd_area_polys, "CLEAR_SELECTION")
-        arcpy.SelectLayerByLocation_management(in_layer=input_nhd_area_polys, overlap_type="INTERSECT", select_features="pf_swpt_all_fl_filt", search_distance="", selection_type="NEW_SELECTION", invert_spatial_relationship="NOT_INVERT")
-        arcpy.AddMessage("  Dissolving all NHD area polygons that intersect upstream/downstream flowlines...")
-        arcpy.Dissolve_management(in_features=input_nhd_area_polys, out_feature_class="pf_swpt_nhdar6mi_diss", dissolve_field="", statistics_fields="", multi_part="SINGLE_PART", unsplit_lines="DISSOLVE_LINES")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_nhdar6mi_diss",out_layer="pf_swpt_nhdar6mi_diss")
-        arcpy.AddMessage("  Filling holes in NHD area polygons that intersect upstream/downstream flowlines...")
-        arcpy.EliminatePolygonPart_management(in_features="pf_swpt_nhdar6mi_diss", out_feature_class="pf_swpt_nhdar6mi_elim",condition="AREA_AND_PERCENT", part_area="1000000 SquareMeters", part_area_percent="99.0", part_option="CONTAINED_ONLY")
+        if run("dissolve_areas", [pf("pf_swpt_nhdar6mi_diss"), pf("pf_swpt_nhdar6mi_elim")]):
+            report.begin("dissolve_areas", [input_nhd_area_polys])
+            gp.clear_selection(input_nhd_area_polys)
+            gp.select_by_location(input_nhd_area_polys, [("NEW_SELECTION", "INTERSECT", pf("pf_swpt_all_fl_filt"), False)], pf("pf_swpt_nhdar6mi_sel"))
+            gp.add_message("  Dissolving all NHD area polygons that intersect upstream/downstream flowlines...")
+            gp.dissolve(pf("pf_swpt_nhdar6mi_sel"), pf("pf_swpt_nhdar6mi_diss"), multi_part=False)
+            gp.add_message("  Filling holes in NHD area polygons that intersect upstream/downstream flowlines...")
+            gp.eliminate_polygon_part(pf("pf_swpt_nhdar6mi_diss"), pf("pf_swpt_nhdar6mi_elim"), 1000000, 99.0)
+            report.end([pf("pf_swpt_nhdar6mi_diss"), pf("pf_swpt_nhdar6mi_elim")])
 
         # Construct perpendicular cutlines for flowlines that are 1.) within open water polygons and 2.) that end at an upstream or downstream endpoint
-        arcpy.SelectLayerByAttribute_management(input_flow_lines, "CLEAR_SELECTION")
-        arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_all_fl_filt", overlap_type="WITHIN", select_features="pf_swpt_nhdar6mi_diss", search_distance="", selection_type="NEW_SELECTION", invert_spatial_relationship="NOT_INVERT")
-        arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_all_fl_filt", overlap_type="BOUNDARY_TOUCHES", select_features=input_upstr_pts, search_distance="", selection_type="SUBSET_SELECTION", invert_spatial_relationship="NOT_INVERT")
-        make_perpendicular("pf_swpt_all_fl_filt", 2000, "pf_swpt_cutline_upstrm", True)
-
-        arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_all_fl_filt", overlap_type="WITHIN", select_features="pf_swpt_nhdar6mi_diss", search_distance="", selection_type="NEW_SELECTION", invert_spatial_relationship="NOT_INVERT")
-        arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_all_fl_filt", overlap_type="BOUNDARY_TOUCHES", select_features=input_dnstr_pts, search_distance="", selection_type="SUBSET_SELECTION", invert_spatial_relationship="NOT_INVERT")
-        arcpy.AddMessage("  Making downstream perpendicular cutlines...")
-        make_perpendicular("pf_swpt_all_fl_filt", 2000, "pf_swpt_cutline_dwnstrm", False)
-        arcpy.SelectLayerByAttribute_management("pf_swpt_all_fl_filt", "CLEAR_SELECTION")
+        if run("make_cutlines", [pf("pf_swpt_cutline_upstrm"), pf("pf_swpt_cutline_dwnstrm")]):
+            report.begin("make_cutlines", [pf("pf_swpt_all_fl_filt")])
+            gp.select_by_location(pf("pf_swpt_all_fl_filt"), [("NEW_SELECTION", "WITHIN", pf("pf_swpt_nhdar6mi_diss"), False),
+                                                               ("SUBSET_SELECTION", "BOUNDARY_TOUCHES", input_upstr_pts, False)], pf("pf_swpt_fl_upstrm"))
+            make_perpendicular(pf("pf_swpt_fl_upstrm"), cutline_distance, pf("pf_swpt_cutline_upstrm"), True, report)
+
+            gp.select_by_location(pf("pf_swpt_all_fl_filt"), [("NEW_SELECTION", "WITHIN", pf("pf_swpt_nhdar6mi_diss"), False),
+                                                               ("SUBSET_SELECTION", "BOUNDARY_TOUCHES", input_dnstr_pts, False)], pf("pf_swpt_fl_dwnstrm"))
+            gp.add_message("  Making downstream perpendicular cutlines...")
+            make_perpendicular(pf("pf_swpt_fl_dwnstrm"), cutline_distance, pf("pf_swpt_cutline_dwnstrm"), False, report)
+            report.end([pf("pf_swpt_cutline_upstrm"), pf("pf_swpt_cutline_dwnstrm")])
 
         # Get only parts of cutlines we want
-        arcpy.AddMessage("  Extracting correct portion of cutlines...")
-        arcpy.Merge_management(inputs="pf_swpt_cutline_dwnstrm;pf_swpt_cutline_upstrm", output="pf_swpt_cutlines_all")
-        arcpy.Clip_analysis(in_features="pf_swpt_cutlines_all", clip_features="pf_swpt_nhdar6mi_elim", out_feature_class="pf_swpt_cutlines_clip")
-        arcpy.MultipartToSinglepart_management(in_features="pf_swpt_cutlines_clip", out_feature_class="pf_swpt_cutlines_clip_mult")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_cutlines_clip_mult",out_layer="pf_swpt_cutlines_clip_mult")
-        arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_cutlines_clip_mult", overlap_type="INTERSECT", select_features="pf_swpt_splitpnt_ends", search_distance="", selection_type="NEW_SELECTION", invert_spatial_relationship="NOT_INVERT")
-        arcpy.CopyFeatures_management("pf_swpt_cutlines_clip_mult", "pf_swpt_cutlines_clip_mult_ends")
-        arcpy.AddMessage("  Deleting unneeded portions of intersecting cutlines...")
-        remove_self_intersects("pf_swpt_cutlines_clip_mult_ends", "pf_swpt_splitpnt_ends", "DWUNIQUE", "pf_swpt_cutlines_filt")
+        if run("extract_cutlines", [pf("pf_swpt_cutlines_filt")]):
+            report.begin("extract_cutlines", [pf("pf_swpt_cutline_upstrm"), pf("pf_swpt_cutline_dwnstrm")])
+            gp.add_message("  Extracting correct portion of cutlines...")
+            gp.merge([pf("pf_swpt_cutline_dwnstrm"), pf("pf_swpt_cutline_upstrm")], pf("pf_swpt_cutlines_all"))
+            gp.clip(pf("pf_swpt_cutlines_all"), pf("pf_swpt_nhdar6mi_elim"), pf("pf_swpt_cutlines_clip"))
+            gp.multipart_to_singlepart(pf("pf_swpt_cutlines_clip"), pf("pf_swpt_cutlines_clip_mult"))
+            gp.select_by_location(pf("pf_swpt_cutlines_clip_mult"), [("NEW_SELECTION", "INTERSECT", pf("pf_swpt_splitpnt_ends"), False)], pf("pf_swpt_cutlines_clip_mult_ends"))
+            gp.add_message("  Deleting unneeded portions of intersecting cutlines...")
+            remove_self_intersects(pf("pf_swpt_cutlines_clip_mult_ends"), pf("pf_swpt_splitpnt_ends"), "DWUNIQUE", pf("pf_swpt_cutlines_filt"), report)
+            report.end([pf("pf_swpt_cutlines_filt")])
 
        # Crack island-removed NHD open water polygons with cutlines and trim
-        arcpy.AddMessage("  Cracking and trimming NHD area polygons with perpendicular cutlines...")
-        arcpy.FeatureToPolygon_management(in_features="pf_swpt_nhdar6mi_elim;pf_swpt_cutlines_filt", out_feature_class="pf_swpt_nhdar_allcut", cluster_tolerance="", attributes="ATTRIBUTES", label_features="")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_nhdar_allcut",out_layer="pf_swpt_nhdar_allcut")
-        arcpy.SelectLayerByAttribute_management("pf_swpt_all_fl_filt", "CLEAR_SELECTION")
-        arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_nhdar_allcut", overlap_type="CROSSED_BY_THE_OUTLINE_OF", select_features="pf_swpt_all_fl_filt", search_distance="", selection_type="NEW_SELECTION", invert_spatial_relationship="NOT_INVERT")
-        arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_nhdar_allcut", overlap_type="CONTAINS", select_features="pf_swpt_all_fl_filt", search_distance="", selection_type="ADD_TO_SELECTION", invert_spatial_relationship="NOT_INVERT")
-        arcpy.CopyFeatures_management("pf_swpt_nhdar_allcut", "pf_swpt_nhdar_cut")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_nhdar_cut",out_layer="pf_swpt_nhdar_cut")
+        if run("crack_areas", [pf("pf_swpt_nhdar_cut")]):
+            report.begin("crack_areas", [pf("pf_swpt_nhdar6mi_elim"), pf("pf_swpt_cutlines_filt")])
+            gp.add_message("  Cracking and trimming NHD area polygons with perpendicular cutlines...")
+            gp.feature_to_polygon([pf("pf_swpt_nhdar6mi_elim"), pf("pf_swpt_cutlines_filt")], pf("pf_swpt_nhdar_allcut"))
+            gp.select_by_location(pf("pf_swpt_nhdar_allcut"), [("NEW_SELECTION", "CROSSED_BY_THE_OUTLINE_OF", pf("pf_swpt_all_fl_filt"), False),
+                                                                ("ADD_TO_SELECTION", "CONTAINS", pf("pf_swpt_all_fl_filt"), False)], pf("pf_swpt_nhdar_cut"))
+            report.end([pf("pf_swpt_nhdar_cut")])
 
         # Clip flowlines by NHD open water polygons
-        arcpy.AddMessage("  Clipping upstream/downstream flowlines by NHD area polygons...")
-        arcpy.Clip_analysis(in_features="pf_swpt_all_fl_filt", clip_features="pf_swpt_nhdar_cut", out_feature_class="pf_swpt_all_fl_filt_nhdarclip")
-        arcpy.AddMessage("  Clipping all flowlines by NHD area polygons...")
-        arcpy.Clip_analysis(in_features="pf_swpt_nhdfl6mi_filt", clip_features="pf_swpt_nhdar_cut", out_feature_class="pf_swpt_nhdfl6mi_nhdarclip")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_all_fl_filt_nhdarclip",out_layer="pf_swpt_all_fl_filt_nhdarclip")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_nhdfl6mi_nhdarclip",out_layer="pf_swpt_nhdfl6mi_nhdarclip")
-
-        # Convert vertices from ALL flowlines inside such open water polygons, merge, and discard duplicated vertices from non-upstream-downstream flowlines, if present
-        arcpy.AddMessage("  Densifying flowlines...")
-        arcpy.Densify_edit(in_features="pf_swpt_all_fl_filt_nhdarclip", densification_method="DISTANCE", distance="10 Meters", max_deviation="0.1 Meters", max_angle="10")
-        arcpy.Densify_edit(in_features="pf_swpt_nhdfl6mi_nhdarclip", densification_method="DISTANCE", distance="10 Meters", max_deviation="0.1 Meters", max_angle="10")
-        arcpy.AddMessage("  Converting vertices to points...")
-        arcpy.FeatureVerticesToPoints_management(in_features="pf_swpt_all_fl_filt_nhdarclip", out_feature_class="pf_swpt_all_fl_nhdarclip_vert", point_location="ALL")
-        arcpy.FeatureVerticesToPoints_management(in_features="pf_swpt_nhdfl6mi_nhdarclip", out_feature_class="pf_swpt_nhdfl6mi_nhdarclip_vert", point_location="ALL")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_all_fl_nhdarclip_vert",out_layer="pf_swpt_all_fl_nhdarclip_vert")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_nhdfl6mi_nhdarclip_vert",out_layer="pf_swpt_nhdfl6mi_nhdarclip_vert")
-        arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_nhdfl6mi_nhdarclip_vert", overlap_type="INTERSECT", select_features="pf_swpt_all_fl_nhdarclip_vert", search_distance="", selection_type="NEW_SELECTION", invert_spatial_relationship="INVERT")
-        arcpy.Merge_management(inputs="pf_swpt_all_fl_nhdarclip_vert;pf_swpt_nhdfl6mi_nhdarclip_vert", output="pf_swpt_vert_all")
-
-        # Generate Thiessen polygons
-        arcpy.AddMessage("  Generating Thiessen polygons...")
-        arcpy.env.extent = arcpy.Describe("pf_swpt_nhdar_cut").extent
-        arcpy.CreateThiessenPolygons_analysis(in_features="pf_swpt_vert_all", out_feature_class="pf_swpt_vert_all_th", fields_to_copy="ONLY_FID")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_vert_all_th",out_layer="pf_swpt_vert_all_th")
-        arcpy.env.extent = "MAXOF"
+        if run("clip_flowlines", [pf("pf_swpt_all_fl_filt_nhdarclip"), pf("pf_swpt_nhdfl6mi_nhdarclip")]):
+            report.begin("clip_flowlines", [pf("pf_swpt_all_fl_filt"), pf("pf_swpt_nhdfl6mi_filt")])
+            gp.add_message("  Clipping upstream/downstream flowlines by NHD area polygons...")
+            gp.clip(pf("pf_swpt_all_fl_filt"), pf("pf_swpt_nhdar_cut"), pf("pf_swpt_all_fl_filt_nhdarclip"))
+            gp.add_message("  Clipping all flowlines by NHD area polygons...")
+            gp.clip(pf("pf_swpt_nhdfl6mi_filt"), pf("pf_swpt_nhdar_cut"), pf("pf_swpt_nhdfl6mi_nhdarclip"))
+            report.end([pf("pf_swpt_all_fl_filt_nhdarclip"), pf("pf_swpt_nhdfl6mi_nhdarclip")])
+
+        # Densify ALL flowlines inside such open water polygons, discard duplicated vertices from non-upstream-downstream flowlines, if present, and generate Thiessen polygons
+        if run("thiessen", [pf("pf_swpt_vert_all_th")]):
+            report.begin("thiessen", [pf("pf_swpt_all_fl_filt_nhdarclip"), pf("pf_swpt_nhdfl6mi_nhdarclip")])
+            gp.add_message("  Densifying flowlines and generating Thiessen polygons...")
+            make_thiessen([pf("pf_swpt_all_fl_filt_nhdarclip"), pf("pf_swpt_nhdfl6mi_nhdarclip")], pf("pf_swpt_nhdar_cut"), densify_spacing, pf("pf_swpt_vert_all_th"))
+            report.end([pf("pf_swpt_vert_all_th")])
 
         # Crack open water polygons with thiessen polygon boundaries
-        arcpy.AddMessage("  Cracking NHD area polygons with Thiessen polygons...")
-        arcpy.Identity_analysis(in_features="pf_swpt_nhdar_cut", identity_features="pf_swpt_vert_all_th", out_feature_class="pf_swpt_nhdar_cut_th", join_attributes="ONLY_FID", cluster_tolerance="", relationship="NO_RELATIONSHIPS")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_nhdar_cut_th",out_layer="pf_swpt_nhdar_cut_th")
+        if run("identity", [pf("pf_swpt_nhdar_cut_th")]):
+            report.begin("identity", [pf("pf_swpt_nhdar_cut"), pf("pf_swpt_vert_all_th")])
+            gp.add_message("  Cracking NHD area polygons with Thiessen polygons...")
+            gp.identity(pf("pf_swpt_nhdar_cut"), pf("pf_swpt_vert_all_th"), pf("pf_swpt_nhdar_cut_th"))
+            report.end([pf("pf_swpt_nhdar_cut_th")])
 
         # Check for and merge orphaned polygons that no longer intersect a flowline
-        arcpy.AddMessage("  Merging orphaned polygons...")
-        arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_nhdar_cut_th", overlap_type="INTERSECT", select_features="pf_swpt_nhdfl6mi_filt", search_distance="", selection_type="NEW_SELECTION", invert_spatial_relationship="INVERT")
-        arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_nhdar_cut_th", overlap_type="SHARE_A_LINE_SEGMENT_WITH", select_features="pf_swpt_nhdar_cut_th", search_distance="", selection_type="NEW_SELECTION", invert_spatial_relationship="NOT_INVERT")
-        if str(thiessen).lower() == 'true': # THIS OPTION PRESERVES THIESSEN POLYS WHEN IN CONFLICT
-            arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_nhdar_cut_th", overlap_type="INTERSECT", select_features="pf_swpt_splitpnt_ends", search_distance="", selection_type="REMOVE_FROM_SELECTION", invert_spatial_relationship="NOT_INVERT")
-            arcpy.Dissolve_management(in_features="pf_swpt_nhdar_cut_th", out_feature_class="pf_swpt_nhdar_cut_th_orphans", dissolve_field="FID_pf_swpt_vert_all_th", statistics_fields="", multi_part="MULTI_PART", unsplit_lines="DISSOLVE_LINES")
-        else: # THIS OPTION PRESERVES CUTLINE POLYS WHEN IN CONFLICT
-            arcpy.Dissolve_management(in_features="pf_swpt_nhdar_cut_th", out_feature_class="pf_swpt_nhdar_cut_th_orphans", dissolve_field="FID_pf_swpt_nhdar_cut", statistics_fields="", multi_part="MULTI_PART", unsplit_lines="DISSOLVE_LINES")
-
-        arcpy.SelectLayerByAttribute_management(in_layer_or_view="pf_swpt_nhdar_cut_th", selection_type="SWITCH_SELECTION", where_clause="")
-        arcpy.Merge_management(inputs="pf_swpt_nhdar_cut_th;pf_swpt_nhdar_cut_th_orphans", output="pf_swpt_nhdar_cut_th_merged", field_mappings="")
-
-        # Spatial join (one-to-many) flowlines to merged open water polygons
-        arcpy.AddMessage("  Joining cracked NHD area polygons to upstream/downstream flowlines...")
-        arcpy.SelectLayerByAttribute_management("pf_swpt_all_fl_filt", "CLEAR_SELECTION")
-        arcpy.SpatialJoin_analysis(target_features="pf_swpt_nhdar_cut_th_merged", join_features="pf_swpt_all_fl_filt", out_feature_class="pf_swpt_nhdar_cut_th_merged_join", join_operation="JOIN_ONE_TO_MANY", join_type="KEEP_COMMON", match_option="CROSSED_BY_THE_OUTLINE_OF", search_radius="", distance_field_name="")
+        if run("merge_orphans", [pf("pf_swpt_nhdar_cut_th_merged")]):
+            report.begin("merge_orphans", [pf("pf_swpt_nhdar_cut_th")])
+            gp.add_message("  Merging orphaned polygons...")
+            if str(thiessen).lower() == 'true': # THIS OPTION PRESERVES THIESSEN POLYS WHEN IN CONFLICT
+                dissolve_field = "FID_"+os.path.basename(pf("pf_swpt_vert_all_th"))
+            else: # THIS OPTION PRESERVES CUTLINE POLYS WHEN IN CONFLICT
+                dissolve_field = "FID_"+os.path.basename(pf("pf_swpt_nhdar_cut"))
+            gp.merge_orphans(pf("pf_swpt_nhdar_cut_th"), pf("pf_swpt_nhdfl6mi_filt"), pf("pf_swpt_splitpnt_ends"), dissolve_field, thiessen, pf("pf_swpt_nhdar_cut_th_merged"))
+            report.end([pf("pf_swpt_nhdar_cut_th_merged")])
+
+        if str(label_cells).lower() == 'true':
+            # Label merged open water polygons by the flowline their Thiessen polygon was seeded from and dissolve on DWUNIQUE
+            if run("label_cells", [pf("pf_swpt_nhdar_cut_th_merged_join_diss")]):
+                report.begin("label_cells", [pf("pf_swpt_nhdar_cut_th_merged"), pf("pf_swpt_vert_all_th")])
+                gp.add_message("  Labelling cracked NHD area polygons by Thiessen polygon and dissolving by DWUNIQUE...")
+                gp.label_cells(pf("pf_swpt_nhdar_cut_th_merged"), "FID_"+os.path.basename(pf("pf_swpt_vert_all_th")), pf("pf_swpt_vert_all_th"), pf("pf_swpt_all_fl_filt"), pf("pf_swpt_nhdar_cut_th_merged_join_diss"))
+                report.end([pf("pf_swpt_nhdar_cut_th_merged_join_diss")])
+        else:
+            # Spatial join (one-to-many) flowlines to merged open water polygons
+            if run("spatial_join", [pf("pf_swpt_nhdar_cut_th_merged_join"), pf("pf_swpt_nhdar_cut_th_merged_join_diss")]):
+                report.begin("spatial_join", [pf("pf_swpt_nhdar_cut_th_merged"), pf("pf_swpt_all_fl_filt")])
+                gp.add_message("  Joining cracked NHD area polygons to upstream/downstream flowlines...")
+                gp.spatial_join(pf("pf_swpt_nhdar_cut_th_merged"), pf("pf_swpt_all_fl_filt"), pf("pf_swpt_nhdar_cut_th_merged_join"), "CROSSED_BY_THE_OUTLINE_OF")
+                gp.dissolve(pf("pf_swpt_nhdar_cut_th_merged_join"), pf("pf_swpt_nhdar_cut_th_merged_join_diss"), "DWUNIQUE", multi_part=False)
+                report.end([pf("pf_swpt_nhdar_cut_th_merged_join"), pf("pf_swpt_nhdar_cut_th_merged_join_diss")])
 
         # Dissolve on DWUNIQUE and clip using dissolved NHD open water polygons
-        arcpy.AddMessage("  Dissolving cracked NHD area polygons by DWUNIQUE and clipping to make final output...")
-        arcpy.Dissolve_management(in_features="pf_swpt_nhdar_cut_th_merged_join", out_feature_class="pf_swpt_nhdar_cut_th_merged_join_diss", dissolve_field="DWUNIQUE", statistics_fields="", multi_part="SINGLE_PART", unsplit_lines="DISSOLVE_LINES")
-        arcpy.MakeFeatureLayer_management(in_features="pf_swpt_nhdar_cut_th_merged_join_diss",out_layer="pf_swpt_nhdar_cut_th_merged_join_diss")
-        arcpy.SelectLayerByLocation_management(in_layer="pf_swpt_nhdar_cut_th_merged_join_diss", overlap_type="INTERSECT", select_features="pf_swpt_all_fl_filt", search_distance="", selection_type="NEW_SELECTION", invert_spatial_relationship="NOT_INVERT")
-        arcpy.Dissolve_management(in_features="pf_swpt_nhdar_cut_th_merged_join_diss", out_feature_class="pf_swpt_nhdar_all_fl", dissolve_field="DWUNIQUE", statistics_fields="", multi_part="MULTI_PART", unsplit_lines="DISSOLVE_LINES")
-        arcpy.Clip_analysis(in_features="pf_swpt_nhdar_all_fl", clip_features="pf_swpt_nhdar6mi_diss", out_feature_class="pf_swpt_nhdar_all_fl_clip", cluster_tolerance="")
-
-        pass
-
-    except arcpy.ExecuteError:
-        # Get the geoprocessing error messages
-        msgs = arcpy.GetMessage(0)
-        msgs += arcpy.GetMessages(2)
-
-        # Return gp error messages for use with a script tool
-        arcpy.AddError(msgs)
-        # Print gp error messages for use in Python/PythonWin
-        print msgs
-
-    except:
-        # Get the traceback object
-        tb = sys.exc_info()[2]
-        tbinfo = traceback.format_tb(tb)[0]
-        # Concatenate information together concerning the error into a
-        # message string
-        pymsg = tbinfo + "\n" + str(sys.exc_type)+ ": " + str(sys.exc_value)
-
-        # Return python error messages for use with a script tool
-        arcpy.AddError(pymsg)
-
-        # Print Python error messages for use in Python/PythonWin
-        print pymsg
+        if run("final_dissolve", [store.output(output_features)]):
+            report.begin("final_dissolve", [pf("pf_swpt_nhdar_cut_th_merged_join_diss")])
+            gp.add_message("  Dissolving cracked NHD area polygons by DWUNIQUE and clipping to make final output...")
+            gp.select_by_location(pf("pf_swpt_nhdar_cut_th_merged_join_diss"), [("NEW_SELECTION", "INTERSECT", pf("pf_swpt_all_fl_filt"), False)], pf("pf_swpt_nhdar_cut_th_merged_join_sel"))
+            gp.dissolve(pf("pf_swpt_nhdar_cut_th_merged_join_sel"), pf("pf_swpt_nhdar_all_fl"), "DWUNIQUE")
+            gp.clip(pf("pf_swpt_nhdar_all_fl"), pf("pf_swpt_nhdar6mi_diss"), store.output(output_features))
+            report.end([store.output(output_features)])
+
+        for record in report.records:
+            if "/" not in record['stage']:
+                gp.add_message("  {0}: {1:.1f} s wall, {2:.1f} s CPU, {3} features{4} out, {5} intermediate bytes written, peak memory up {6}".format(
+                    record['stage'], record['wall_s'], record['cpu_s'], record['output_features'],
+                    "" if record['output_vertices'] is None else " ({0} vertices)".format(record['output_vertices']),
+                    "unknown" if record['bytes_written'] is None else record['bytes_written'],
+                    "unknown" if record['peak_rss_growth_bytes'] is None else "{0:.1f} MB".format(record['peak_rss_growth_bytes'] / 1048576.0)))
+
+    except Exception as e:
+        if gp is not None and isinstance(e, gp.ExecuteError):
+            # Get the geoprocessing error messages
+            msgs = gp.get_messages(e)
+
+            # Return gp error messages for use with a script tool
+            gp.add_error(msgs)
+            # Print gp error messages for use in Python/PythonWin
+            print(msgs)
+            if raise_errors:
+                raise
+        else:
+            # Get the traceback object
+            tb = sys.exc_info()[2]
+            tbinfo = traceback.format_tb(tb)[0]
+            # Concatenate information together concerning the error into a
+            # message string
+            pymsg = tbinfo + "\n" + str(sys.exc_info()[0])+ ": " + str(sys.exc_info()[1])
+
+            # Return python error messages for use with a script tool
+            if gp is not None:
+                gp.add_error(pymsg)
+
+            # Print Python error messages for use in Python/PythonWin
+            print(pymsg)
+            if raise_errors:
+                raise
+
+    finally:
+        if report is not None:
+            report.abort()
+        # Remove intermediates unless they were asked to be kept, or the caller owns the store
+        if store is not None and store is not intermediates:
+            store.close()
 
 if __name__ == '__main__':
+    import arcpy
     argv = tuple(arcpy.GetParameterAsText(i) for i in range(arcpy.GetArgumentCount()))
     flow_area(*argv)
@@ -0,0 +1,303 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_backend.py
+# Purpose:     Geoprocessing backends for flow_area.py.  A backend performs the
+#              handful of operations the flow_area chain uses, on named
+#              datasets, either through arcpy (ArcpyBackend, loaded only when
+#              picked) or through shapely/GEOS and NumPy on GeoPackage tables
+#              (flow_shapely.ShapelyBackend), which needs no ArcGIS licence.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+#-------------------------------------------------------------------------------
+#
+# Every operation reads its input datasets and writes a new output dataset, replacing any existing one.
+#
+# Selections are expressed as a list of steps, each a tuple of
+#   (selection_type, overlap_type, select_features, invert)
+# with the selection and overlap types of arcpy.SelectLayerByLocation_management().  A step whose select_features is
+# the input dataset itself uses the input's current selection, as selecting a layer against itself does in arcpy.
+# A step ("SWITCH_SELECTION", None, None, False) switches the selection.
+#
+# Densifying and Thiessen polygons are not backend operations: flow_area.make_thiessen() does both in NumPy/SciPy
+# (flow_thiessen.py) and reads and writes through flow_io.py, which handles arcpy and GeoPackage datasets alike.
+
+import os, sys
+import flow_io, flow_report, flow_orphans
+
+BACKENDS = ('arcpy', 'shapely')
+
+class ExecuteError(Exception):
+    # Raised by backends other than arcpy when a geoprocessing operation fails
+    pass
+
+class Backend(object):
+    # Base class listing the operations.  name is the backend's entry in BACKENDS, and workspace_extension the extension
+    # of the workspaces it creates.
+
+    name = None
+    workspace_extension = None
+    ExecuteError = ExecuteError
+
+    def use_workspace(self, workspace):
+        # Make bare dataset names refer to datasets in workspace
+        pass
+
+    def create_workspace(self, directory, name):
+        # Create a new workspace called name plus workspace_extension in directory and return its path
+        raise NotImplementedError
+
+    def add_message(self, message):
+        flow_io.add_message(message)
+
+    def add_warning(self, message):
+        sys.stderr.write(message + "\n")
+
+    def add_error(self, message):
+        sys.stderr.write(message + "\n")
+
+    def get_messages(self, error):
+        # Error messages for an ExecuteError raised by this backend
+        return str(error)
+
+    def count(self, dataset, vertices=False):
+        # (features, vertices) of a dataset.  Vertices are only counted when asked for, since that reads every geometry, and are None otherwise
+        raise NotImplementedError
+
+    def exists(self, dataset):
+        raise NotImplementedError
+
+    def clear_selection(self, dataset):
+        # Clear any selection on a layer, so that operations on it use every feature.  Datasets without selections are left alone.
+        pass
+
+    def copy(self, in_features, out_feature_class):
+        raise NotImplementedError
+
+    def select(self, in_features, where_clause, out_feature_class):
+        # Copy the features matching an SQL where clause
+        raise NotImplementedError
+
+    def select_by_location(self, in_features, steps, out_feature_class, out_unselected=None):
+        # Copy the features selected by steps (see above) to out_feature_class, and optionally the rest to out_unselected
+        raise NotImplementedError
+
+    def merge(self, inputs, output):
+        raise NotImplementedError
+
+    def dissolve(self, in_features, out_feature_class, dissolve_field=None, multi_part=True):
+        # Union features sharing a value of dissolve_field (all features if None).  multi_part False splits the result into single parts.
+        raise NotImplementedError
+
+    def eliminate_polygon_part(self, in_features, out_feature_class, part_area, part_area_percent):
+        # Fill holes smaller than both part_area (square meters) and part_area_percent of their polygon's outer area
+        raise NotImplementedError
+
+    def clip(self, in_features, clip_features, out_feature_class):
+        raise NotImplementedError
+
+    def multipart_to_singlepart(self, in_features, out_feature_class):
+        raise NotImplementedError
+
+    def feature_to_polygon(self, in_features, out_feature_class):
+        # Polygons enclosed by the outlines of a list of polygon and line datasets, with the attributes of the polygon they fall in
+        raise NotImplementedError
+
+    def identity(self, in_features, identity_features, out_feature_class):
+        # Split in_features by identity_features, keeping only FID_<dataset name> fields of both
+        raise NotImplementedError
+
+    def spatial_join(self, target_features, join_features, out_feature_class, match_option):
+        # One row per matching (target, join) pair, keeping only pairs that match
+        raise NotImplementedError
+
+    def merge_orphans(self, in_features, flowlines, split_points, dissolve_field, thiessen, out_feature_class):
+        # Merge polygons no longer intersecting flowlines with the polygons sharing an edge with them, dissolved on
+        # dissolve_field; polygons intersecting split_points are left alone when thiessen is true (see flow_orphans.py)
+        raise NotImplementedError
+
+    def label_cells(self, in_features, cell_field, cells, flowlines, out_feature_class):
+        # Dissolve in_features into single parts by the DWUNIQUE of the Thiessen cell whose FID is in cell_field.  Features
+        # whose cell has no DWUNIQUE of flowlines are instead labelled by every flowline crossing their outline, as a
+        # one-to-many SpatialJoin with CROSSED_BY_THE_OUTLINE_OF would.
+        raise NotImplementedError
+
+class ArcpyBackend(Backend):
+    # Thin wrappers around the arcpy tools flow_area has always called
+
+    name = 'arcpy'
+    workspace_extension = '.gdb'
+
+    def __init__(self):
+        import arcpy
+        self.arcpy = arcpy
+        self.ExecuteError = arcpy.ExecuteError
+        arcpy.env.qualifiedFieldNames = False
+        arcpy.env.overwriteOutput = True
+
+    def use_workspace(self, workspace):
+        self.arcpy.env.workspace = workspace
+
+    def create_workspace(self, directory, name):
+        return self.arcpy.CreateFileGDB_management(directory, name + self.workspace_extension).getOutput(0)
+
+    def add_message(self, message):
+        self.arcpy.AddMessage(message)
+
+    def add_warning(self, message):
+        self.arcpy.AddWarning(message)
+
+    def add_error(self, message):
+        self.arcpy.AddError(message)
+
+    def get_messages(self, error):
+        return self.arcpy.GetMessage(0) + self.arcpy.GetMessages(2)
+
+    def count(self, dataset, vertices=False):
+        return flow_report.arcpy_counter(vertices)(dataset)
+
+    def exists(self, dataset):
+        return bool(self.arcpy.Exists(dataset))
+
+    def clear_selection(self, dataset):
+        # The tools, and MakeFeatureLayer on a layer, only use a layer's selected features
+        if self.arcpy.Describe(dataset).dataType in ("FeatureLayer", "Layer"):
+            self.arcpy.SelectLayerByAttribute_management(dataset, "CLEAR_SELECTION")
+
+    def copy(self, in_features, out_feature_class):
+        self.arcpy.CopyFeatures_management(in_features, out_feature_class)
+
+    def select(self, in_features, where_clause, out_feature_class):
+        layer = os.path.basename(str(out_feature_class)) + "_lyr"
+        self.arcpy.MakeFeatureLayer_management(in_features=in_features, out_layer=layer, where_clause=where_clause)
+        self.arcpy.CopyFeatures_management(layer, out_feature_class)
+        self.arcpy.Delete_management(layer)
+
+    def select_by_location(self, in_features, steps, out_feature_class, out_unselected=None):
+        arcpy = self.arcpy
+        layer = os.path.basename(str(out_feature_class)) + "_lyr"
+        arcpy.MakeFeatureLayer_management(in_features=in_features, out_layer=layer)
+        for selection_type, overlap_type, select_features, invert in steps:
+            if selection_type == "SWITCH_SELECTION":
+                arcpy.SelectLayerByAttribute_management(in_layer_or_view=layer, selection_type="SWITCH_SELECTION", where_clause="")
+                continue
+            arcpy.SelectLayerByLocation_management(in_layer=layer, overlap_type=overlap_type, select_features=layer if select_features == in_features else select_features, search_distance="", selection_type=selection_type, invert_spatial_relationship="INVERT" if invert else "NOT_INVERT")
+        arcpy.CopyFeatures_management(layer, out_feature_class)
+        if out_unselected:
+            arcpy.SelectLayerByAttribute_management(in_layer_or_view=layer, selection_type="SWITCH_SELECTION", where_clause="")
+            arcpy.CopyFeatures_management(layer, out_unselected)
+        arcpy.Delete_management(layer)
+
+    def merge(self, inputs, output):
+        self.arcpy.Merge_management(inputs=";".join(str(dataset) for dataset in inputs), output=output, field_mappings="")
+
+    def dissolve(self, in_features, out_feature_class, dissolve_field=None, multi_part=True):
+        self.arcpy.Dissolve_management(in_features=in_features, out_feature_class=out_feature_class, dissolve_field=dissolve_field or "", statistics_fields="", multi_part="MULTI_PART" if multi_part else "SINGLE_PART", unsplit_lines="DISSOLVE_LINES")
+
+    def eliminate_polygon_part(self, in_features, out_feature_class, part_area, part_area_percent):
+        self.arcpy.EliminatePolygonPart_management(in_features=in_features, out_feature_class=out_feature_class, condition="AREA_AND_PERCENT", part_area="{0} SquareMeters".format(part_area), part_area_percent=str(part_area_percent), part_option="CONTAINED_ONLY")
+
+    def clip(self, in_features, clip_features, out_feature_class):
+        self.arcpy.Clip_analysis(in_features=in_features, clip_features=clip_features, out_feature_class=out_feature_class, cluster_tolerance="")
+
+    def multipart_to_singlepart(self, in_features, out_feature_class):
+        self.arcpy.MultipartToSinglepart_management(in_features=in_features, out_feature_class=out_feature_class)
+
+    def feature_to_polygon(self, in_features, out_feature_class):
+        self.arcpy.FeatureToPolygon_management(in_features=";".join(str(dataset) for dataset in in_features), out_feature_class=out_feature_class, cluster_tolerance="", attributes="ATTRIBUTES", label_features="")
+
+    def identity(self, in_features, identity_features, out_feature_class):
+        self.arcpy.Identity_analysis(in_features=in_features, identity_features=identity_features, out_feature_class=out_feature_class, join_attributes="ONLY_FID", cluster_tolerance="", relationship="NO_RELATIONSHIPS")
+
+    def spatial_join(self, target_features, join_features, out_feature_class, match_option):
+        self.arcpy.SpatialJoin_analysis(target_features=target_features, join_features=join_features, out_feature_class=out_feature_class, join_operation="JOIN_ONE_TO_MANY", join_type="KEEP_COMMON", match_option=match_option, search_radius="", distance_field_name="")
+
+    def merge_orphans(self, in_features, flowlines, split_points, dissolve_field, thiessen, out_feature_class):
+        # The edge graph is built in NumPy from the polygons read through flow_io; arcpy only marks the polygons
+        # intersecting flowlines and split points, and dissolves the selected groups
+        arcpy = self.arcpy
+        layer = os.path.basename(str(out_feature_class)) + "_lyr"
+        arcpy.MakeFeatureLayer_management(in_features=in_features, out_layer=layer)
+        oid_field = arcpy.Describe(layer).OIDFieldName
+        polygons = flow_io.concatenate(list(flow_io.read_chunks(layer, ['OID@', dissolve_field])))
+        oids = polygons.attributes.get('OID@', [])
+        marks = []
+        for dataset in (flowlines, split_points if str(thiessen).lower() == 'true' else None):
+            marked = set()
+            if dataset:
+                arcpy.SelectLayerByLocation_management(in_layer=layer, overlap_type="INTERSECT", select_features=dataset, search_distance="", selection_type="NEW_SELECTION", invert_spatial_relationship="NOT_INVERT")
+                with arcpy.da.SearchCursor(layer, ['OID@']) as rows:
+                    marked = set(row[0] for row in rows)
+            marks.append([oid in marked for oid in oids])
+        tolerance = flow_io.describe(in_features)[2]
+        selected = flow_orphans.orphan_groups(polygons, polygons.attributes.get(dissolve_field, []), marks[0], marks[1], thiessen, tolerance)[0]
+        if not selected.any():
+            # An empty selection would make the tools below process every feature
+            arcpy.SelectLayerByAttribute_management(in_layer_or_view=layer, selection_type="CLEAR_SELECTION", where_clause="")
+            arcpy.CopyFeatures_management(layer, out_feature_class)
+            arcpy.Delete_management(layer)
+            return
+        if selected.all():
+            arcpy.SelectLayerByAttribute_management(in_layer_or_view=layer, selection_type="CLEAR_SELECTION", where_clause="")
+            self.dissolve(layer, out_feature_class, dissolve_field)
+            arcpy.Delete_management(layer)
+            return
+        where = "{0} IN ({1})".format(arcpy.AddFieldDelimiters(layer, oid_field), ",".join(str(oids[c]) for c in selected.nonzero()[0]))
+        arcpy.SelectLayerByAttribute_management(in_layer_or_view=layer, selection_type="NEW_SELECTION", where_clause=where)
+        orphans, unselected = str(out_feature_class) + "_orphans", str(out_feature_class) + "_unsel"
+        arcpy.Dissolve_management(in_features=layer, out_feature_class=orphans, dissolve_field=dissolve_field, statistics_fields="", multi_part="MULTI_PART", unsplit_lines="DISSOLVE_LINES")
+        arcpy.SelectLayerByAttribute_management(in_layer_or_view=layer, selection_type="SWITCH_SELECTION", where_clause="")
+        arcpy.CopyFeatures_management(layer, unselected)
+        arcpy.Delete_management(layer)
+        self.merge([unselected, orphans], out_feature_class)
+        for dataset in (unselected, orphans):
+            arcpy.Delete_management(dataset)
+
+    def label_cells(self, in_features, cell_field, cells, flowlines, out_feature_class):
+        arcpy = self.arcpy
+        labels = {}
+        with arcpy.da.SearchCursor(cells, ['OID@', 'DWUNIQUE']) as rows:
+            for oid, label in rows:
+                labels[oid] = label
+        with arcpy.da.SearchCursor(flowlines, ['DWUNIQUE']) as rows:
+            known = dict((str(row[0]), row[0]) for row in rows if row[0] is not None)
+        # Labels are compared as text, as make_thiessen() writes them, and written back as the flowlines hold them
+        copy, labelled, unlabelled, joined, merged = [str(out_feature_class) + suffix for suffix in ("_copy", "_lab", "_unlab", "_join", "_all")]
+        arcpy.CopyFeatures_management(in_features, copy)
+        dwunique = [field for field in arcpy.ListFields(flowlines) if field.name.upper() == 'DWUNIQUE'][0]
+        field_type = {'Integer': 'LONG', 'SmallInteger': 'SHORT', 'Double': 'DOUBLE', 'Single': 'FLOAT'}.get(dwunique.type, 'TEXT')
+        arcpy.AddField_management(copy, "DWUNIQUE", field_type, field_length=dwunique.length)
+        missing = 0
+        with arcpy.da.UpdateCursor(copy, [cell_field, 'DWUNIQUE']) as rows:
+            for row in rows:
+                label = known.get(str(labels.get(row[0])))
+                if label is None:
+                    missing += 1
+                rows.updateRow([row[0], label])
+        if not missing:
+            self.dissolve(copy, out_feature_class, "DWUNIQUE", multi_part=False)
+            arcpy.Delete_management(copy)
+            return
+        self.select(copy, "DWUNIQUE IS NULL", unlabelled)
+        arcpy.DeleteField_management(unlabelled, "DWUNIQUE")
+        self.spatial_join(unlabelled, flowlines, joined, "CROSSED_BY_THE_OUTLINE_OF")
+        self.select(copy, "DWUNIQUE IS NOT NULL", labelled)
+        self.merge([labelled, joined], merged)
+        self.dissolve(merged, out_feature_class, "DWUNIQUE", multi_part=False)
+        for dataset in (copy, labelled, unlabelled, joined, merged):
+            arcpy.Delete_management(dataset)
+
+def make_backend(backend=None, dataset=None):
+    # Return a Backend.  backend may be a Backend, one of the names in BACKENDS, or None to pick shapely for GeoPackage
+    # datasets and arcpy for anything else.
+    if isinstance(backend, Backend):
+        return backend
+    if backend is None or backend == "":
+        backend = 'shapely' if dataset is not None and flow_io.split_gpkg(dataset) else 'arcpy'
+    if backend == 'arcpy':
+        return ArcpyBackend()
+    if backend == 'shapely':
+        import flow_shapely
+        return flow_shapely.ShapelyBackend()
+    raise ValueError("Unknown backend '{0}', expected one of {1}".format(backend, ", ".join(BACKENDS)))
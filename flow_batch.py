@@ -0,0 +1,299 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_batch.py
+# Purpose:     Batch driver for flow_area.py.  Runs the basins listed in a CSV
+#              or JSON manifest through a bounded pool of worker processes,
+#              checkpoints every completed stage and basin in a SQLite
+#              database so an interrupted batch resumes where it stopped,
+#              retries failed basins with exponential backoff, and summarizes
+#              throughput and failures at the end.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+# Usage:       python flow_batch.py manifest [checkpoint] [workers] [retries] [summary.json]
+#
+#-------------------------------------------------------------------------------
+#
+# MANIFEST:
+# One basin per CSV row or JSON object (a JSON file holds a list of objects, or an object with a "jobs" list).
+# Required keys are id plus the six flow_area() parameters input_nhd_area_polys, input_flow_lines, input_upstr_pts,
+# input_dnstr_pts, input_all_flow_lines and thiessen.  Optional keys cutline_distance, densify_spacing, intermediates,
+# output_features, backend and label_cells are passed on to flow_area() when present and not empty; output_features
+# defaults to flow_area_<id> so basins sharing a workspace do not overwrite each other.  intermediates defaults to a
+# "namespace" store named after the basin id.
+#
+# CHECKPOINTS:
+# A basin is skipped when the checkpoint database records it as done.  Basins that failed or were interrupted are run
+# again, with attempts numbered on from the previous run.  The stages table records the stages each attempt completed,
+# so an interrupted or failed basin shows how far it got.  With "namespace" or "keep" intermediates the intermediates
+# of a failed attempt stay in the input workspace, and the next attempt resumes at the first stage without a
+# checkpoint.  "temp" and "memory" intermediates do not outlive an attempt, so those basins start again from the first
+# stage.
+
+import os, sys, re, csv, json, time, sqlite3, hashlib, traceback, multiprocessing
+import flow_area, flow_report, flow_io, flow_store
+
+REQUIRED = ('id', 'input_nhd_area_polys', 'input_flow_lines', 'input_upstr_pts', 'input_dnstr_pts', 'input_all_flow_lines', 'thiessen')
+OPTIONAL = ('cutline_distance', 'densify_spacing', 'intermediates', 'output_features', 'backend', 'label_cells')
+
+def read_manifest(path):
+    # Return the list of job dictionaries in a CSV or JSON manifest, in manifest order
+    if path.lower().endswith('.json'):
+        with open(path) as f:
+            jobs = json.load(f)
+        if isinstance(jobs, dict):
+            jobs = jobs['jobs']
+    else:
+        with open(path) as f:
+            jobs = [dict(row) for row in csv.DictReader(f)]
+    seen = set()
+    for number, job in enumerate(jobs):
+        missing = [key for key in REQUIRED if job.get(key) in (None, "")]
+        if missing:
+            raise ValueError("Manifest entry {0} is missing {1}".format(number + 1, ", ".join(missing)))
+        job['id'] = str(job['id'])
+        if job['id'] in seen:
+            raise ValueError("Duplicate manifest id: " + job['id'])
+        seen.add(job['id'])
+        for key in ('cutline_distance', 'densify_spacing'):
+            if job.get(key) not in (None, ""):
+                job[key] = float(job[key])
+        if job.get('output_features') in (None, ""):
+            job['output_features'] = "flow_area_" + re.sub(r'\W', '_', job['id'])
+    return jobs
+
+class CheckpointStore(object):
+    # SQLite database of job and stage checkpoints.  Each process opens its own store on the same file.
+    #
+    # ARGUMENTS:
+    # path:                 Database file, created if needed
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, started REAL, finished REAL, wall_s REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS stages (id TEXT NOT NULL, attempt INTEGER NOT NULL, stage TEXT NOT NULL, wall_s REAL, cpu_s REAL, peak_rss_bytes INTEGER, peak_rss_growth_bytes INTEGER, finished REAL, PRIMARY KEY (id, attempt, stage))")
+        if 'peak_rss_growth_bytes' not in [row[1] for row in self.conn.execute("PRAGMA table_info(stages)")]:
+            # Checkpoint databases from before the column was added
+            self.conn.execute("ALTER TABLE stages ADD COLUMN peak_rss_growth_bytes INTEGER")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def _write(self, sql, params):
+        self.conn.execute(sql, params)
+        self.conn.commit()
+
+    def done(self):
+        return set(row[0] for row in self.conn.execute("SELECT id FROM jobs WHERE status = 'done'"))
+
+    def attempts(self, job_id):
+        row = self.conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else 0
+
+    def start(self, job_id, attempt):
+        self._write("INSERT OR REPLACE INTO jobs (id, status, attempts, error, started) VALUES (?, 'running', ?, NULL, ?)", (job_id, attempt, time.time()))
+
+    def stage(self, job_id, attempt, record):
+        self._write("INSERT OR REPLACE INTO stages (id, attempt, stage, wall_s, cpu_s, peak_rss_bytes, peak_rss_growth_bytes, finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, attempt, record['stage'], record['wall_s'], record['cpu_s'], record['process_peak_rss_bytes'], record['peak_rss_growth_bytes'], time.time()))
+
+    def finish(self, job_id, wall_s):
+        self._write("UPDATE jobs SET status = 'done', error = NULL, finished = ?, wall_s = ? WHERE id = ?", (time.time(), wall_s, job_id))
+
+    def fail(self, job_id, error, final):
+        # final False marks a failure that will be retried
+        self._write("UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?", ('failed' if final else 'retrying', error, time.time(), job_id))
+
+    def jobs(self):
+        # List of (id, status, attempts, error, wall_s) for every job checkpointed so far
+        return self.conn.execute("SELECT id, status, attempts, error, wall_s FROM jobs ORDER BY id").fetchall()
+
+    def completed(self, job_id):
+        # Names of the stages of a job checkpointed by any attempt
+        return set(row[0] for row in self.conn.execute("SELECT DISTINCT stage FROM stages WHERE id = ?", (job_id,)))
+
+    def forget(self, job_id, stage):
+        # Drop the checkpoints of a stage that is being run again, so that they cannot outlive its new intermediates
+        self._write("DELETE FROM stages WHERE id = ? AND stage = ?", (job_id, stage))
+
+    def last_stage(self, job_id):
+        row = self.conn.execute("SELECT stage FROM stages WHERE id = ? ORDER BY attempt DESC, finished DESC LIMIT 1", (job_id,)).fetchone()
+        return row[0] if row else None
+
+class CheckpointReport(flow_report.RunReport):
+    # RunReport that checkpoints each completed top-level stage.  Stages closed by abort() after an error did not complete and are not checkpointed,
+    # and a stage that is begun again loses the checkpoints of earlier attempts.
+
+    def __init__(self, checkpoint, job_id, attempt, counter=None):
+        flow_report.RunReport.__init__(self, counter)
+        self.checkpoint = checkpoint
+        self.job_id = job_id
+        self.attempt = attempt
+        self._aborting = False
+
+    def begin(self, stage, inputs=None):
+        if not self._open:
+            self.checkpoint.forget(self.job_id, stage)
+        flow_report.RunReport.begin(self, stage, inputs)
+
+    def end(self, outputs=None):
+        record = flow_report.RunReport.end(self, outputs)
+        if not self._aborting and "/" not in record['stage']:
+            self.checkpoint.stage(self.job_id, self.attempt, record)
+        return record
+
+    def abort(self):
+        self._aborting = True
+        flow_report.RunReport.abort(self)
+
+def open_store(job):
+    # Open the intermediates store of a basin, or return None for "temp" and "memory" intermediates, which flow_area()
+    # keeps itself.  "namespace" stores are named after the basin id, so that every attempt finds the intermediates of
+    # the one before it.
+    mode = job.get('intermediates') or 'namespace'
+    if mode not in ('namespace', 'keep'):
+        return None
+    workspace = flow_io.describe(job['input_nhd_area_polys'])[0]
+    return flow_store.make_store(workspace, mode, hashlib.md5(job['id'].encode('utf-8')).hexdigest()[:8]).open()
+
+def run_job(job):
+    # Worker function: run flow_area() for one basin, retrying with backoff, and checkpoint the outcome.
+    #
+    # ARGUMENTS:
+    # job:                  Manifest entry, plus the keys checkpoint, retries and backoff added by run_batch()
+    #
+    # Returns a tuple of (id, True if done, attempts made in this run, wall seconds of the last attempt, error or None)
+
+    checkpoint = CheckpointStore(job['checkpoint'])
+    try:
+        attempt = checkpoint.attempts(job['id'])
+        made = 0
+        while True:
+            attempt += 1
+            made += 1
+            checkpoint.start(job['id'], attempt)
+            started = time.time()
+            store = None
+            try:
+                kwargs = dict((key, job[key]) for key in OPTIONAL if job.get(key) not in (None, ""))
+                store = open_store(job)
+                if store is not None:
+                    kwargs['intermediates'] = store
+                    kwargs['resume'] = checkpoint.completed(job['id'])
+                flow_area.flow_area(job['input_nhd_area_polys'], job['input_flow_lines'], job['input_upstr_pts'], job['input_dnstr_pts'], job['input_all_flow_lines'], job['thiessen'],
+                                    report=CheckpointReport(checkpoint, job['id'], attempt), raise_errors=True, **kwargs)
+                if store is not None:
+                    store.close()
+                wall = time.time() - started
+                checkpoint.finish(job['id'], wall)
+                return (job['id'], True, made, wall, None)
+            except Exception:
+                if store is not None:
+                    # Keep the intermediates of the completed stages for the next attempt
+                    store.release()
+                wall = time.time() - started
+                error = traceback.format_exc()
+                final = made > job['retries']
+                checkpoint.fail(job['id'], error, final)
+                if final:
+                    return (job['id'], False, made, wall, error)
+                time.sleep(job['backoff'] * 2 ** (made - 1))
+    finally:
+        checkpoint.close()
+
+def run_batch(manifest, checkpoint=None, workers=None, retries=2, backoff=30, summary_path=None):
+    # Function to run every basin in a manifest that the checkpoint database does not already record as done.
+    #
+    # ARGUMENTS:
+    # manifest:             CSV or JSON manifest path, or a list of job dictionaries as returned by read_manifest()
+    # checkpoint:           Checkpoint database path.  Defaults to the manifest path plus ".checkpoint.sqlite"
+    # workers:              Number of worker processes.  Defaults to the number of CPUs; 1 runs the basins in this process
+    # retries:              Number of times a failed basin is retried before it is recorded as failed
+    # backoff:              Seconds to wait before the first retry, doubling for each further retry
+    # summary_path:         Optional path to write the summary to as JSON
+    #
+    # Returns the summary dictionary
+
+    jobs = read_manifest(manifest) if not isinstance(manifest, list) else manifest
+    if checkpoint is None:
+        checkpoint = str(manifest) + ".checkpoint.sqlite"
+    store = CheckpointStore(checkpoint)
+    done = store.done()
+    store.close()
+
+    pending = []
+    for job in jobs:
+        if job['id'] in done:
+            continue
+        job = dict(job)
+        job.update({'checkpoint': checkpoint, 'retries': retries, 'backoff': backoff})
+        pending.append(job)
+    flow_io.add_message("  {0} basins in manifest, {1} already done, {2} to run".format(len(jobs), len(jobs) - len(pending), len(pending)))
+
+    started = time.time()
+    results = []
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(pending) <= 1:
+        for job in pending:
+            results.append(run_job(job))
+            _progress(results[-1], len(results), len(pending))
+    elif pending:
+        if os.name == 'nt':
+            # Spawned workers must start the standalone interpreter, not the ArcGIS application hosting this script
+            multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+        pool = multiprocessing.Pool(processes=min(workers, len(pending)))
+        try:
+            for result in pool.imap_unordered(run_job, pending, 1):
+                results.append(result)
+                _progress(result, len(results), len(pending))
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - started
+
+    summary = summarize(checkpoint, results, elapsed, len(jobs) - len(pending))
+    flow_io.add_message("  {0} done, {1} failed, {2} skipped in {3:.1f} s ({4:.1f} basins/hour, {5} retries)".format(
+        summary['done'], summary['failed'], summary['skipped'], summary['wall_s'], summary['basins_per_hour'], summary['retries']))
+    for failure in summary['failures']:
+        flow_io.add_message("  {0} failed after {1} attempts (last completed stage {2}): {3}".format(failure['id'], failure['attempts'], failure['last_stage'], failure['error']))
+    if summary_path:
+        with open(summary_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+def _progress(result, finished, total):
+    job_id, ok, made, wall, error = result
+    flow_io.add_message("  [{0}/{1}] {2} {3} in {4:.1f} s{5}".format(finished, total, job_id, "done" if ok else "FAILED", wall, " after {0} attempts".format(made) if made > 1 else ""))
+
+def summarize(checkpoint, results, elapsed, skipped):
+    # Throughput and failure summary of this run's results, with failure details from the checkpoint database
+    store = CheckpointStore(checkpoint)
+    try:
+        done = [result for result in results if result[1]]
+        walls = sorted(result[3] for result in done)
+        failures = []
+        for result in results:
+            if not result[1]:
+                lines = (result[4] or "").strip().splitlines()
+                failures.append({'id': result[0], 'attempts': store.attempts(result[0]), 'last_stage': store.last_stage(result[0]), 'error': lines[-1] if lines else None})
+        return {'done': len(done), 'failed': len(failures), 'skipped': skipped,
+                'retries': sum(result[2] - 1 for result in results),
+                'wall_s': elapsed,
+                'basins_per_hour': 3600.0 * len(done) / elapsed if elapsed > 0 else 0.0,
+                'basin_wall_s_mean': sum(walls) / len(walls) if walls else None,
+                'basin_wall_s_median': walls[len(walls) // 2] if walls else None,
+                'basin_wall_s_max': walls[-1] if walls else None,
+                'failures': failures}
+    finally:
+        store.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python flow_batch.py manifest [checkpoint] [workers] [retries] [summary.json]")
+    argv = sys.argv[1:] + [""] * 5
+    summary = run_batch(argv[0], argv[1] or None, int(argv[2]) if argv[2] else None, int(argv[3]) if argv[3] else 2, summary_path=argv[4] or None)
+    sys.exit(1 if summary['failed'] else 0)
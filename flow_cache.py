@@ -0,0 +1,173 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_cache.py
+# Purpose:     Content-hash cache of stage outputs for incremental flow_area
+#              runs.  Stage inputs are fingerprinted by geometry and attributes,
+#              combined with the stage parameters into a key, and outputs are
+#              kept in a size-bounded least-recently-used cache directory.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+#-------------------------------------------------------------------------------
+
+import os, glob, json, time, hashlib, shutil, tempfile
+import flow_store, flow_io, flow_gpkg
+
+# Bump when the layout of cache entries changes.  Changes to the pipeline itself are covered by code_version().
+CACHE_VERSION = 2
+
+_code_version = None
+
+def code_version():
+    # Hash of the source of the flow_*.py modules next to this one, so that editing any stage invalidates the outputs
+    # cached by the previous code.  Line endings are normalised so that checkouts on different platforms share entries.
+    global _code_version
+    if _code_version is None:
+        h = hashlib.sha1()
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "flow_*.py"))):
+            h.update(os.path.basename(path).encode('utf-8'))
+            with open(path, 'rb') as f:
+                h.update(f.read().replace(b'\r\n', b'\n'))
+            h.update(b'\x00')
+        _code_version = h.hexdigest()
+    return _code_version
+
+def fingerprint_rows(rows):
+    # Fingerprint of an iterable of rows, in order.  Each row is a tuple of geometry bytes (e.g. WKB) and attribute values;
+    # renumbered object IDs give the same fingerprint, but a different row order does not.  Stages depend on input order:
+    # remove_self_intersects() cuts a line by the last overlapping line in input order, and the Thiessen stage keeps the
+    # first of coincident seed vertices.
+    digests = hashlib.sha1()
+    for row in rows:
+        h = hashlib.sha1()
+        for value in row:
+            if isinstance(value, (bytes, bytearray)):
+                h.update(b'b')
+                h.update(bytes(value))
+            else:
+                h.update(b'v')
+                h.update(repr(value).encode('utf-8'))
+            h.update(b'\x00')
+        digests.update(h.digest())
+    return digests.hexdigest()
+
+def fingerprint_arcpy(dataset):
+    # Fingerprint of an arcpy dataset or layer from its geometry (as WKB) and every attribute except object ID and shape fields, in cursor order
+    import arcpy
+    desc = arcpy.Describe(dataset)
+    skip = set([desc.OIDFieldName, getattr(desc, 'shapeFieldName', None)])
+    for attr in ('lengthFieldName', 'areaFieldName'):
+        skip.add(getattr(desc, attr, None))
+    fields = sorted(f.name for f in arcpy.ListFields(dataset) if f.name not in skip and f.type not in ('OID', 'Geometry', 'Blob', 'Raster'))
+
+    def rows():
+        with arcpy.da.SearchCursor(dataset, ['SHAPE@WKB'] + fields) as cursor:
+            for row in cursor:
+                yield row
+    return fingerprint_rows(rows())
+
+def fingerprint_gpkg(dataset):
+    # Fingerprint of a GeoPackage table from its geometry (as WKB) and every attribute, as fingerprint_arcpy() takes them, in the
+    # fid order the shapely backend reads them in
+    path, table = flow_io.split_gpkg(dataset)
+    conn, owned = flow_io.connect(path)
+    try:
+        fields = sorted(flow_gpkg.field_names(conn, table))
+        columns = ''.join(', "{0}"'.format(name) for name in fields)
+        rows = conn.execute('SELECT geom{0} FROM "{1}" ORDER BY fid'.format(columns, table))
+        return fingerprint_rows((flow_gpkg.wkb_from_blob(row[0]),) + tuple(row[1:]) for row in rows)
+    finally:
+        if owned:
+            conn.close()
+
+def fingerprint(dataset):
+    # Fingerprint of a GeoPackage table or an arcpy dataset or layer
+    if flow_io.split_gpkg(dataset):
+        return fingerprint_gpkg(dataset)
+    return fingerprint_arcpy(dataset)
+
+def cache_key(stage, fingerprints, params):
+    # Key for a stage from its name, its input fingerprints (in argument order) and a dictionary of its parameters
+    payload = json.dumps([CACHE_VERSION, code_version(), stage, list(fingerprints), sorted((str(k), str(v)) for k, v in params.items())])
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+class StageCache(object):
+    # Directory of cache entries, one sub-directory per key.  Each entry holds whatever files the stage saved plus a small
+    # metadata file whose modification time records when the entry was last used.  Entries are written to a temporary
+    # directory and renamed into place, so several processes can share a cache directory.
+    #
+    # ARGUMENTS:
+    # directory:            Cache directory, created if needed
+    # max_bytes:            Size limit; least recently used entries are evicted after each save until the cache fits
+
+    META = "entry.json"
+
+    def __init__(self, directory, max_bytes=10 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        # Return the entry directory for key and mark it used, or None on a miss
+        entry = self.path(key)
+        meta = os.path.join(entry, self.META)
+        if os.path.exists(meta):
+            os.utime(meta, None)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def put(self, key, save):
+        # Create the entry for key by calling save(directory) to write its files, then evict old entries.  Returns the entry directory.
+        entry = self.path(key)
+        if os.path.exists(os.path.join(entry, self.META)):
+            return entry
+        staging = tempfile.mkdtemp(prefix=".tmp_", dir=self.directory)
+        try:
+            save(staging)
+            with open(os.path.join(staging, self.META), 'w') as f:
+                json.dump({'key': key, 'created': time.time(), 'bytes': flow_store.folder_bytes(staging)}, f)
+            try:
+                os.rename(staging, entry)
+            except OSError:
+                # Another process saved the same entry first
+                shutil.rmtree(staging, ignore_errors=True)
+        except:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.evict(keep=key)
+        return entry
+
+    def entries(self):
+        # List of (last used time, bytes, key) for complete entries
+        found = []
+        for key in os.listdir(self.directory):
+            meta = os.path.join(self.directory, key, self.META)
+            if key.startswith(".") or not os.path.exists(meta):
+                continue
+            try:
+                with open(meta) as f:
+                    size = json.load(f)['bytes']
+                found.append((os.path.getmtime(meta), size, key))
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+        return found
+
+    def evict(self, keep=None):
+        entries = sorted(self.entries())
+        total = sum(entry[1] for entry in entries)
+        for used, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= size
@@ -0,0 +1,286 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_geom.py
+# Purpose:     Pure-Python/NumPy geometry helpers used by flow_area.py that do
+#              not require arcpy, so they can be run and checked on any platform.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+#-------------------------------------------------------------------------------
+#
+# Geometry conventions used throughout this module:
+#   point:  (x, y) tuple
+#   part:   list of points making up one continuous path
+#   line:   list of parts (a single-part line is a list holding one part)
+#   bbox:   (xmin, ymin, xmax, ymax) tuple
+
+from __future__ import division
+import math
+import numpy
+
+def add_subtract_radians(theta):
+    return (theta + 1.57079632679, theta - 1.57079632679)
+
+def distance(x1, y1, x2, y2):
+    return float(math.pow(((math.pow((x2-x1),2)) + (math.pow((y2 - y1),2))),.5))
+
+def cart_to_polar(xy1, xy2):
+    try:
+        x1, y1, x2, y2 = float(xy1[0]), float(xy1[1]), float(xy2[0]), float(xy2[1])
+        xdistance, ydistance = x2 - x1, y2 - y1
+        distance = math.pow(((math.pow((x2 - x1),2)) + (math.pow((y2 - y1),2))),.5)
+        if xdistance == 0:
+            if y2 > y1:
+                theta = math.pi/2
+            else:
+                theta = (3*math.pi)/2
+        elif ydistance == 0:
+            if x2 > x1:
+                theta = 0
+            else:
+                theta = math.pi
+        else:
+            theta = math.atan(ydistance/xdistance)
+            if xdistance > 0 and ydistance < 0:
+                theta = 2*math.pi + theta
+            if xdistance < 0 and ydistance > 0:
+                theta = math.pi + theta
+            if xdistance < 0 and ydistance < 0:
+                theta = math.pi + theta
+        return [distance, theta]
+    except:
+        print("      Cutline - Error in CartesianToPolar()")
+
+def polar_to_cart(polarcoords):
+    r = polarcoords[0]
+    theta = polarcoords[1]
+    x = r * math.cos(theta)
+    y = r * math.sin(theta)
+    return [x, y]
+
+def perpendicular_cutlines(start_xy, end_xy, distance, start):
+    # Vectorized equivalent of the cart_to_polar/add_subtract_radians/polar_to_cart steps
+    # in make_perpendicular(), for many segments at once.
+    #
+    # ARGUMENTS:
+    # start_xy:     (N, 2) array of segment start coordinates
+    # end_xy:       (N, 2) array of segment end coordinates
+    # distance:     Cutline half-length, either a scalar or an (N,) array for per-feature lengths
+    # start:        Boolean.  True centres each cutline on the segment start, False on the segment end
+    #
+    # Returns an (N, 3, 2) array of cutline vertices ordered [theta + 90, centre, theta - 90].
+    start_xy = numpy.asarray(start_xy, dtype=float).reshape(-1, 2)
+    end_xy = numpy.asarray(end_xy, dtype=float).reshape(-1, 2)
+    delta = end_xy - start_xy
+    theta = numpy.arctan2(delta[:, 1], delta[:, 0])
+    # cart_to_polar() treats a zero-length segment as pointing straight down
+    theta[(delta[:, 0] == 0) & (delta[:, 1] == 0)] = -math.pi/2
+    offset = numpy.asarray(distance, dtype=float).reshape(-1, 1) * numpy.column_stack((-numpy.sin(theta), numpy.cos(theta)))
+    centre = start_xy if start else end_xy
+    cutlines = numpy.empty((len(centre), 3, 2))
+    cutlines[:, 0, :] = centre + offset
+    cutlines[:, 1, :] = centre
+    cutlines[:, 2, :] = centre - offset
+    return cutlines
+
+def line_bbox(line):
+    xs = [pt[0] for part in line for pt in part]
+    ys = [pt[1] for part in line for pt in part]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+def bboxes_overlap(a, b, tolerance=0.0):
+    return not (a[2] + tolerance < b[0] or b[2] + tolerance < a[0] or
+                a[3] + tolerance < b[1] or b[3] + tolerance < a[1])
+
+def _cross(ox, oy, ax, ay, bx, by):
+    return (ax - ox) * (by - oy) - (ay - oy) * (bx - ox)
+
+def point_segment_distance(pt, a, b):
+    px, py = pt
+    ax, ay = a
+    bx, by = b
+    dx, dy = bx - ax, by - ay
+    seglen2 = dx * dx + dy * dy
+    if seglen2 == 0:
+        return math.hypot(px - ax, py - ay)
+    t = ((px - ax) * dx + (py - ay) * dy) / seglen2
+    t = max(0.0, min(1.0, t))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+def segments_touch(a1, a2, b1, b2, tolerance=0.0):
+    # True if segments a1-a2 and b1-b2 cross or come within tolerance of each other
+    d1 = _cross(b1[0], b1[1], b2[0], b2[1], a1[0], a1[1])
+    d2 = _cross(b1[0], b1[1], b2[0], b2[1], a2[0], a2[1])
+    d3 = _cross(a1[0], a1[1], a2[0], a2[1], b1[0], b1[1])
+    d4 = _cross(a1[0], a1[1], a2[0], a2[1], b2[0], b2[1])
+    if ((d1 > 0 and d2 < 0) or (d1 < 0 and d2 > 0)) and ((d3 > 0 and d4 < 0) or (d3 < 0 and d4 > 0)):
+        return True
+    return min(point_segment_distance(a1, b1, b2), point_segment_distance(a2, b1, b2),
+               point_segment_distance(b1, a1, a2), point_segment_distance(b2, a1, a2)) <= tolerance
+
+def segment_intersection(a1, a2, b1, b2):
+    # Returns parameter t along a1-a2 at which it properly crosses b1-b2, or None
+    rx, ry = a2[0] - a1[0], a2[1] - a1[1]
+    sx, sy = b2[0] - b1[0], b2[1] - b1[1]
+    denom = rx * sy - ry * sx
+    if denom == 0:
+        return None
+    qpx, qpy = b1[0] - a1[0], b1[1] - a1[1]
+    t = (qpx * sy - qpy * sx) / denom
+    u = (qpx * ry - qpy * rx) / denom
+    if 0.0 <= t <= 1.0 and 0.0 <= u <= 1.0:
+        return t
+    return None
+
+def _segments(line):
+    for part in line:
+        for i in range(len(part) - 1):
+            yield part[i], part[i + 1]
+
+def lines_disjoint(a, b, tolerance=0.0):
+    if not bboxes_overlap(line_bbox(a), line_bbox(b), tolerance):
+        return True
+    for a1, a2 in _segments(a):
+        for b1, b2 in _segments(b):
+            if segments_touch(a1, a2, b1, b2, tolerance):
+                return False
+    return True
+
+def _parts_equal(a, b, tolerance):
+    if len(a) != len(b):
+        return False
+    for p, q in zip(a, b):
+        if abs(p[0] - q[0]) > tolerance or abs(p[1] - q[1]) > tolerance:
+            return False
+    return True
+
+def lines_equal(a, b, tolerance=0.0):
+    # Geometric equality of two lines, ignoring part direction
+    if len(a) != len(b):
+        return False
+    for pa, pb in zip(a, b):
+        if not (_parts_equal(pa, pb, tolerance) or _parts_equal(pa, list(reversed(pb)), tolerance)):
+            return False
+    return True
+
+def point_on_line(pt, line, tolerance=0.0):
+    for a1, a2 in _segments(line):
+        if point_segment_distance(pt, a1, a2) <= tolerance:
+            return True
+    return False
+
+def _near(p, q, tolerance):
+    return math.hypot(p[0] - q[0], p[1] - q[1]) <= tolerance
+
+def cut_line(line, cutter, tolerance=0.0):
+    # Split line where it is crossed by cutter, in the manner of arcpy.Polyline.cut().
+    # Returns [first, second], each a (possibly multipart) line, with pieces on
+    # alternating sides of the cutter assigned alternately.  If the cutter does not
+    # cross the interior of the line, the line is returned unchanged as a single item.
+    pieces = []
+    for part in line:
+        current = [part[0]]
+        for i in range(len(part) - 1):
+            a1, a2 = part[i], part[i + 1]
+            ts = []
+            for b1, b2 in _segments(cutter):
+                t = segment_intersection(a1, a2, b1, b2)
+                if t is not None:
+                    ts.append(t)
+            for t in sorted(set(ts)):
+                x = a1[0] + t * (a2[0] - a1[0])
+                y = a1[1] + t * (a2[1] - a1[1])
+                if _near((x, y), current[-1], tolerance) or _near((x, y), part[-1], tolerance):
+                    continue
+                current.append((x, y))
+                pieces.append(current)
+                current = [(x, y)]
+            if not _near(a2, current[-1], 0.0):
+                current.append(a2)
+        pieces.append(current)
+    if len(pieces) <= len(line):
+        return [line]
+    return [pieces[0::2], pieces[1::2]]
+
+class GridIndex(object):
+    # Uniform grid bucket index over bounding boxes.  Items may be bucketed under an
+    # additional key (e.g. an ID field value) so that queries only return items
+    # sharing that key.
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.buckets = {}
+
+    def _cells(self, bbox):
+        size = self.cell_size
+        for cx in range(int(math.floor(bbox[0] / size)), int(math.floor(bbox[2] / size)) + 1):
+            for cy in range(int(math.floor(bbox[1] / size)), int(math.floor(bbox[3] / size)) + 1):
+                yield cx, cy
+
+    def insert(self, item, bbox, key=None):
+        for cell in self._cells(bbox):
+            self.buckets.setdefault((key, cell), []).append(item)
+
+    def query(self, bbox, key=None):
+        found = set()
+        for cell in self._cells(bbox):
+            found.update(self.buckets.get((key, cell), ()))
+        return found
+
+def _auto_cell_size(bboxes):
+    spans = [max(b[2] - b[0], b[3] - b[1]) for b in bboxes]
+    spans = [s for s in spans if s > 0]
+    if not spans:
+        return 1.0
+    return sum(spans) / len(spans)
+
+def filter_self_intersects(lines, ids, points, tolerance=0.0, report=None):
+    # In-memory equivalent of the nested cursor loops formerly in remove_self_intersects().
+    #
+    # ARGUMENTS:
+    # lines:        List of lines (see module conventions) in input cursor order
+    # ids:          List of ID values, parallel to lines
+    # points:       List of (x, y) points.  Lines or line portions are kept only where they touch one of these.
+    # tolerance:    XY tolerance used for intersection, equality and point-on-line tests
+    # report:       Optional callable(id_of_cutter, id_of_line) invoked for every overlap found
+    #
+    # Returns a list of (line, id) output rows in the order the original loops inserted
+    # them.  As before, a row is emitted once for every point it touches, and when a line
+    # overlaps several others with the same ID only the last overlap in input order is
+    # used to cut it.
+    bboxes = [line_bbox(line) for line in lines]
+    cell_size = _auto_cell_size(bboxes)
+
+    line_index = GridIndex(cell_size)
+    for i, bbox in enumerate(bboxes):
+        line_index.insert(i, bbox, ids[i])
+
+    point_index = GridIndex(cell_size)
+    for j, pt in enumerate(points):
+        point_index.insert(j, (pt[0], pt[1], pt[0], pt[1]))
+
+    def touching_points(geom, bbox):
+        grown = (bbox[0] - tolerance, bbox[1] - tolerance, bbox[2] + tolerance, bbox[3] + tolerance)
+        return [j for j in sorted(point_index.query(grown)) if point_on_line(points[j], geom, tolerance)]
+
+    output = []
+    for i, line in enumerate(lines):
+        cutter = None
+        for k in sorted(line_index.query(bboxes[i], ids[i])):
+            if not bboxes_overlap(bboxes[i], bboxes[k], tolerance):
+                continue
+            other = lines[k]
+            if not lines_disjoint(other, line, tolerance) and not lines_equal(other, line, tolerance):
+                if report is not None:
+                    report(ids[k], ids[i])
+                cutter = other
+        if cutter is None:
+            for j in touching_points(line, bboxes[i]):
+                output.append((line, ids[i]))
+        else:
+            for piece in cut_line(line, cutter, tolerance):
+                piecebbox = line_bbox(piece)
+                for j in touching_points(piece, piecebbox):
+                    output.append((piece, ids[i]))
+    return output
@@ -0,0 +1,216 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_gpkg.py
+# Purpose:     Minimal GeoPackage reader/writer built on the standard library
+#              sqlite3 module, used to hold flow_area intermediates on systems
+#              without arcpy.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+#-------------------------------------------------------------------------------
+#
+# Geometries are passed in the conventions of flow_geom.py according to the
+# geometry type of the table:
+#   POINT:          (x, y)
+#   MULTILINESTRING: list of parts
+#   MULTIPOLYGON:   list of polygons, each a list of closed rings (exterior first)
+
+import sqlite3, struct
+
+GEOMETRY_TYPES = {'POINT': 1, 'LINESTRING': 2, 'POLYGON': 3, 'MULTIPOINT': 4, 'MULTILINESTRING': 5, 'MULTIPOLYGON': 6}
+FIELD_TYPES = {'TEXT': 'TEXT', 'LONG': 'INTEGER', 'SHORT': 'INTEGER', 'DOUBLE': 'DOUBLE', 'FLOAT': 'DOUBLE'}
+
+# Open connections registered with share(), by workspace path
+_shared = {}
+
+def share(path, conn):
+    # Register an open connection as the one to use for the GeoPackage at path, e.g. for an in-memory database
+    _shared[path] = conn
+
+def unshare(path):
+    _shared.pop(path, None)
+
+def shared(path):
+    return _shared.get(path)
+
+def connect(path):
+    # Open (creating if necessary) a GeoPackage and make sure its metadata tables exist.  path may be ':memory:'.
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA application_id = 1196444487")
+    conn.execute("CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name))")
+    conn.execute("INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', NULL)")
+    conn.execute("INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', NULL)")
+    conn.commit()
+    return conn
+
+def _pack_points(points):
+    return struct.pack('<I', len(points)) + b''.join(struct.pack('<dd', x, y) for x, y in points)
+
+def to_wkb(geometry_type, geom):
+    if geometry_type == 'POINT':
+        return struct.pack('<BIdd', 1, 1, geom[0], geom[1])
+    if geometry_type == 'MULTILINESTRING':
+        return struct.pack('<BII', 1, 5, len(geom)) + b''.join(struct.pack('<BI', 1, 2) + _pack_points(part) for part in geom)
+    if geometry_type == 'MULTIPOLYGON':
+        body = []
+        for polygon in geom:
+            body.append(struct.pack('<BII', 1, 3, len(polygon)) + b''.join(_pack_points(ring) for ring in polygon))
+        return struct.pack('<BII', 1, 6, len(geom)) + b''.join(body)
+    raise ValueError("Unsupported geometry type: " + str(geometry_type))
+
+def _read_wkb(buf, offset):
+    order = '<' if struct.unpack_from('B', buf, offset)[0] == 1 else '>'
+    wkbtype = struct.unpack_from(order + 'I', buf, offset + 1)[0] % 1000
+    offset += 5
+
+    def points(offset):
+        count = struct.unpack_from(order + 'I', buf, offset)[0]
+        offset += 4
+        pts = [struct.unpack_from(order + 'dd', buf, offset + 16 * i) for i in range(count)]
+        return pts, offset + 16 * count
+
+    if wkbtype == 1:
+        return ('POINT', struct.unpack_from(order + 'dd', buf, offset)), offset + 16
+    if wkbtype == 2:
+        pts, offset = points(offset)
+        return ('LINESTRING', pts), offset
+    if wkbtype == 3:
+        count = struct.unpack_from(order + 'I', buf, offset)[0]
+        offset += 4
+        rings = []
+        for i in range(count):
+            ring, offset = points(offset)
+            rings.append(ring)
+        return ('POLYGON', rings), offset
+    if wkbtype in (4, 5, 6):
+        count = struct.unpack_from(order + 'I', buf, offset)[0]
+        offset += 4
+        members = []
+        for i in range(count):
+            member, offset = _read_wkb(buf, offset)
+            members.append(member[1])
+        return ({4: 'MULTIPOINT', 5: 'MULTILINESTRING', 6: 'MULTIPOLYGON'}[wkbtype], members), offset
+    raise ValueError("Unsupported WKB geometry type: " + str(wkbtype))
+
+def from_wkb(buf):
+    # Parse WKB into the conventions above; single lines and polygons are promoted to their multi form.
+    (geometry_type, geom), offset = _read_wkb(buf, 0)
+    if geometry_type == 'LINESTRING':
+        return 'MULTILINESTRING', [geom]
+    if geometry_type == 'POLYGON':
+        return 'MULTIPOLYGON', [geom]
+    return geometry_type, geom
+
+def _bbox(geometry_type, geom):
+    if geometry_type == 'POINT':
+        return (geom[0], geom[1], geom[0], geom[1])
+    if geometry_type == 'MULTILINESTRING':
+        pts = [pt for part in geom for pt in part]
+    else:
+        pts = [pt for polygon in geom for pt in polygon[0]]
+    xs = [pt[0] for pt in pts]
+    ys = [pt[1] for pt in pts]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+def blob_from_wkb(wkb, bbox, srs_id=-1):
+    # GeoPackage geometry blob: standard header with an XY envelope, followed by WKB
+    xmin, ymin, xmax, ymax = bbox
+    header = struct.pack('<2sBBi4d', b'GP', 0, 0x03, srs_id, xmin, xmax, ymin, ymax)
+    return sqlite3.Binary(header + wkb)
+
+def wkb_from_blob(blob):
+    if blob is None:
+        return None
+    buf = bytes(blob)
+    flags = struct.unpack_from('B', buf, 3)[0]
+    envelope = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}[(flags >> 1) & 0x07]
+    return buf[8 + envelope:]
+
+def to_blob(geometry_type, geom, srs_id=-1):
+    if geom is None:
+        return None
+    return blob_from_wkb(to_wkb(geometry_type, geom), _bbox(geometry_type, geom), srs_id)
+
+def from_blob(blob):
+    if blob is None:
+        return None
+    return from_wkb(wkb_from_blob(blob))[1]
+
+def spatial_ref_sys(conn, table):
+    # The gpkg_spatial_ref_sys row (srs_name, srs_id, organization, organization_coordsys_id, definition, description)
+    # of the coordinate system of table, which create_table() can register in another GeoPackage
+    srs = srs_id(conn, table)
+    row = conn.execute("SELECT srs_name, srs_id, organization, organization_coordsys_id, definition, description FROM gpkg_spatial_ref_sys WHERE srs_id = ?", (srs,)).fetchone()
+    return tuple(row) if row else srs
+
+def create_table(conn, table, geometry_type, fields=(), srs_id=-1):
+    # Create (replacing any existing) feature table.  fields is a list of (name, type) pairs using the arcpy field type names in FIELD_TYPES.
+    # srs_id is either an srs_id already defined in this GeoPackage, or a spatial_ref_sys() row of another, which is
+    # added if this GeoPackage has no coordinate system with that srs_id.
+    if isinstance(srs_id, tuple):
+        conn.execute("INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", srs_id)
+        srs_id = srs_id[1]
+    drop_table(conn, table)
+    columns = ''.join(', "{0}" {1}'.format(name, FIELD_TYPES.get(ftype.upper(), 'TEXT')) for name, ftype in fields)
+    conn.execute('CREATE TABLE "{0}" (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom BLOB{1})'.format(table, columns))
+    conn.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, 'features', ?, ?)", (table, table, srs_id))
+    conn.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', ?, ?, 0, 0)", (table, geometry_type, srs_id))
+    conn.commit()
+
+def drop_table(conn, table):
+    conn.execute('DROP TABLE IF EXISTS "{0}"'.format(table))
+    conn.execute("DELETE FROM gpkg_contents WHERE table_name = ?", (table,))
+    conn.execute("DELETE FROM gpkg_geometry_columns WHERE table_name = ?", (table,))
+    conn.commit()
+
+def list_tables(conn):
+    return [row[0] for row in conn.execute("SELECT table_name FROM gpkg_contents ORDER BY table_name")]
+
+def geometry_type(conn, table):
+    return conn.execute("SELECT geometry_type_name FROM gpkg_geometry_columns WHERE table_name = ?", (table,)).fetchone()[0]
+
+def field_names(conn, table):
+    return [row[1] for row in conn.execute('PRAGMA table_info("{0}")'.format(table)) if row[1] not in ('fid', 'geom')]
+
+def fields(conn, table):
+    # List of (name, arcpy field type) for the attribute columns of table
+    types = {'INTEGER': 'LONG', 'DOUBLE': 'DOUBLE', 'REAL': 'DOUBLE'}
+    return [(row[1], types.get(str(row[2]).upper(), 'TEXT')) for row in conn.execute('PRAGMA table_info("{0}")'.format(table)) if row[1] not in ('fid', 'geom')]
+
+def srs_id(conn, table):
+    row = conn.execute("SELECT srs_id FROM gpkg_geometry_columns WHERE table_name = ?", (table,)).fetchone()
+    if row is None:
+        raise ValueError("No such feature table: " + str(table))
+    return row[0]
+
+def insert_rows(conn, table, fields, rows):
+    # Insert (geometry, value, value, ...) rows in a single transaction
+    gtype = geometry_type(conn, table)
+    srs_id = conn.execute("SELECT srs_id FROM gpkg_geometry_columns WHERE table_name = ?", (table,)).fetchone()[0]
+    columns = ''.join(', "{0}"'.format(name) for name in fields)
+    marks = ', ?' * len(fields)
+    conn.executemany('INSERT INTO "{0}" (geom{1}) VALUES (?{2})'.format(table, columns, marks),
+                     ([to_blob(gtype, row[0], srs_id)] + list(row[1:]) for row in rows))
+    conn.commit()
+
+def read_rows(conn, table, fields=(), where=None, batch_size=10000):
+    # Yield (fid, geometry, value, value, ...) rows in fid order, fetching batch_size rows at a time
+    columns = ''.join(', "{0}"'.format(name) for name in fields)
+    sql = 'SELECT fid, geom{0} FROM "{1}"'.format(columns, table)
+    if where:
+        sql += ' WHERE ' + where
+    cursor = conn.execute(sql + ' ORDER BY fid')
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        for row in batch:
+            yield (row[0], from_blob(row[1])) + tuple(row[2:])
+
+def database_bytes(conn):
+    # Bytes of the database in use (excluding free pages), valid for file and ':memory:' databases alike
+    pages = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return pages * conn.execute("PRAGMA page_size").fetchone()[0]
@@ -0,0 +1,423 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_io.py
+# Purpose:     Chunked feature I/O for flow_area.py.  Features are streamed in
+#              fixed-size chunks held as NumPy coordinate buffers with offset
+#              arrays, and written back a whole chunk at a time, so memory use
+#              is bounded by the chunk size rather than the feature count.
+#              Datasets may be arcpy feature classes/layers or GeoPackage tables
+#              (path/to/file.gpkg/table), the latter needing no arcpy.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+#-------------------------------------------------------------------------------
+#
+# Chunk layout (ragged arrays) for n features:
+#   coords:             (M, 2) float64 array of every vertex in the chunk
+#   part_offsets:       (P + 1,) int64 array; part p is coords[part_offsets[p]:part_offsets[p + 1]]
+#   feature_offsets:    (n + 1,) int64 array; feature i is parts feature_offsets[i] to feature_offsets[i + 1]
+#   attributes:         dictionary of field name to list of n values
+# A point feature is one part of one vertex.  A polygon feature is written as a single polygon whose first part is the
+# exterior ring and any further parts its holes; when read, every ring of every polygon is a part.
+
+import os, sys, struct
+import numpy
+import flow_gpkg
+
+CHUNK_SIZE = 10000
+METERS_PER_DEGREE = 111319.49    # length of a degree of latitude, or of longitude at the equator, on the WGS84 ellipsoid
+GPKG_TYPES = {'POINT': 'POINT', 'POLYLINE': 'MULTILINESTRING', 'POLYGON': 'MULTIPOLYGON'}
+
+class FeatureChunk(object):
+
+    def __init__(self, geometry_type, coords, part_offsets, feature_offsets, attributes=None):
+        self.geometry_type = geometry_type
+        self.coords = coords
+        self.part_offsets = part_offsets
+        self.feature_offsets = feature_offsets
+        self.attributes = attributes or {}
+
+    def __len__(self):
+        return len(self.feature_offsets) - 1
+
+    @classmethod
+    def from_rings(cls, polygons, attributes=None):
+        # Build a polygon chunk from a list of polygons, each a list of closed rings with the exterior first
+        chunk = cls.from_lines(polygons, attributes)
+        chunk.geometry_type = 'POLYGON'
+        return chunk
+
+    @classmethod
+    def from_lines(cls, lines, attributes=None):
+        # Build a polyline chunk from either an (N, V, 2) array of single-part lines, or a list of lines in flow_geom conventions
+        if isinstance(lines, numpy.ndarray):
+            count, nverts = lines.shape[0], lines.shape[1]
+            return cls('POLYLINE', lines.reshape(-1, 2), numpy.arange(count + 1, dtype=numpy.int64) * nverts,
+                       numpy.arange(count + 1, dtype=numpy.int64), attributes)
+        parts = [part for line in lines for part in line]
+        part_lengths = [len(part) for part in parts]
+        coords = numpy.array([pt for part in parts for pt in part], dtype=float).reshape(-1, 2)
+        return cls('POLYLINE', coords, _offsets(part_lengths), _offsets([len(line) for line in lines]), attributes)
+
+    def lines(self):
+        # The chunk's features as lists of parts of (x, y) tuples, as used by flow_geom
+        xy = [tuple(pt) for pt in self.coords.tolist()]
+        parts = [xy[self.part_offsets[p]:self.part_offsets[p + 1]] for p in range(len(self.part_offsets) - 1)]
+        return [parts[self.feature_offsets[i]:self.feature_offsets[i + 1]] for i in range(len(self))]
+
+    def points(self):
+        return [tuple(pt) for pt in self.coords[self.part_offsets[:-1]].tolist()]
+
+    def vertex_count(self):
+        return len(self.coords)
+
+    def first_segments(self):
+        # (start, end) arrays of the first two vertices of each feature's first part
+        first = self.part_offsets[self.feature_offsets[:-1]]
+        return self.coords[first], self.coords[first + 1]
+
+    def last_segments(self):
+        # (start, end) arrays of the last two vertices of each feature's last part
+        last = self.part_offsets[self.feature_offsets[1:]] - 1
+        return self.coords[last - 1], self.coords[last]
+
+def _offsets(lengths):
+    offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+def concatenate(chunks):
+    # One FeatureChunk holding the features of a list of chunks of the same geometry type, in order
+    if not chunks:
+        return FeatureChunk('POLYLINE', numpy.empty((0, 2)), numpy.zeros(1, dtype=numpy.int64), numpy.zeros(1, dtype=numpy.int64))
+    coords = numpy.vstack([chunk.coords for chunk in chunks])
+    part_lengths = numpy.concatenate([numpy.diff(chunk.part_offsets) for chunk in chunks])
+    feature_parts = numpy.concatenate([numpy.diff(chunk.feature_offsets) for chunk in chunks])
+    attributes = dict((name, [value for chunk in chunks for value in chunk.attributes[name]]) for name in chunks[0].attributes)
+    return FeatureChunk(chunks[0].geometry_type, coords, _offsets(part_lengths), _offsets(feature_parts), attributes)
+
+def split_gpkg(dataset):
+    # Return (GeoPackage path, table) for a dataset inside a GeoPackage, or None for anything else
+    path = str(dataset)
+    lower = path.lower()
+    index = lower.find('.gpkg')
+    if index < 0 or len(path) <= index + 6:
+        return None
+    return path[:index + 5], path[index + 6:]
+
+def output_path(workspace, name):
+    # Path of a new dataset called name in workspace; names that are already GeoPackage dataset paths are used as they are
+    if split_gpkg(name):
+        return name
+    return os.path.join(workspace, name)
+
+def catalog_path(dataset):
+    # Path of the data behind a dataset or layer, which other processes can open.  A layer's selection and definition query do not carry over.
+    if split_gpkg(dataset):
+        return str(dataset)
+    import arcpy
+    return arcpy.Describe(dataset).catalogPath
+
+def oid_field(dataset):
+    # Name of the feature ID field of a dataset, delimited for use in where clauses
+    if split_gpkg(dataset):
+        return '"fid"'
+    import arcpy
+    return arcpy.AddFieldDelimiters(dataset, arcpy.Describe(dataset).OIDFieldName)
+
+def connect(path):
+    # Return (connection, owned) for a GeoPackage.  Connections shared through flow_gpkg.share() are not owned and must not be closed.
+    conn = flow_gpkg.shared(path)
+    if conn is not None:
+        return conn, False
+    return flow_gpkg.connect(path), True
+
+def describe(dataset):
+    # Return (workspace, spatial reference, XY tolerance) of a dataset.  For GeoPackage tables the spatial reference is
+    # the flow_gpkg.spatial_ref_sys() row, so that tables written from it in other GeoPackages keep the coordinate system.
+    gpkg = split_gpkg(dataset)
+    if gpkg:
+        # The ArcGIS default XY tolerance of 1 millimeter, in degrees for geographic coordinate systems
+        conn, owned = connect(gpkg[0])
+        spatialRef = flow_gpkg.spatial_ref_sys(conn, gpkg[1])
+        if owned:
+            conn.close()
+        return gpkg[0], spatialRef, 0.001 / METERS_PER_DEGREE if is_geographic(dataset) else 0.001
+    import arcpy
+    desc = arcpy.Describe(dataset)
+    spatialRef = desc.spatialReference
+    return desc.path, spatialRef, spatialRef.XYTolerance if spatialRef.XYTolerance else 0.001
+
+def _gpkg_definition(gpkg):
+    # (srs_id, WKT definition) of the coordinate system of a GeoPackage table
+    conn, owned = connect(gpkg[0])
+    srs_id = flow_gpkg.srs_id(conn, gpkg[1])
+    row = conn.execute("SELECT definition FROM gpkg_spatial_ref_sys WHERE srs_id = ?", (srs_id,)).fetchone()
+    if owned:
+        conn.close()
+    return srs_id, str(row[0]) if row else ""
+
+def meters_per_unit(dataset):
+    # Meters per horizontal unit of a projected dataset, or None for geographic or unknown coordinate systems
+    gpkg = split_gpkg(dataset)
+    if gpkg:
+        definition = _gpkg_definition(gpkg)[1]
+        if not definition.upper().startswith("PROJCS"):
+            return None
+        # The linear unit is the last UNIT of a projected WKT definition, as in UNIT["metre",1]
+        unit = definition[definition.upper().rindex('UNIT['):]
+        return float(unit.split(',')[1].split(']')[0])
+    import arcpy
+    spatialRef = arcpy.Describe(dataset).spatialReference
+    return spatialRef.metersPerUnit if spatialRef.type == "Projected" else None
+
+def is_geographic(dataset):
+    # True for a dataset in a geographic (longitude/latitude) coordinate system
+    gpkg = split_gpkg(dataset)
+    if gpkg:
+        # srs_id 0 is the GeoPackage's undefined geographic coordinate system
+        srs_id, definition = _gpkg_definition(gpkg)
+        return srs_id == 0 or definition.upper().startswith(("GEOGCS", "GEOGCRS", "GEODCRS"))
+    import arcpy
+    return arcpy.Describe(dataset).spatialReference.type == "Geographic"
+
+def field_names(dataset):
+    gpkg = split_gpkg(dataset)
+    if gpkg:
+        conn, owned = connect(gpkg[0])
+        names = flow_gpkg.field_names(conn, gpkg[1])
+        if owned:
+            conn.close()
+        return names
+    import arcpy
+    return [f.name for f in arcpy.ListFields(dataset)]
+
+def extent(dataset, chunk_size=CHUNK_SIZE):
+    # (xmin, ymin, xmax, ymax) of a dataset
+    gpkg = split_gpkg(dataset)
+    if not gpkg:
+        import arcpy
+        ext = arcpy.Describe(dataset).extent
+        return (ext.XMin, ext.YMin, ext.XMax, ext.YMax)
+    bounds = None
+    for chunk in read_chunks(dataset, (), chunk_size):
+        if not chunk.vertex_count():
+            continue
+        lo, hi = chunk.coords.min(axis=0), chunk.coords.max(axis=0)
+        if bounds is not None:
+            lo, hi = numpy.minimum(lo, bounds[0]), numpy.maximum(hi, bounds[1])
+        bounds = (lo, hi)
+    if bounds is None:
+        return None
+    return (float(bounds[0][0]), float(bounds[0][1]), float(bounds[1][0]), float(bounds[1][1]))
+
+def add_message(message):
+    # arcpy.AddMessage() where arcpy is in use, otherwise standard output
+    if 'arcpy' in sys.modules:
+        sys.modules['arcpy'].AddMessage(message)
+    else:
+        sys.stdout.write(message + "\n")
+
+def _decode(buf, offset, coords, part_lengths):
+    # Append the coordinate blocks of one WKB geometry at offset to coords/part_lengths; returns (parts added, new offset)
+    order = '<' if struct.unpack_from('B', buf, offset)[0] == 1 else '>'
+    wkbtype = struct.unpack_from(order + 'I', buf, offset + 1)[0]
+    dims = 2
+    if wkbtype & 0x80000000:
+        dims += 1
+    if wkbtype & 0x40000000:
+        dims += 1
+    wkbtype &= 0x0FFFFFFF
+    dims += {0: 0, 1: 1, 2: 1, 3: 2}[wkbtype // 1000]
+    wkbtype %= 1000
+    offset += 5
+    dtype = numpy.dtype(order + 'f8')
+
+    def block(offset, count):
+        xy = numpy.frombuffer(buf, dtype, count * dims, offset).reshape(count, dims)[:, :2]
+        coords.append(xy)
+        part_lengths.append(count)
+        return offset + 8 * dims * count
+
+    if wkbtype == 1:
+        return 1, block(offset, 1)
+    if wkbtype == 2:
+        count = struct.unpack_from(order + 'I', buf, offset)[0]
+        return 1, block(offset + 4, count)
+    if wkbtype == 3:
+        rings = struct.unpack_from(order + 'I', buf, offset)[0]
+        offset += 4
+        for i in range(rings):
+            count = struct.unpack_from(order + 'I', buf, offset)[0]
+            offset = block(offset + 4, count)
+        return rings, offset
+    if wkbtype in (4, 5, 6, 7):
+        members = struct.unpack_from(order + 'I', buf, offset)[0]
+        offset += 4
+        total = 0
+        for i in range(members):
+            parts, offset = _decode(buf, offset, coords, part_lengths)
+            total += parts
+        return total, offset
+    raise ValueError("Unsupported WKB geometry type: " + str(wkbtype))
+
+def chunk_from_wkb(geometry_type, wkbs, attributes):
+    coords = []
+    part_lengths = []
+    feature_parts = []
+    for wkb in wkbs:
+        if wkb is None:
+            feature_parts.append(0)
+            continue
+        parts, offset = _decode(bytes(wkb), 0, coords, part_lengths)
+        feature_parts.append(parts)
+    xy = numpy.vstack(coords) if coords else numpy.empty((0, 2))
+    return FeatureChunk(geometry_type, numpy.ascontiguousarray(xy, dtype=float), _offsets(part_lengths), _offsets(feature_parts), attributes)
+
+def chunk_to_wkb(chunk):
+    # List of WKB geometries, one per feature of chunk
+    wkbs = []
+    coords = numpy.ascontiguousarray(chunk.coords, dtype='<f8')
+    for i in range(len(chunk)):
+        first, last = chunk.feature_offsets[i], chunk.feature_offsets[i + 1]
+        if chunk.geometry_type == 'POINT':
+            start = chunk.part_offsets[first]
+            wkbs.append(struct.pack('<BI', 1, 1) + coords[start].tobytes())
+            continue
+        if chunk.geometry_type == 'POLYGON':
+            pieces = [struct.pack('<BIIBII', 1, 6, 1, 1, 3, last - first)]
+            for p in range(first, last):
+                start, end = chunk.part_offsets[p], chunk.part_offsets[p + 1]
+                pieces.append(struct.pack('<I', end - start))
+                pieces.append(coords[start:end].tobytes())
+            wkbs.append(b''.join(pieces))
+            continue
+        pieces = [struct.pack('<BII', 1, 5, last - first)]
+        for p in range(first, last):
+            start, end = chunk.part_offsets[p], chunk.part_offsets[p + 1]
+            pieces.append(struct.pack('<BII', 1, 2, end - start))
+            pieces.append(coords[start:end].tobytes())
+        wkbs.append(b''.join(pieces))
+    return wkbs
+
+def read_chunks(dataset, fields=(), chunk_size=CHUNK_SIZE):
+    # Yield FeatureChunks of at most chunk_size features from dataset, in cursor order, with the listed attribute fields.
+    # The arcpy token OID@ reads the feature ID.
+    fields = list(fields)
+    gpkg = split_gpkg(dataset)
+    if gpkg:
+        conn, owned = connect(gpkg[0])
+        try:
+            geometry_type = {'POINT': 'POINT', 'MULTIPOLYGON': 'POLYGON', 'POLYGON': 'POLYGON'}.get(flow_gpkg.geometry_type(conn, gpkg[1]), 'POLYLINE')
+            columns = ''.join(', "{0}"'.format('fid' if name == 'OID@' else name) for name in fields)
+            sql = 'SELECT fid, geom{0} FROM "{1}" WHERE fid > ? ORDER BY fid LIMIT ?'.format(columns, gpkg[1])
+            # Page by fid rather than holding a cursor open, so the GeoPackage is not locked against writers between chunks
+            last = -1
+            while True:
+                rows = conn.execute(sql, (last, chunk_size)).fetchall()
+                if not rows:
+                    break
+                last = rows[-1][0]
+                wkbs = [flow_gpkg.wkb_from_blob(row[1]) for row in rows]
+                yield chunk_from_wkb(geometry_type, wkbs, dict((name, [row[j + 2] for row in rows]) for j, name in enumerate(fields)))
+        finally:
+            if owned:
+                conn.close()
+        return
+
+    import arcpy
+    geometry_type = {'Point': 'POINT', 'Polygon': 'POLYGON'}.get(arcpy.Describe(dataset).shapeType, 'POLYLINE')
+    with arcpy.da.SearchCursor(dataset, ['SHAPE@WKB'] + fields) as cursor:
+        rows = []
+        for row in cursor:
+            rows.append(row)
+            if len(rows) == chunk_size:
+                yield chunk_from_wkb(geometry_type, [r[0] for r in rows], dict((name, [r[j + 1] for r in rows]) for j, name in enumerate(fields)))
+                rows = []
+        if rows:
+            yield chunk_from_wkb(geometry_type, [r[0] for r in rows], dict((name, [r[j + 1] for r in rows]) for j, name in enumerate(fields)))
+
+class ChunkWriter(object):
+    # Writes whole FeatureChunks to a new dataset.  Use open_writer() to create one.
+
+    def __init__(self, dataset, geometry_type, fields, spatial_reference=None, template=None):
+        # fields: list of (name, arcpy field type, length) tuples
+        self.dataset = dataset
+        self.geometry_type = geometry_type
+        self.field_names = [field[0] for field in fields]
+        self.count = 0
+        gpkg = split_gpkg(dataset)
+        if gpkg:
+            self.conn, self.owned = connect(gpkg[0])
+            self.table = gpkg[1]
+            columns = list(fields)
+            template_gpkg = split_gpkg(template) if template else None
+            if template_gpkg:
+                tconn, towned = connect(template_gpkg[0])
+                for name, ftype in flow_gpkg.fields(tconn, template_gpkg[1]):
+                    if name not in self.field_names:
+                        columns.append((name, ftype, None))
+                if towned:
+                    tconn.close()
+            flow_gpkg.create_table(self.conn, self.table, GPKG_TYPES[geometry_type], [(c[0], c[1]) for c in columns], spatial_reference if spatial_reference is not None else -1)
+            self.cursor = None
+        else:
+            import arcpy
+            self.conn = None
+            workspace, name = os.path.split(str(dataset))
+            arcpy.CreateFeatureclass_management(workspace, name, geometry_type, template or "", "", "", spatial_reference)
+            existing = [f.name for f in arcpy.ListFields(dataset)]
+            for name, ftype, length in fields:
+                if name not in existing:
+                    arcpy.AddField_management(dataset, name, ftype, "", "", length)
+            self.cursor = arcpy.da.InsertCursor(dataset, ['SHAPE@WKB'] + self.field_names)
+        self.gpkg = gpkg is not None
+
+    def write(self, chunk):
+        wkbs = chunk_to_wkb(chunk)
+        values = [chunk.attributes[name] for name in self.field_names]
+        if self.gpkg:
+            srs_id = flow_gpkg.srs_id(self.conn, self.table)
+            columns = ''.join(', "{0}"'.format(name) for name in self.field_names)
+            marks = ', ?' * len(self.field_names)
+            rows = []
+            for i, wkb in enumerate(wkbs):
+                rows.append([_gpkg_blob(wkb, chunk, i, srs_id)] + [column[i] for column in values])
+            self.conn.executemany('INSERT INTO "{0}" (geom{1}) VALUES (?{2})'.format(self.table, columns, marks), rows)
+            self.conn.commit()
+        else:
+            for i, wkb in enumerate(wkbs):
+                self.cursor.insertRow([bytearray(wkb)] + [column[i] for column in values])
+        self.count += len(wkbs)
+
+    def close(self):
+        if self.conn is not None:
+            if self.owned:
+                self.conn.close()
+            self.conn = None
+        elif self.cursor is not None:
+            del self.cursor
+            self.cursor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+def _gpkg_blob(wkb, chunk, i, srs_id):
+    first, last = chunk.feature_offsets[i], chunk.feature_offsets[i + 1]
+    xy = chunk.coords[chunk.part_offsets[first]:chunk.part_offsets[last]]
+    return flow_gpkg.blob_from_wkb(wkb, (xy[:, 0].min(), xy[:, 1].min(), xy[:, 0].max(), xy[:, 1].max()), srs_id)
+
+def open_writer(dataset, geometry_type, fields, spatial_reference=None, template=None):
+    # Create dataset (replacing any existing one) and return a ChunkWriter for it.
+    #
+    # ARGUMENTS:
+    # dataset:              Output feature class path, or path/to/file.gpkg/table
+    # geometry_type:        "POINT", "POLYLINE" or "POLYGON"
+    # fields:               List of (name, arcpy field type, length) tuples to write
+    # spatial_reference:    arcpy spatial reference, or GeoPackage srs_id or flow_gpkg.spatial_ref_sys() row
+    # template:             Optional dataset whose fields the new dataset copies
+    return ChunkWriter(dataset, geometry_type, fields, spatial_reference, template)
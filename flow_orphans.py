@@ -0,0 +1,141 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_orphans.py
+# Purpose:     Orphan polygon merging for flow_area.py as a graph problem.  The
+#              edge-sharing graph of the cracked open water polygons is built
+#              once by hashing every ring segment on its two endpoints, and
+#              orphans (polygons no longer touching a flowline) are grouped with
+#              their neighbours in a single union-find pass, in place of the
+#              repeated SHARE_A_LINE_SEGMENT_WITH selections and Dissolve.
+#              NumPy only; does not require arcpy or shapely.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+#-------------------------------------------------------------------------------
+#
+# Polygons are passed as a flow_io.FeatureChunk, every ring of every polygon being a part.  The grouping reproduces
+# the selection flow_area has always made:
+#   1. orphans are the polygons that do not intersect a flowline
+#   2. the selection is the orphans and every polygon sharing a line segment with one
+#   3. with thiessen True, polygons intersecting a split point are removed from the selection (Thiessen polygons win)
+#   4. selected polygons sharing a key (the FID of the Thiessen polygon or of the cutline polygon they came from) are
+#      merged into one feature; unselected polygons are kept as they are
+
+import math
+import numpy
+import flow_geom
+
+class UnionFind(object):
+    # Disjoint sets over the integers 0..count-1
+
+    def __init__(self, count):
+        self.parent = list(range(count))
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+        return min(i, j)
+
+def chunk_segments(chunk):
+    # (starts, ends, cells): the (S, 2) start and end points of every ring segment of a polygon chunk, and the
+    # feature each belongs to
+    part_lengths = numpy.diff(chunk.part_offsets)
+    part_of = numpy.repeat(numpy.arange(len(part_lengths)), part_lengths)
+    feature_of = numpy.repeat(numpy.arange(len(chunk)), numpy.diff(chunk.feature_offsets))
+    same_part = numpy.nonzero(part_of[:-1] == part_of[1:])[0]
+    return chunk.coords[same_part], chunk.coords[same_part + 1], feature_of[part_of[same_part]]
+
+def _collinear_overlap(a1, a2, b1, b2, tolerance):
+    # True if segment b lies along segment a, within tolerance, and the two overlap by more than tolerance
+    dx, dy = a2[0] - a1[0], a2[1] - a1[1]
+    length = math.hypot(dx, dy)
+    if length <= tolerance:
+        return False
+    offsets = []
+    for px, py in (b1, b2):
+        if abs(dx * (py - a1[1]) - dy * (px - a1[0])) / length > tolerance:
+            return False
+        offsets.append((dx * (px - a1[0]) + dy * (py - a1[1])) / length)
+    return min(length, max(offsets)) - max(0.0, min(offsets)) > tolerance
+
+def shared_edges(starts, ends, cells, tolerance, check=None):
+    # Index arrays (i, j), i < j, of the pairs of cells whose outlines share a segment.  Segments are hashed on their two
+    # endpoints snapped to the XY tolerance, in sorted order, so that a segment matches its reverse in the neighbouring
+    # ring.  Segments of the cells flagged in the boolean array check that match nothing are then compared with the other
+    # unmatched segments for a collinear overlap, which catches neighbours whose common edge has a vertex on one side only.
+    snapped = numpy.round(numpy.hstack((starts, ends)) / tolerance).astype(numpy.int64)
+    swap = (snapped[:, 0] > snapped[:, 2]) | ((snapped[:, 0] == snapped[:, 2]) & (snapped[:, 1] > snapped[:, 3]))
+    snapped[swap] = snapped[swap][:, [2, 3, 0, 1]]
+    keep = numpy.nonzero((snapped[:, 0] != snapped[:, 2]) | (snapped[:, 1] != snapped[:, 3]))[0]
+    if not len(keep):
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+    inverse = numpy.unique(snapped[keep], axis=0, return_inverse=True)[1].reshape(-1)
+    order = numpy.argsort(inverse, kind='mergesort')
+    sizes = numpy.bincount(inverse)
+    bounds = numpy.concatenate(([0], numpy.cumsum(sizes)))
+    segment_cells = cells[keep][order]
+    # Each edge of a partition is normally shared by exactly two rings
+    twos = bounds[:-1][sizes == 2]
+    i, j = [segment_cells[twos]], [segment_cells[twos + 1]]
+    for start, end in zip(bounds[:-1][sizes > 2], bounds[1:][sizes > 2]):
+        group = numpy.unique(segment_cells[start:end])
+        a, b = numpy.triu_indices(len(group), 1)
+        i.append(group[a])
+        j.append(group[b])
+    if check is not None and numpy.any(check):
+        lonely = keep[order[bounds[:-1][sizes == 1]]]
+        i_extra, j_extra = _overlapping(starts[lonely], ends[lonely], cells[lonely], tolerance, check)
+        i.append(i_extra)
+        j.append(j_extra)
+    i, j = numpy.concatenate(i), numpy.concatenate(j)
+    pairs = numpy.unique(numpy.column_stack((numpy.minimum(i, j), numpy.maximum(i, j))), axis=0)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    return pairs[:, 0], pairs[:, 1]
+
+def _overlapping(starts, ends, cells, tolerance, check):
+    # Cell pairs from unmatched segments of the cells in check lying along unmatched segments of other cells
+    if not len(cells):
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+    lo = numpy.minimum(starts, ends) - tolerance
+    hi = numpy.maximum(starts, ends) + tolerance
+    bboxes = numpy.hstack((lo, hi)).tolist()
+    spans = numpy.max(hi - lo, axis=1)
+    index = flow_geom.GridIndex(max(float(numpy.mean(spans)), tolerance))
+    for k, bbox in enumerate(bboxes):
+        index.insert(k, bbox)
+    a, b = starts.tolist(), ends.tolist()
+    found_i, found_j = [], []
+    for k in numpy.nonzero(check[cells])[0].tolist():
+        for other in index.query(bboxes[k]):
+            if cells[other] != cells[k] and _collinear_overlap(a[k], b[k], a[other], b[other], tolerance):
+                found_i.append(cells[k])
+                found_j.append(cells[other])
+    return numpy.array(found_i, dtype=int), numpy.array(found_j, dtype=int)
+
+def orphan_groups(chunk, keys, on_flowline, on_split_point, thiessen, tolerance):
+    # Group the polygons of chunk as described above.  keys lists each polygon's key; on_flowline and on_split_point are
+    # boolean arrays marking the polygons that intersect a flowline or a split point.  Returns (selected, groups):
+    # a boolean array of the polygons merged with others, and for each polygon the lowest index in its group.
+    count = len(chunk)
+    orphan = ~numpy.asarray(on_flowline, dtype=bool)
+    starts, ends, cells = chunk_segments(chunk)
+    i, j = shared_edges(starts, ends, cells, tolerance, check=orphan)
+    selected = orphan.copy()
+    selected[i[orphan[j]]] = True
+    selected[j[orphan[i]]] = True
+    if str(thiessen).lower() == 'true':
+        selected &= ~numpy.asarray(on_split_point, dtype=bool)
+    groups = UnionFind(count)
+    first = {}
+    for c in numpy.nonzero(selected)[0].tolist():
+        groups.union(first.setdefault(keys[c], c), c)
+    return selected, numpy.array([groups.find(c) for c in range(count)], dtype=int)
@@ -0,0 +1,352 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_parallel.py
+# Purpose:     Partitioned execution of flow_area() across a process pool.  The
+#              study area is split into connected water bodies, grouped by a
+#              grid (or by user-supplied tiles), each partition runs the full
+#              flow_area() chain in its own
+#              worker process and scratch workspace, and the results are stitched
+#              together by DWUNIQUE.  Runs on either flow_backend backend.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+#-------------------------------------------------------------------------------
+#
+# A partition's water bodies can be affected by their neighbours: cutlines reach cutline_distance from the flowline
+# ends, and a Thiessen polygon seeded on one water body's flowlines can reach into another.  Each partition therefore
+# runs on its own water bodies plus a halo of every water body whose extent lies within cutline_distance of theirs, and
+# its output is clipped back to its own water bodies.  After the run, the partition measures how far its Thiessen
+# polygons reach from their seeds into its own water bodies.  If they reach as far as a water body left out of the run,
+# the partition is run again with the halo widened to that reach.  More seeds can only shorten the reach, so one rerun
+# is enough.  Halo water bodies are run in full, so partitions group neighbouring water bodies, by default about four
+# per worker, to keep the halos a small part of each run.
+#
+# The inputs are read once, up front, for the extents of their features.  Each partition then copies only the features
+# whose extents come within the XY tolerance of its water bodies' extents, by feature ID, before selecting those that
+# intersect them.  As the feature IDs are read through the input layers, the layers' definition queries carry over.
+
+import os, sys, math, traceback, tempfile, shutil, json, multiprocessing, numpy
+import flow_area, flow_cache, flow_backend, flow_io
+
+INPUTS = ('nhdar', 'fl', 'upstr', 'dnstr', 'all_fl')
+
+class PartitionError(Exception):
+    # Raised by flow_area_partitioned() when a partition fails and partial output was not allowed
+    pass
+
+def partition_water_bodies(gp, input_nhd_area_polys, input_flow_lines, workspace, tiles=None, count=None):
+    # Function to dissolve NHD area polygons that intersect artificial-path flowlines into connected water bodies and group them into partitions.
+    #
+    # ARGUMENTS:
+    # gp:                   flow_backend.Backend to run the operations with
+    # input_nhd_area_polys: Feature class or layer containing NHD area polgyons
+    # input_flow_lines:     Feature class or layer containing upstream-downstream flowlines
+    # workspace:            Workspace to write the water bodies to.  Must be readable by the worker processes
+    # tiles:                Optional feature class of tile polygons.  If supplied, each water body is assigned to the tile containing the centre of its extent
+    # count:                Without tiles, the number of cells of a grid over the water bodies to group them by, each water body going to the cell containing
+    #                       the centre of its extent.  By default each water body is its own partition
+    #
+    # Returns the path of the water body dataset, which numbers the water bodies from 0 in its BODY field, and a list of partitions,
+    # each a sorted list of BODY numbers, in a deterministic order.
+
+    gp.clear_selection(input_nhd_area_polys)
+    gp.clear_selection(input_flow_lines)
+    part = lambda name: flow_io.output_path(workspace, name)
+    gp.select(input_flow_lines, "FCode = 55800", part("pf_swpt_part_fl"))
+    gp.select_by_location(input_nhd_area_polys, [("NEW_SELECTION", "INTERSECT", part("pf_swpt_part_fl"), False)], part("pf_swpt_part_nhdar"))
+    gp.dissolve(part("pf_swpt_part_nhdar"), part("pf_swpt_part_diss"), multi_part=False)
+
+    bodies = flow_io.concatenate(list(flow_io.read_chunks(part("pf_swpt_part_diss"))))
+    bodies.attributes = {'BODY': list(range(len(bodies)))}
+    spatialRef = flow_io.describe(part("pf_swpt_part_diss"))[1]
+    with flow_io.open_writer(part("pf_swpt_part_bodies"), "POLYGON", [('BODY', 'LONG', None)], spatialRef) as writer:
+        writer.write(bodies)
+
+    groups = {}
+    extents = feature_extents(bodies)
+    centres = (extents[:, :2] + extents[:, 2:]) / 2.0
+    if tiles:
+        offsets = numpy.arange(len(bodies) + 1, dtype=numpy.int64)
+        with flow_io.open_writer(part("pf_swpt_part_centres"), "POINT", [('BODY', 'LONG', None)], spatialRef) as writer:
+            writer.write(flow_io.FeatureChunk('POINT', centres, offsets, offsets, {'BODY': list(range(len(bodies)))}))
+        gp.spatial_join(part("pf_swpt_part_centres"), tiles, part("pf_swpt_part_tiles"), "WITHIN")
+        tile_of = {}
+        for chunk in flow_io.read_chunks(part("pf_swpt_part_tiles"), ['BODY', 'JOIN_FID']):
+            for body, tile in zip(chunk.attributes['BODY'], chunk.attributes['JOIN_FID']):
+                tile_of[body] = min(tile, tile_of.get(body, tile))
+        # Water bodies whose centre is in no tile make up one more partition
+        for body in range(len(bodies)):
+            groups.setdefault(tile_of.get(body, -1), []).append(body)
+    elif count and len(bodies):
+        for body, cell in enumerate(grid_cells(extents, centres, count)):
+            groups.setdefault(cell, []).append(body)
+    else:
+        for body in range(len(bodies)):
+            groups.setdefault(body, []).append(body)
+    return part("pf_swpt_part_bodies"), [sorted(groups[key]) for key in sorted(groups)]
+
+def feature_extents(chunk):
+    # (N, 4) array of the (xmin, ymin, xmax, ymax) extent of each feature of a flow_io.FeatureChunk, NaN for features without vertices
+    extents = numpy.full((len(chunk), 4), numpy.nan)
+    starts = chunk.part_offsets[chunk.feature_offsets[:-1]]
+    nonempty = chunk.part_offsets[chunk.feature_offsets[1:]] > starts
+    if nonempty.any():
+        extents[nonempty] = numpy.hstack((numpy.minimum.reduceat(chunk.coords, starts[nonempty]), numpy.maximum.reduceat(chunk.coords, starts[nonempty])))
+    return extents
+
+def grid_cells(extents, points, count):
+    # Cell number of each point in a grid of about count cells, as close to square as the overall extent allows, over the extents
+    lo, hi = extents[:, :2].min(axis=0), extents[:, 2:].max(axis=0)
+    size = numpy.maximum(hi - lo, 1e-12)
+    columns = int(min(count, max(1, round(math.sqrt(count * size[0] / size[1])))))
+    rows = max(1, count // columns)
+    column = numpy.minimum(((points[:, 0] - lo[0]) / size[0] * columns).astype(int), columns - 1)
+    row = numpy.minimum(((points[:, 1] - lo[1]) / size[1] * rows).astype(int), rows - 1)
+    return (row * columns + column).tolist()
+
+def input_extents(dataset):
+    # (delimited feature ID field, feature IDs, (N, 4) extents) of the features of a dataset, read one chunk at a time
+    oids = []
+    extents = [numpy.empty((0, 4))]
+    for chunk in flow_io.read_chunks(dataset, ['OID@']):
+        oids.extend(chunk.attributes['OID@'])
+        extents.append(feature_extents(chunk))
+    return flow_io.oid_field(dataset), numpy.array(oids, dtype=numpy.int64), numpy.vstack(extents)
+
+def split_where(oid_field, oids, extents, region, tolerance):
+    # Where clause selecting the features whose extents come within tolerance of any of the extents in region
+    near = numpy.zeros(len(oids), dtype=bool)
+    for xmin, ymin, xmax, ymax in region:
+        near |= (extents[:, 0] <= xmax + tolerance) & (extents[:, 2] >= xmin - tolerance) & (extents[:, 1] <= ymax + tolerance) & (extents[:, 3] >= ymin - tolerance)
+    if not near.any():
+        return "{0} < 0".format(oid_field)
+    return "{0} IN ({1})".format(oid_field, ",".join(str(oid) for oid in oids[near]))
+
+def halo(extents, own, distance):
+    # The water bodies, other than own, whose extents lie within distance of the extent of one of own, and the distance
+    # to the nearest extent of those left out (infinite if none are)
+    gap = numpy.full(len(extents), numpy.inf)
+    for body in own:
+        dx = numpy.maximum(numpy.maximum(extents[:, 0] - extents[body, 2], extents[body, 0] - extents[:, 2]), 0.0)
+        dy = numpy.maximum(numpy.maximum(extents[:, 1] - extents[body, 3], extents[body, 1] - extents[:, 3]), 0.0)
+        gap = numpy.minimum(gap, numpy.hypot(dx, dy))
+    gap[own] = -1.0
+    included = numpy.nonzero((gap >= 0.0) & (gap <= distance))[0]
+    excluded = gap[gap > distance]
+    return included.tolist(), float(excluded.min()) if len(excluded) else float('inf')
+
+def thiessen_reach(workspace, extents, densify_spacing):
+    # How far the Thiessen polygons of a flow_area() run whose intermediates were kept in workspace reach from their seeds into the given extents
+    import flow_thiessen
+    lines = [flow_io.output_path(workspace, name) for name in ("pf_swpt_all_fl_filt_nhdarclip", "pf_swpt_nhdfl6mi_nhdarclip")]
+    bbox = flow_io.extent(flow_io.output_path(workspace, "pf_swpt_nhdar_cut"))
+    spacing = flow_area.thiessen_spacing(lines[0], bbox, densify_spacing)
+    seeds = [numpy.empty((0, 2))]
+    for lines_fc in lines:
+        for chunk in flow_io.read_chunks(lines_fc):
+            seeds.append(flow_thiessen.densify_vertices(chunk.lines(), [None] * len(chunk), spacing)[0])
+    cells = [feature[0] for chunk in flow_io.read_chunks(flow_io.output_path(workspace, "pf_swpt_vert_all_th")) for feature in chunk.lines() if feature]
+    return flow_thiessen.cell_reach(cells, numpy.vstack(seeds), extents)
+
+def save_features(gp, datasets, directory, name):
+    # Copy datasets into a new workspace called name in directory, keeping their names
+    workspace = gp.create_workspace(directory, name)
+    for dataset in datasets:
+        gp.copy(dataset, flow_io.output_path(workspace, os.path.basename(str(dataset))))
+    return workspace
+
+def run_partition(job):
+    # Worker function: copy the inputs that fall within one partition and its halo into a scratch workspace, run flow_area() on them and clip the output to the partition's own water bodies.
+    #
+    # ARGUMENTS:
+    # job:                  Dictionary describing the partition, as built by flow_area_partitioned()
+    #
+    # Returns a tuple of (partition index, output dataset path or None, error message or None, whether the output came from the cache,
+    # and None or, if the Thiessen polygons reach as far as a water body outside the halo, how far they reach)
+
+    index = job['index']
+    try:
+        gp = flow_backend.make_backend(job['backend'], job['nhdar'])
+        workspace = gp.create_workspace(job['scratch'], "partition_{0}".format(index))
+        gp.use_workspace(workspace)
+        part = lambda name: flow_io.output_path(workspace, name)
+
+        gp.select(job['bodies'], "BODY IN ({0})".format(",".join(str(body) for body in job['own'] + job['halo'])), part("part_bodies"))
+        gp.select(job['bodies'], "BODY IN ({0})".format(",".join(str(body) for body in job['own'])), part("part_own"))
+        copies = []
+        for name in INPUTS:
+            gp.select(job[name], job['where'][name], part("part_" + name + "_near"))
+            gp.select_by_location(part("part_" + name + "_near"), [("NEW_SELECTION", "INTERSECT", part("part_bodies"), False)], part("part_" + name))
+            copies.append(part("part_" + name))
+        output = part("part_output")
+
+        # Reuse the cached output if this partition's inputs and parameters are unchanged since it was last run
+        cache = None
+        if job['cache_dir']:
+            cache = flow_cache.StageCache(job['cache_dir'], job['cache_max_bytes'])
+            params = {'thiessen': str(job['thiessen']).lower(), 'cutline_distance': job['cutline_distance'], 'densify_spacing': job['densify_spacing'],
+                      'label_cells': str(job['label_cells']).lower(), 'backend': gp.name}
+            key = flow_cache.cache_key("flow_area", [flow_cache.fingerprint(dataset) for dataset in copies + [part("part_own")]], params)
+            entry = cache.get(key)
+            if entry:
+                gp.copy(flow_io.output_path(os.path.join(entry, "output" + gp.workspace_extension), "part_output"), output)
+                return (index, output, None, True, None)
+
+        # The partition workspace is already private to this worker, so intermediates can stay in it
+        flow_area.flow_area(copies[0], copies[1], copies[2], copies[3], copies[4], job['thiessen'], job['cutline_distance'], job['densify_spacing'], "keep",
+                            output_features="part_flow_area", backend=job['backend'], raise_errors=True, label_cells=job['label_cells'])
+        if job['clearance'] != float('inf'):
+            reach = thiessen_reach(workspace, job['extents'], job['densify_spacing'])
+            if reach >= job['clearance']:
+                return (index, None, None, False, reach)
+        gp.clip(part("part_flow_area"), part("part_own"), output)
+        if cache:
+            cache.put(key, lambda entry: save_features(gp, [output], entry, "output"))
+        return (index, output, None, False, None)
+    except:
+        return (index, None, traceback.format_exc(), False, None)
+
+def run_partitions(jobs, workers):
+    if workers <= 1 or len(jobs) <= 1:
+        return [run_partition(job) for job in jobs]
+    if os.name == 'nt':
+        # Spawned workers must start the standalone interpreter, not the ArcGIS application hosting this script
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+    pool = multiprocessing.Pool(processes=min(workers, len(jobs)))
+    try:
+        return pool.map(run_partition, jobs, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def flow_area_partitioned(input_nhd_area_polys, input_flow_lines, input_upstr_pts, input_dnstr_pts, input_all_flow_lines, thiessen, workers=None, tiles=None, partitions=None, output_features="pf_swpt_nhdar_all_fl_clip", cutline_distance=2000, densify_spacing=10, keep_scratch=False, cache_dir=None, cache_max_bytes=10 * 1024 ** 3, backend=None, label_cells=True, allow_partial=False):
+    # Function to run flow_area() once per connected water body (or tile) in parallel and stitch the results together.
+    #
+    # ARGUMENTS:
+    # input_nhd_area_polys ... thiessen:    As for flow_area.flow_area()
+    # workers:              Number of worker processes.  Defaults to the number of CPUs; 1 runs every partition in this process
+    # tiles:                Optional feature class of tile polygons used to group water bodies into partitions
+    # partitions:           Without tiles, about how many partitions to group the water bodies into, by a grid over their extent.  Defaults to
+    #                       four per worker; 0 makes each water body its own partition
+    # output_features:      Output feature class name, created in the workspace of input_nhd_area_polys
+    # cutline_distance, densify_spacing:    As for flow_area.flow_area()
+    # keep_scratch:         Boolean indicating whether to keep the scratch workspaces (partitioning, stitching and per-partition intermediates) for inspection
+    # cache_dir:            Optional cache directory for incremental runs.  The partitioning and each partition's output are cached under a
+    #                       fingerprint of their inputs and parameters, so a re-run only recomputes the water bodies whose inputs changed
+    # cache_max_bytes:      Size limit of cache_dir; least recently used entries are evicted beyond it
+    # backend, label_cells: As for flow_area.flow_area(), except that backend must be a name, as it is passed to the worker processes
+    # allow_partial:        Boolean indicating whether to stitch the outputs of the partitions that succeeded when others fail, with a warning for each
+    #                       failure.  By default any failed partition raises PartitionError, as the output would be missing its water bodies
+    #
+    # DWUNIQUE values that occur in more than one partition are merged into a single multipart feature.  Partition outputs are merged in
+    # ascending partition order before the final dissolve, so the result does not depend on which worker finishes first.
+
+    gp = flow_backend.make_backend(backend, input_nhd_area_polys)
+    backend = gp.name
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if partitions is None:
+        partitions = 4 * workers
+    output = flow_io.output_path(flow_io.describe(input_nhd_area_polys)[0], output_features)
+
+    # Partitioning and stitching intermediates live in a scratch workspace next to the partition workspaces
+    scratch = tempfile.mkdtemp(prefix="pf_swpt_")
+    try:
+        shared = gp.create_workspace(scratch, "shared")
+        gp.use_workspace(shared)
+
+        gp.add_message("  Partitioning NHD area polygons into connected water bodies...")
+        if cache_dir:
+            cache = flow_cache.StageCache(cache_dir, cache_max_bytes)
+            fingerprints = [flow_cache.fingerprint(fc) for fc in (input_nhd_area_polys, input_flow_lines)]
+            fingerprints.append(flow_cache.fingerprint(tiles) if tiles else "")
+            key = flow_cache.cache_key("partition", fingerprints, {'backend': backend, 'partitions': 0 if tiles else partitions})
+            entry = cache.get(key)
+            if entry:
+                bodies = flow_io.output_path(shared, "pf_swpt_part_bodies")
+                gp.copy(flow_io.output_path(os.path.join(entry, "partition" + gp.workspace_extension), "pf_swpt_part_bodies"), bodies)
+                with open(os.path.join(entry, "partitions.json")) as f:
+                    groups = json.load(f)
+            else:
+                bodies, groups = partition_water_bodies(gp, input_nhd_area_polys, input_flow_lines, shared, tiles, partitions)
+                def save(entry):
+                    save_features(gp, [bodies], entry, "partition")
+                    with open(os.path.join(entry, "partitions.json"), 'w') as f:
+                        json.dump(groups, f)
+                cache.put(key, save)
+        else:
+            bodies, groups = partition_water_bodies(gp, input_nhd_area_polys, input_flow_lines, shared, tiles, partitions)
+        gp.add_message("  {0} partitions".format(len(groups)))
+
+        extents = feature_extents(flow_io.concatenate(list(flow_io.read_chunks(bodies))))
+        inputs = (input_nhd_area_polys, input_flow_lines, input_upstr_pts, input_dnstr_pts, input_all_flow_lines)
+        tolerance = flow_io.describe(input_nhd_area_polys)[2]
+        for fc in inputs:
+            gp.clear_selection(fc)
+        splits = [input_extents(fc) for fc in inputs]
+        def split(job):
+            # Where clauses of the features of each input near the partition's water bodies and halo
+            region = extents[job['own'] + job['halo']]
+            job['where'] = dict((name, split_where(oid_field, oids, fc_extents, region, tolerance)) for name, (oid_field, oids, fc_extents) in zip(INPUTS, splits))
+        jobs = []
+        for index, own in enumerate(groups):
+            included, clearance = halo(extents, own, float(cutline_distance))
+            job = {'index': index, 'own': own, 'halo': included, 'clearance': clearance, 'extents': extents[own].tolist(),
+                   'bodies': bodies, 'scratch': scratch,
+                   'thiessen': thiessen, 'cutline_distance': cutline_distance, 'densify_spacing': densify_spacing,
+                   'backend': backend, 'label_cells': label_cells,
+                   'cache_dir': cache_dir, 'cache_max_bytes': cache_max_bytes}
+            job.update(zip(INPUTS, [flow_io.catalog_path(fc) for fc in inputs]))
+            split(job)
+            jobs.append(job)
+
+        results = []
+        pending = jobs
+        while pending:
+            rerun = []
+            for index, output_fc, error, cached, reach in run_partitions(pending, workers):
+                if reach is None:
+                    results.append((index, output_fc, error, cached))
+                    continue
+                job = jobs[index]
+                gp.add_message("  Partition {0}: Thiessen polygons reach {1:.1f} from their seeds, as far as a water body outside its halo; widening the halo".format(index, reach))
+                job['halo'], job['clearance'] = halo(extents, job['own'], reach)
+                split(job)
+                job['scratch'] = tempfile.mkdtemp(prefix="rerun_", dir=scratch)
+                rerun.append(job)
+            pending = rerun
+
+        outputs = []
+        failed = 0
+        for index, output_fc, error, cached in sorted(results):
+            if error:
+                failed += 1
+                (gp.add_warning if allow_partial else gp.add_error)("  Partition {0} failed: {1}".format(index, error))
+            elif output_fc:
+                outputs.append(output_fc)
+        if cache_dir:
+            gp.add_message("  {0} of {1} partitions reused from cache".format(len([result for result in results if result[3]]), len(results)))
+        if failed and not (allow_partial and outputs):
+            raise PartitionError("{0} of {1} partitions failed".format(failed, len(results)))
+        if not outputs:
+            gp.add_error("  No partition produced output")
+            return None
+
+        gp.use_workspace(shared)
+        gp.add_message("  Stitching {0} partition outputs by DWUNIQUE...".format(len(outputs)))
+        gp.merge(outputs, flow_io.output_path(shared, "pf_swpt_part_merged"))
+        gp.dissolve(flow_io.output_path(shared, "pf_swpt_part_merged"), output, "DWUNIQUE")
+        return output
+    finally:
+        if not keep_scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+if __name__ == '__main__':
+    # Tool parameters are those of flow_area.py followed by the worker count, an optional tile feature class and an optional cache directory
+    import arcpy
+    argv = [arcpy.GetParameterAsText(i) for i in range(arcpy.GetArgumentCount())]
+    workers = int(argv[6]) if len(argv) > 6 and argv[6] else None
+    tiles = argv[7] if len(argv) > 7 and argv[7] else None
+    cache_dir = argv[8] if len(argv) > 8 and argv[8] else None
+    flow_area_partitioned(*argv[:6], workers=workers, tiles=tiles, cache_dir=cache_dir)
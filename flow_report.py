@@ -0,0 +1,167 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_report.py
+# Purpose:     Per-stage timing and resource instrumentation for flow_area.py.
+#              Records wall time, CPU time, peak resident memory, intermediate
+#              bytes written and input/output feature and vertex counts for each
+#              stage, and writes the result as JSON or CSV.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+#-------------------------------------------------------------------------------
+
+import os, sys, time, json, csv, cProfile, collections
+
+def peak_rss():
+    # Peak resident set size of this process in bytes, or None if it cannot be determined
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except Exception:
+        pass
+    return None
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+def arcpy_counter(count_vertices=False):
+    # Return a counter that gives (features, vertices) for an arcpy dataset or layer.  Vertex counting reads every
+    # geometry, so it is off by default and vertices are reported as None.
+    def counter(dataset):
+        import arcpy
+        features = int(arcpy.GetCount_management(dataset).getOutput(0))
+        vertices = None
+        if count_vertices:
+            vertices = 0
+            with arcpy.da.SearchCursor(dataset, ['SHAPE@']) as rows:
+                for row in rows:
+                    if row[0] is not None:
+                        vertices += row[0].pointCount
+        return features, vertices
+    return counter
+
+class RunReport(object):
+    # Collects one record per stage.  Stages are opened with begin() and closed with end(); a stage begun while another
+    # is open is recorded as a sub-stage named "parent/child".
+    #
+    # ARGUMENTS:
+    # counter:              Optional callable(dataset) returning (features, vertices) used for dataset names passed to begin()/end().
+    #                       None skips counting, which is how the hooks are used with the geoprocessing calls stubbed out.
+    # profile_stage:        Optional stage name to run under cProfile
+    # profile_path:         Where to write the cProfile statistics for profile_stage.  Defaults to "<stage>.prof"
+
+    #
+    # process_peak_rss_bytes is the process's peak resident memory so far when the stage ended, so stages after the
+    # most memory-hungry one repeat it.  peak_rss_growth_bytes is how far the stage raised that peak, which is zero for
+    # a stage that stayed under the peak of an earlier one.
+
+    FIELDS = ['stage', 'wall_s', 'cpu_s', 'process_peak_rss_bytes', 'peak_rss_growth_bytes', 'bytes_written', 'input_features', 'input_vertices', 'output_features', 'output_vertices']
+
+    def __init__(self, counter=None, profile_stage=None, profile_path=None):
+        self.counter = counter
+        self.profile_stage = profile_stage
+        self.profile_path = profile_path
+        self.store = None
+        self.records = []
+        self.started = time.time()
+        self._open = []
+        self._profiler = None
+
+    def attach(self, store):
+        # Take per-stage bytes written from a flow_store.IntermediateStore
+        self.store = store
+
+    def _count(self, datasets):
+        # Sum (features, vertices) over datasets.  Entries may be dataset names, or (features, vertices) tuples for in-memory data.
+        features, vertices = 0, 0
+        for dataset in datasets or ():
+            if isinstance(dataset, tuple):
+                counts = dataset
+            elif self.counter is None:
+                return None, None
+            else:
+                try:
+                    counts = self.counter(dataset)
+                except Exception:
+                    return None, None
+            features = None if features is None or counts[0] is None else features + counts[0]
+            vertices = None if vertices is None or counts[1] is None else vertices + counts[1]
+        return features, vertices
+
+    def begin(self, stage, inputs=None):
+        name = self._open[-1]['stage'] + "/" + stage if self._open else stage
+        record = collections.OrderedDict((field, None) for field in self.FIELDS)
+        record['stage'] = name
+        record['input_features'], record['input_vertices'] = self._count(inputs)
+        record['_wall'] = time.time()
+        record['_cpu'] = cpu_time()
+        record['_peak'] = peak_rss()
+        self._open.append(record)
+        if self.profile_stage in (stage, name) and self._profiler is None:
+            self._profiler = (name, cProfile.Profile())
+            self._profiler[1].enable()
+
+    def end(self, outputs=None):
+        record = self._open.pop()
+        record['wall_s'] = time.time() - record.pop('_wall')
+        record['cpu_s'] = cpu_time() - record.pop('_cpu')
+        if self._profiler is not None and self._profiler[0] == record['stage']:
+            self._profiler[1].disable()
+            self._profiler[1].dump_stats(self.profile_path or record['stage'].replace("/", "_") + ".prof")
+            self._profiler = None
+        peak = record.pop('_peak')
+        record['process_peak_rss_bytes'] = peak_rss()
+        if peak is not None and record['process_peak_rss_bytes'] is not None:
+            record['peak_rss_growth_bytes'] = record['process_peak_rss_bytes'] - peak
+        if self.store is not None and not self._open:
+            record['bytes_written'] = self.store.end_stage(record['stage'])
+        record['output_features'], record['output_vertices'] = self._count(outputs)
+        self.records.append(record)
+        return record
+
+    def abort(self):
+        # Close any stages left open by an error, so the report still shows how far the run got
+        while self._open:
+            self.end()
+
+    def summary(self):
+        return {'started': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                'total_wall_s': sum(record['wall_s'] for record in self.records if "/" not in record['stage']),
+                'stages': self.records}
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_csv(self, path):
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, self.FIELDS, lineterminator='\n')
+            writer.writeheader()
+            for record in self.records:
+                writer.writerow(record)
+
+    def write(self, path):
+        # Write JSON or CSV depending on the extension of path
+        if path.lower().endswith('.csv'):
+            self.write_csv(path)
+        else:
+            self.write_json(path)
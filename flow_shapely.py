@@ -0,0 +1,484 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_shapely.py
+# Purpose:     Geoprocessing backend for flow_area.py built on shapely/GEOS and
+#              NumPy, operating on GeoPackage tables.  Runs headless without
+#              arcpy.  Requires shapely 2.0 or later.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+#-------------------------------------------------------------------------------
+#
+# Datasets are GeoPackage tables named path/to/file.gpkg/table, or bare table names in the workspace given to
+# use_workspace().  Outputs are written with new feature IDs, as the arcpy tools do.  Spatial relationships follow the
+# arcpy overlap types:
+#   INTERSECT:                      within the XY tolerance of each other
+#   WITHIN / CONTAINS:              covered by / covers, within the XY tolerance
+#   BOUNDARY_TOUCHES:               the input's boundary (line endpoints, polygon outline) within the XY tolerance of the other's outline
+#   CROSSED_BY_THE_OUTLINE_OF:      the outlines cross at points (lines sharing a segment do not count)
+#   SHARE_A_LINE_SEGMENT_WITH:      the outlines share a segment
+
+import os, math
+import numpy
+import shapely
+from shapely.geometry import MultiLineString, MultiPolygon
+import flow_gpkg, flow_io, flow_orphans
+from flow_backend import Backend, ExecuteError
+
+DIMENSIONS = {'POINT': 0, 'MULTIPOINT': 0, 'LINESTRING': 1, 'MULTILINESTRING': 1, 'POLYGON': 2, 'MULTIPOLYGON': 2}
+TABLE_TYPES = {0: 'POINT', 1: 'MULTILINESTRING', 2: 'MULTIPOLYGON'}
+
+class Table(object):
+    # Features of a dataset in memory: fields as (name, arcpy field type), the flow_gpkg.spatial_ref_sys() row as srs_id,
+    # and parallel fids, shapely geometries and value lists
+
+    def __init__(self, geometry_type, fields, srs_id, fids, geoms, values):
+        self.geometry_type = geometry_type
+        self.fields = fields
+        self.srs_id = srs_id
+        self.fids = fids
+        self.geoms = geoms
+        self.values = values
+
+    def dimension(self):
+        return DIMENSIONS[self.geometry_type]
+
+def _ground_area(polygon, meters, geographic):
+    # Area of a polygon in square meters: scaled by the meters per unit of projected data, and for geographic data by the
+    # length of a degree of latitude and of longitude at the polygon's latitude.  Data with an unknown coordinate system is
+    # taken to be in meters.
+    area = polygon.area
+    if meters:
+        return area * meters ** 2
+    if geographic:
+        latitude = math.radians(min(abs(polygon.centroid.y), 89.0))
+        return area * flow_io.METERS_PER_DEGREE ** 2 * math.cos(latitude)
+    return area
+
+def _parts(geom):
+    # Single-part geometries making up geom, however deeply nested
+    parts = []
+    for part in shapely.get_parts(geom):
+        if part.geom_type.startswith('Multi') or part.geom_type == 'GeometryCollection':
+            parts.extend(_parts(part))
+        elif not part.is_empty:
+            parts.append(part)
+    return parts
+
+def _extract(geom, dimension):
+    # The parts of geom of the given dimension as a single geometry, or None if there are none
+    if geom is None:
+        return None
+    parts = [part for part in _parts(geom) if shapely.get_dimensions(part) == dimension]
+    if not parts:
+        return None
+    if dimension == 2:
+        return MultiPolygon(parts)
+    if dimension == 1:
+        return MultiLineString(parts)
+    return parts[0] if len(parts) == 1 else shapely.multipoints(parts)
+
+def _outline(geoms):
+    # Polygons replaced by their boundaries; points and lines unchanged
+    geoms = numpy.asarray(geoms, dtype=object)
+    polygons = numpy.isin(shapely.get_type_id(geoms), (3, 6))
+    return numpy.where(polygons, shapely.boundary(geoms), geoms)
+
+def _boundary(geoms):
+    # Line endpoints and polygon outlines; points unchanged
+    geoms = numpy.asarray(geoms, dtype=object)
+    points = numpy.isin(shapely.get_type_id(geoms), (0, 4))
+    return numpy.where(points, geoms, shapely.boundary(geoms))
+
+def polygon_chunk(geoms):
+    # flow_io.FeatureChunk of polygon geometries, every ring of every polygon a part; None and empty geometries have no parts
+    polygons, owners = shapely.get_parts(numpy.asarray(geoms, dtype=object), return_index=True)
+    rings, ring_polygons = shapely.get_rings(polygons, return_index=True)
+    coords, ring_of = shapely.get_coordinates(rings, return_index=True)
+    part_offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(ring_of, minlength=len(rings)))))
+    feature_offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(owners[ring_polygons], minlength=len(geoms)))))
+    return flow_io.FeatureChunk('POLYGON', coords, part_offsets, feature_offsets)
+
+def _union(geoms, grid_size):
+    # Union of geoms snapped to the grid.  union_all() returns a lone polygon as it is, unsnapped, so that a polygon
+    # dissolved alone would not match the same polygon dissolved with others; it is overlaid with an empty one instead.
+    if len(geoms) == 1:
+        return shapely.union(geoms[0], shapely.Polygon(), grid_size=grid_size)
+    return shapely.union_all(geoms, grid_size=grid_size)
+
+def _buffered(geoms, index, tolerance):
+    # geoms[index] grown by the XY tolerance, buffering each geometry once however often it is indexed
+    unique, inverse = numpy.unique(index, return_inverse=True)
+    return shapely.buffer(geoms[unique], tolerance)[inverse]
+
+def pairs(overlap_type, geoms, others, tolerance):
+    # Index arrays (i, j) of the pairs for which geoms[i] has the relationship overlap_type to others[j]
+    geoms = numpy.asarray(geoms, dtype=object)
+    others = numpy.asarray(others, dtype=object)
+    if not len(geoms) or not len(others):
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+    tree = shapely.STRtree(others)
+    if overlap_type == "INTERSECT":
+        return tuple(tree.query(geoms, predicate='dwithin', distance=tolerance))
+    if overlap_type == "WITHIN":
+        i, j = tree.query(geoms, predicate='dwithin', distance=tolerance)
+        keep = shapely.covered_by(geoms[i], _buffered(others, j, tolerance))
+    elif overlap_type == "CONTAINS":
+        i, j = tree.query(geoms, predicate='dwithin', distance=tolerance)
+        keep = shapely.covers(_buffered(geoms, i, tolerance), others[j])
+    elif overlap_type == "BOUNDARY_TOUCHES":
+        i, j = tree.query(geoms, predicate='dwithin', distance=tolerance)
+        keep = shapely.dwithin(_boundary(geoms[i]), _outline(others[j]), tolerance)
+    elif overlap_type == "CROSSED_BY_THE_OUTLINE_OF":
+        i, j = tree.query(geoms, predicate='intersects')
+        keep = shapely.relate_pattern(_outline(geoms[i]), _outline(others[j]), '0********')
+    elif overlap_type == "SHARE_A_LINE_SEGMENT_WITH":
+        i, j = tree.query(geoms, predicate='intersects')
+        keep = shapely.relate_pattern(_outline(geoms[i]), _outline(others[j]), '1********')
+    else:
+        raise ExecuteError("Unsupported overlap type: " + str(overlap_type))
+    keep = numpy.asarray(keep, dtype=bool)
+    return i[keep], j[keep]
+
+class ShapelyBackend(Backend):
+
+    name = 'shapely'
+    workspace_extension = '.gpkg'
+
+    def __init__(self):
+        self.workspace = None
+
+    def use_workspace(self, workspace):
+        self.workspace = workspace
+
+    def create_workspace(self, directory, name):
+        path = os.path.join(directory, name + self.workspace_extension)
+        flow_gpkg.connect(path).close()
+        return path
+
+    def _split(self, dataset):
+        gpkg = flow_io.split_gpkg(dataset)
+        if gpkg:
+            return gpkg
+        if self.workspace and flow_io.split_gpkg(os.path.join(self.workspace, str(dataset))):
+            return flow_io.split_gpkg(os.path.join(self.workspace, str(dataset)))
+        raise ExecuteError("Not a GeoPackage dataset: " + str(dataset))
+
+    def read(self, dataset, where_clause=None):
+        path, table = self._split(dataset)
+        conn, owned = flow_io.connect(path)
+        try:
+            if table not in flow_gpkg.list_tables(conn):
+                raise ExecuteError("Dataset does not exist: " + str(dataset))
+            fields = flow_gpkg.fields(conn, table)
+            columns = ''.join(', "{0}"'.format(name) for name, ftype in fields)
+            sql = 'SELECT fid, geom{0} FROM "{1}"'.format(columns, table)
+            if where_clause:
+                sql += ' WHERE ' + where_clause
+            rows = conn.execute(sql + ' ORDER BY fid').fetchall()
+            geoms = shapely.from_wkb([flow_gpkg.wkb_from_blob(row[1]) for row in rows]) if rows else []
+            return Table(flow_gpkg.geometry_type(conn, table), fields, flow_gpkg.spatial_ref_sys(conn, table),
+                         [row[0] for row in rows], list(geoms), [list(row[2:]) for row in rows])
+        finally:
+            if owned:
+                conn.close()
+
+    def write(self, dataset, dimension, fields, srs_id, geoms, values):
+        # Write geometries (converted to the multi-part form of the table type, dropping empty ones) and their values
+        path, table = self._split(dataset)
+        rows = []
+        for geom, row in zip(geoms, values):
+            geom = _extract(geom, dimension)
+            if geom is not None:
+                rows.append((geom, row))
+        conn, owned = flow_io.connect(path)
+        try:
+            flow_gpkg.create_table(conn, table, TABLE_TYPES[dimension], fields, srs_id)
+            srs_id = flow_gpkg.srs_id(conn, table)
+            if rows:
+                out = numpy.array([geom for geom, row in rows], dtype=object)
+                wkbs = shapely.to_wkb(out, output_dimension=2)
+                bounds = shapely.bounds(out)
+                columns = ''.join(', "{0}"'.format(name) for name, ftype in fields)
+                marks = ', ?' * len(fields)
+                conn.executemany('INSERT INTO "{0}" (geom{1}) VALUES (?{2})'.format(table, columns, marks),
+                                 ([flow_gpkg.blob_from_wkb(wkb, bbox, srs_id)] + list(row[1]) for wkb, bbox, row in zip(wkbs, bounds.tolist(), rows)))
+                conn.commit()
+        finally:
+            if owned:
+                conn.close()
+
+    def _tolerance(self, dataset):
+        return flow_io.describe(self._dataset(dataset))[2]
+
+    def _resolution(self, dataset):
+        # Overlays are snapped to a grid of one tenth of the XY tolerance, the default XY resolution in ArcGIS, so that
+        # edges which differ only by rounding (e.g. between neighbouring Thiessen cells) are merged as arcpy merges them
+        return self._tolerance(dataset) / 10.0
+
+    def _dataset(self, dataset):
+        return os.path.join(*self._split(dataset))
+
+    def count(self, dataset, vertices=False):
+        path, table = self._split(dataset)
+        conn, owned = flow_io.connect(path)
+        try:
+            features = conn.execute('SELECT COUNT(*) FROM "{0}"'.format(table)).fetchone()[0]
+            if not vertices:
+                return features, None
+            blobs = [row[0] for row in conn.execute('SELECT geom FROM "{0}" WHERE geom IS NOT NULL'.format(table))]
+            geoms = shapely.from_wkb([flow_gpkg.wkb_from_blob(blob) for blob in blobs]) if blobs else []
+            return features, int(shapely.get_num_coordinates(geoms).sum()) if blobs else 0
+        finally:
+            if owned:
+                conn.close()
+
+    def exists(self, dataset):
+        path, table = self._split(dataset)
+        if not os.path.exists(path) and flow_gpkg.shared(path) is None:
+            return False
+        conn, owned = flow_io.connect(path)
+        try:
+            return table in flow_gpkg.list_tables(conn)
+        finally:
+            if owned:
+                conn.close()
+
+    def copy(self, in_features, out_feature_class):
+        self.select(in_features, None, out_feature_class)
+
+    def select(self, in_features, where_clause, out_feature_class):
+        t = self.read(in_features, where_clause)
+        self.write(out_feature_class, t.dimension(), t.fields, t.srs_id, t.geoms, t.values)
+
+    def select_by_location(self, in_features, steps, out_feature_class, out_unselected=None):
+        t = self.read(in_features)
+        tolerance = self._tolerance(in_features)
+        geoms = numpy.array(t.geoms, dtype=object)
+        selected = numpy.zeros(len(geoms), dtype=bool)
+        for selection_type, overlap_type, select_features, invert in steps:
+            if selection_type == "SWITCH_SELECTION":
+                selected = ~selected
+                continue
+            if select_features == in_features:
+                others = geoms[selected]
+            else:
+                others = self.read(select_features).geoms
+            match = numpy.zeros(len(geoms), dtype=bool)
+            match[pairs(overlap_type, geoms, others, tolerance)[0]] = True
+            if invert:
+                match = ~match
+            if selection_type == "NEW_SELECTION":
+                selected = match
+            elif selection_type == "ADD_TO_SELECTION":
+                selected = selected | match
+            elif selection_type == "REMOVE_FROM_SELECTION":
+                selected = selected & ~match
+            elif selection_type == "SUBSET_SELECTION":
+                selected = selected & match
+            else:
+                raise ExecuteError("Unsupported selection type: " + str(selection_type))
+        for output, keep in ((out_feature_class, selected), (out_unselected, ~selected)):
+            if output:
+                self.write(output, t.dimension(), t.fields, t.srs_id, geoms[keep], [t.values[i] for i in numpy.nonzero(keep)[0]])
+
+    def merge(self, inputs, output):
+        tables = [self.read(dataset) for dataset in inputs]
+        fields = []
+        for t in tables:
+            for field in t.fields:
+                if field[0] not in [f[0] for f in fields]:
+                    fields.append(field)
+        geoms = []
+        values = []
+        for t in tables:
+            lookup = [[f[0] for f in t.fields].index(name) if name in [f[0] for f in t.fields] else None for name, ftype in fields]
+            geoms.extend(t.geoms)
+            values.extend([[row[k] if k is not None else None for k in lookup] for row in t.values])
+        self.write(output, tables[0].dimension(), fields, tables[0].srs_id, geoms, values)
+
+    def dissolve(self, in_features, out_feature_class, dissolve_field=None, multi_part=True):
+        t = self.read(in_features)
+        grid_size = self._resolution(in_features)
+        groups = {}
+        k = [f[0] for f in t.fields].index(dissolve_field) if dissolve_field else None
+        for geom, row in zip(t.geoms, t.values):
+            if geom is not None:
+                groups.setdefault(row[k] if k is not None else None, []).append(geom)
+        geoms = []
+        values = []
+        for key in sorted(groups, key=lambda value: (value is not None, value)):
+            union = _union(groups[key], grid_size)
+            for geom in ([union] if multi_part else _parts(union)):
+                geoms.append(geom)
+                values.append([key] if dissolve_field else [])
+        fields = [t.fields[k]] if dissolve_field else []
+        self.write(out_feature_class, t.dimension(), fields, t.srs_id, geoms, values)
+
+    def eliminate_polygon_part(self, in_features, out_feature_class, part_area, part_area_percent):
+        t = self.read(in_features)
+        meters = flow_io.meters_per_unit(self._dataset(in_features))
+        geographic = not meters and flow_io.is_geographic(self._dataset(in_features))
+        geoms = []
+        for geom in t.geoms:
+            polygons = _parts(geom) if geom is not None else []
+            outer = sum(shapely.Polygon(polygon.exterior).area for polygon in polygons)
+            filled = []
+            for polygon in polygons:
+                holes = [ring for ring in polygon.interiors
+                         if not (_ground_area(shapely.Polygon(ring), meters, geographic) < part_area and shapely.Polygon(ring).area < outer * part_area_percent / 100.0)]
+                filled.append(shapely.Polygon(polygon.exterior, holes))
+            geoms.append(MultiPolygon(filled) if filled else None)
+        self.write(out_feature_class, 2, t.fields, t.srs_id, geoms, t.values)
+
+    def clip(self, in_features, clip_features, out_feature_class):
+        t = self.read(in_features)
+        clips = numpy.array([geom for geom in self.read(clip_features).geoms if geom is not None], dtype=object)
+        geoms = numpy.array(t.geoms, dtype=object)
+        out = [None] * len(geoms)
+        if len(clips):
+            i, j = shapely.STRtree(clips).query(geoms, predicate='intersects')
+            for index in numpy.unique(i):
+                cands = clips[j[i == index]]
+                clipper = cands[0] if len(cands) == 1 else shapely.union_all(cands)
+                out[index] = shapely.intersection(geoms[index], clipper)
+        self.write(out_feature_class, t.dimension(), t.fields, t.srs_id, out, t.values)
+
+    def multipart_to_singlepart(self, in_features, out_feature_class):
+        t = self.read(in_features)
+        geoms = []
+        values = []
+        for fid, geom, row in zip(t.fids, t.geoms, t.values):
+            for part in (_parts(geom) if geom is not None else []):
+                geoms.append(part)
+                values.append(row + [fid])
+        self.write(out_feature_class, t.dimension(), t.fields + [('ORIG_FID', 'LONG')], t.srs_id, geoms, values)
+
+    def feature_to_polygon(self, in_features, out_feature_class):
+        tables = [self.read(dataset) for dataset in in_features]
+        outlines = []
+        for t in tables:
+            outlines.extend(_outline([geom for geom in t.geoms if geom is not None]))
+        # Noding on the XY resolution grid joins line ends that miss an outline only by rounding, such as clipped cutlines
+        faces = _parts(shapely.polygonize(_parts(shapely.union_all(outlines, grid_size=self._resolution(in_features[0]))))) if outlines else []
+        # Faces take the attributes of the first input polygon they fall in
+        polygon_tables = [t for t in tables if t.dimension() == 2]
+        fields = polygon_tables[0].fields if polygon_tables else []
+        values = [[None] * len(fields) for face in faces]
+        if polygon_tables and faces:
+            labels = shapely.point_on_surface(numpy.array(faces, dtype=object))
+            i, j = shapely.STRtree(numpy.array(polygon_tables[0].geoms, dtype=object)).query(labels, predicate='within')
+            for face, polygon in sorted(zip(i.tolist(), j.tolist()), reverse=True):
+                values[face] = list(polygon_tables[0].values[polygon])
+        self.write(out_feature_class, 2, fields, tables[0].srs_id, faces, values)
+
+    def identity(self, in_features, identity_features, out_feature_class):
+        t = self.read(in_features)
+        other = self.read(identity_features)
+        tolerance = self._tolerance(in_features)
+        geoms = numpy.array(t.geoms, dtype=object)
+        others = numpy.array(other.geoms, dtype=object)
+        out = []
+        values = []
+        pieces = {}
+        if len(geoms) and len(others):
+            i, j = shapely.STRtree(others).query(geoms, predicate='intersects')
+            for a, b, piece in zip(i.tolist(), j.tolist(), shapely.intersection(geoms[i], others[j])):
+                piece = _extract(piece, t.dimension())
+                if piece is not None:
+                    out.append(piece)
+                    values.append([t.fids[a], other.fids[b]])
+                    pieces.setdefault(a, []).append(piece)
+        # Whatever of each input feature is not covered by identity features keeps FID -1 for the identity side
+        for a, geom in enumerate(geoms):
+            if geom is None:
+                continue
+            covered = pieces.get(a, [])
+            if covered and abs(geom.area - sum(piece.area for piece in covered)) <= tolerance * geom.length:
+                continue
+            rest = _extract(shapely.difference(geom, shapely.union_all(covered)) if covered else geom, t.dimension())
+            if rest is not None:
+                out.append(rest)
+                values.append([t.fids[a], -1])
+        fields = [('FID_' + self._split(in_features)[1], 'LONG'), ('FID_' + self._split(identity_features)[1], 'LONG')]
+        self.write(out_feature_class, t.dimension(), fields, t.srs_id, out, values)
+
+    def spatial_join(self, target_features, join_features, out_feature_class, match_option):
+        t = self.read(target_features)
+        other = self.read(join_features)
+        i, j = pairs(match_option, t.geoms, other.geoms, self._tolerance(target_features))
+        order = numpy.lexsort((j, i))
+        names = ['Join_Count', 'TARGET_FID', 'JOIN_FID'] + [f[0] for f in t.fields]
+        join_fields = []
+        for name, ftype in other.fields:
+            # Join fields whose names are taken get a numeric suffix, as in arcpy
+            new_name, n = name, 0
+            while new_name in names:
+                n += 1
+                new_name = "{0}_{1}".format(name, n)
+            names.append(new_name)
+            join_fields.append((new_name, ftype))
+        fields = [('Join_Count', 'LONG'), ('TARGET_FID', 'LONG'), ('JOIN_FID', 'LONG')] + t.fields + join_fields
+        geoms = [t.geoms[i[k]] for k in order]
+        values = [[1, t.fids[i[k]], other.fids[j[k]]] + t.values[i[k]] + other.values[j[k]] for k in order]
+        self.write(out_feature_class, t.dimension(), fields, t.srs_id, geoms, values)
+
+    def merge_orphans(self, in_features, flowlines, split_points, dissolve_field, thiessen, out_feature_class):
+        t = self.read(in_features)
+        tolerance = self._tolerance(in_features)
+        geoms = numpy.array(t.geoms, dtype=object)
+        marks = []
+        for dataset in (flowlines, split_points):
+            mark = numpy.zeros(len(geoms), dtype=bool)
+            if dataset:
+                mark[pairs("INTERSECT", geoms, self.read(dataset).geoms, tolerance)[0]] = True
+            marks.append(mark)
+        k = [f[0] for f in t.fields].index(dissolve_field)
+        selected, groups = flow_orphans.orphan_groups(polygon_chunk(geoms), [row[k] for row in t.values], marks[0], marks[1], thiessen, tolerance)
+        # Unselected polygons as they are, then each group dissolved, as Merge of the unselected and dissolved selected polygons
+        out = [geoms[c] for c in numpy.nonzero(~selected)[0]]
+        values = [t.values[c] for c in numpy.nonzero(~selected)[0]]
+        members = {}
+        for c in numpy.nonzero(selected)[0].tolist():
+            members.setdefault(groups[c], []).append(c)
+        grid_size = self._resolution(in_features)
+        for root in sorted(members, key=lambda root: (t.values[root][k] is not None, t.values[root][k])):
+            parts = [geoms[c] for c in members[root] if geoms[c] is not None]
+            out.append(parts[0] if len(parts) == 1 else shapely.union_all(parts, grid_size=grid_size))
+            values.append([t.values[root][k] if n == k else None for n in range(len(t.fields))])
+        self.write(out_feature_class, t.dimension(), t.fields, t.srs_id, out, values)
+
+    def label_cells(self, in_features, cell_field, cells, flowlines, out_feature_class):
+        t = self.read(in_features)
+        cell_table = self.read(cells)
+        lines = self.read(flowlines)
+        n = [f[0] for f in lines.fields].index('DWUNIQUE')
+        # Labels are compared as text, as make_thiessen() writes them, and written back as the flowlines hold them
+        known = dict((str(row[n]), row[n]) for row in lines.values if row[n] is not None)
+        labels = dict(zip(cell_table.fids, [row[[f[0] for f in cell_table.fields].index('DWUNIQUE')] for row in cell_table.values]))
+        k = [f[0] for f in t.fields].index(cell_field)
+        groups = {}
+        unlabelled = []
+        for index, (geom, row) in enumerate(zip(t.geoms, t.values)):
+            if geom is None:
+                continue
+            label = known.get(str(labels.get(row[k])))
+            if label is None:
+                unlabelled.append(index)
+            else:
+                groups.setdefault(label, []).append(geom)
+        if unlabelled:
+            geoms = numpy.array(t.geoms, dtype=object)[unlabelled]
+            i, j = pairs("CROSSED_BY_THE_OUTLINE_OF", geoms, lines.geoms, self._tolerance(in_features))
+            for a, b in zip(i.tolist(), j.tolist()):
+                if lines.values[b][n] is not None:
+                    groups.setdefault(lines.values[b][n], []).append(geoms[a])
+        grid_size = self._resolution(in_features)
+        out = []
+        values = []
+        for label in sorted(groups):
+            for part in _parts(_union(groups[label], grid_size)):
+                out.append(part)
+                values.append([label])
+        self.write(out_feature_class, 2, [lines.fields[n]], t.srs_id, out, values)
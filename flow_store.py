@@ -0,0 +1,205 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_store.py
+# Purpose:     Intermediate dataset stores for flow_area.py.  A store decides
+#              where the pf_swpt_* intermediates live, what they are called,
+#              whether they are removed at the end of a run, and records how
+#              many bytes each stage wrote.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+#-------------------------------------------------------------------------------
+#
+# MODES:
+# temp:         Intermediates go to a new per-run workspace in the system temp directory, deleted when the store is closed (default)
+# memory:       Intermediates are held in memory and released when the store is closed
+# namespace:    Intermediates go to the input workspace under a unique per-run prefix, and are deleted when the store is closed.
+#               Concurrent runs against the same workspace do not collide.  A caller may name the namespace instead, so that a
+#               later run can pick up the intermediates of one that failed.
+# keep:         Intermediates go to the input workspace under their plain pf_swpt_* names and are kept, as flow_area always did.
+#               Useful for debugging.
+
+import os, shutil, tempfile, uuid, collections
+import flow_gpkg
+
+MODES = ('temp', 'memory', 'namespace', 'keep')
+PREFIX = 'pf_swpt_'
+
+def folder_bytes(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class IntermediateStore(object):
+    # Base class.  Subclasses set self.workspace in open() and implement size(), cleanup() and output(), and may
+    # override release() to free resources that must be let go whether or not intermediates are kept.
+    #
+    # ARGUMENTS:
+    # input_workspace:      Workspace of the inputs, which receives the outputs
+    # mode:                 One of MODES
+    # namespace:            Namespace of a 'namespace' store.  By default a new random one
+
+    def __init__(self, input_workspace, mode='temp', namespace=None):
+        if mode not in MODES:
+            raise ValueError("Unknown intermediate store mode '{0}', expected one of {1}".format(mode, ", ".join(MODES)))
+        self.input_workspace = input_workspace
+        self.mode = mode
+        self.prefix = PREFIX
+        if mode == 'namespace':
+            self.prefix = '{0}{1}_'.format(PREFIX, namespace or uuid.uuid4().hex[:8])
+        self.workspace = None
+        self.created = []
+        self.bytes_written = collections.OrderedDict()
+        self._last_size = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def name(self, name):
+        # Map an intermediate name such as "pf_swpt_all_fl_filt" to the dataset name used in this store
+        if name.startswith(PREFIX):
+            name = self.prefix + name[len(PREFIX):]
+        if name not in self.created:
+            self.created.append(name)
+        return name
+
+    def open(self):
+        self._last_size = self.size()
+        return self
+
+    def end_stage(self, stage):
+        # Record the growth of the store since the previous stage ended.  Returns None where the store size cannot be measured.
+        size = self.size()
+        written = None
+        if size is not None and self._last_size is not None:
+            written = max(size - self._last_size, 0)
+            written += self.bytes_written.get(stage) or 0
+        self.bytes_written[stage] = written
+        self._last_size = size
+        return written
+
+    def close(self):
+        if self.mode != 'keep':
+            self.cleanup()
+        self.release()
+
+    def release(self):
+        pass
+
+    def size(self):
+        raise NotImplementedError
+
+    def cleanup(self):
+        raise NotImplementedError
+
+    def output(self, name):
+        raise NotImplementedError
+
+class ArcpyStore(IntermediateStore):
+    # Store backed by an ArcGIS workspace: a file geodatabase in the temp directory, the in_memory workspace, or the input workspace itself
+
+    def open(self):
+        import arcpy
+        if self.mode == 'temp':
+            self.folder = tempfile.mkdtemp(prefix=PREFIX)
+            self.workspace = arcpy.CreateFileGDB_management(self.folder, "intermediates.gdb").getOutput(0)
+        elif self.mode == 'memory':
+            self.workspace = "in_memory"
+        else:
+            self.workspace = self.input_workspace
+        arcpy.env.workspace = self.workspace
+        return IntermediateStore.open(self)
+
+    def size(self):
+        if self.workspace and os.path.isdir(self.workspace):
+            return folder_bytes(self.workspace)
+        return None
+
+    def cleanup(self):
+        import arcpy
+        if self.mode == 'temp':
+            arcpy.Delete_management(self.workspace)
+            shutil.rmtree(self.folder, ignore_errors=True)
+        elif self.mode == 'memory':
+            arcpy.Delete_management("in_memory")
+        elif self.mode == 'namespace':
+            # Intermediates of an earlier run in a named namespace need not have been created through this store
+            arcpy.env.workspace = self.workspace
+            names = self.created + [name for name in (arcpy.ListFeatureClasses(self.prefix + "*") or []) if name not in self.created]
+            for name in names:
+                if arcpy.Exists(name):
+                    arcpy.Delete_management(name)
+                path = os.path.join(self.workspace, name)
+                if arcpy.Exists(path):
+                    arcpy.Delete_management(path)
+
+    def output(self, name):
+        return os.path.join(self.input_workspace, name)
+
+class GeoPackageStore(IntermediateStore):
+    # Store backed by GeoPackage files on the local filesystem.  input_workspace is the path of a .gpkg file that receives
+    # outputs (and intermediates in 'namespace' and 'keep' modes).  Intermediates are tables of self.conn, named by
+    # dataset path (workspace/table).  Both connections are shared through flow_gpkg.share(), so the in-memory
+    # workspace "in_memory.gpkg" can be reached by path like any other.
+
+    def open(self):
+        if self.mode == 'temp':
+            self.folder = tempfile.mkdtemp(prefix=PREFIX)
+            self.workspace = os.path.join(self.folder, "intermediates.gpkg")
+            self.conn = flow_gpkg.connect(self.workspace)
+        elif self.mode == 'memory':
+            self.workspace = "in_memory.gpkg"
+            self.conn = flow_gpkg.connect(":memory:")
+        else:
+            self.workspace = self.input_workspace
+            self.conn = flow_gpkg.shared(self.workspace) or flow_gpkg.connect(self.workspace)
+        self.output_conn = self.conn if self.workspace == self.input_workspace else (flow_gpkg.shared(self.input_workspace) or flow_gpkg.connect(self.input_workspace))
+        self._owned = []
+        for conn, path in ((self.conn, self.workspace), (self.output_conn, self.input_workspace)):
+            if flow_gpkg.shared(path) is None and conn not in self._owned:
+                self._owned.append(conn)
+        flow_gpkg.share(self.workspace, self.conn)
+        flow_gpkg.share(self.input_workspace, self.output_conn)
+        return IntermediateStore.open(self)
+
+    def name(self, name):
+        return os.path.join(self.workspace, IntermediateStore.name(self, name))
+
+    def size(self):
+        return flow_gpkg.database_bytes(self.conn)
+
+    def cleanup(self):
+        names = list(self.created)
+        if self.mode == 'namespace':
+            # Intermediates of an earlier run in a named namespace need not have been created through this store
+            names += [name for name in flow_gpkg.list_tables(self.conn) if name.startswith(self.prefix) and name not in names]
+        for name in names:
+            flow_gpkg.drop_table(self.conn, name)
+
+    def release(self):
+        # Only close and unregister the connections this store opened; others belong to an enclosing store
+        for conn in self._owned:
+            for path in (self.workspace, self.input_workspace):
+                if flow_gpkg.shared(path) is conn:
+                    flow_gpkg.unshare(path)
+            conn.close()
+        if self.mode == 'temp':
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def output(self, name):
+        return os.path.join(self.input_workspace, name)
+
+def make_store(input_workspace, mode='temp', namespace=None):
+    # Return a store suited to input_workspace: GeoPackage for .gpkg files, otherwise an ArcGIS workspace
+    if str(input_workspace).lower().endswith('.gpkg'):
+        return GeoPackageStore(input_workspace, mode, namespace)
+    return ArcpyStore(input_workspace, mode, namespace)
@@ -0,0 +1,166 @@
+#-------------------------------------------------------------------------------
+# Name:        flow_thiessen.py
+# Purpose:     In-memory densify / vertex dedupe / Thiessen polygon stage used by
+#              flow_area.py in place of Densify, FeatureVerticesToPoints, Merge
+#              and CreateThiessenPolygons.  Requires NumPy and SciPy only.
+# Author:      Research Planning, Inc.
+#
+# Created:     3/04/2017
+# Copyright:   (c) Research Planning, Inc. 2017
+#
+#-------------------------------------------------------------------------------
+#
+# Lines, parts, points and bboxes follow the conventions in flow_geom.py.  A ring
+# is a closed list of (x, y) points whose last point repeats the first.
+
+from __future__ import division
+import numpy
+from scipy.spatial import Voronoi, cKDTree
+
+def densify_part(part, spacing):
+    # Insert evenly spaced vertices so that no segment of part is longer than spacing.
+    # spacing may also be an (x, y) pair of spacings along each axis, for coordinates
+    # whose axes have different ground lengths such as longitude and latitude.
+    # Returns a (K, 2) array that keeps every original vertex.
+    xy = numpy.asarray(part, dtype=float).reshape(-1, 2)
+    if len(xy) < 2:
+        return xy
+    scale = numpy.broadcast_to(numpy.asarray(spacing, dtype=float), (2,))
+    seglen = numpy.hypot(*((xy[1:] - xy[:-1]) / scale).T)
+    steps = numpy.maximum(numpy.ceil(seglen), 1).astype(int)
+    seg = numpy.repeat(numpy.arange(len(steps)), steps)
+    frac = (numpy.arange(steps.sum()) - numpy.repeat(numpy.cumsum(steps) - steps, steps)) / numpy.repeat(steps, steps).astype(float)
+    out = xy[seg] + (xy[seg + 1] - xy[seg]) * frac[:, None]
+    return numpy.vstack((out, xy[-1:]))
+
+def densify_vertices(lines, labels, spacing):
+    # Densify every part of every line and tag each resulting vertex with the label of its line.
+    #
+    # ARGUMENTS:
+    # lines:        List of lines
+    # labels:       List of labels (any hashable value), parallel to lines
+    # spacing:      Maximum distance between vertices, in coordinate units, or an (x, y) pair (see densify_part)
+    #
+    # Returns an (K, 2) array of vertices and a list of K labels.
+    chunks = []
+    vertexlabels = []
+    for line, label in zip(lines, labels):
+        for part in line:
+            xy = densify_part(part, spacing)
+            chunks.append(xy)
+            vertexlabels.extend([label] * len(xy))
+    if not chunks:
+        return numpy.empty((0, 2)), []
+    return numpy.vstack(chunks), vertexlabels
+
+def dedupe_vertices(xy, labels, tolerance):
+    # Drop vertices that fall on the same tolerance-sized grid cell as an earlier vertex,
+    # so earlier sources take priority over later ones.
+    keys = numpy.round(numpy.asarray(xy, dtype=float) / float(tolerance)).astype(numpy.int64)
+    seen = set()
+    keep = []
+    for i, key in enumerate(map(tuple, keys.tolist())):
+        if key not in seen:
+            seen.add(key)
+            keep.append(i)
+    return xy[keep], [labels[i] for i in keep]
+
+def clip_to_bbox(ring, bbox):
+    # Sutherland-Hodgman clip of a convex ring to bbox.  Returns a closed ring, or None if nothing is left.
+    xmin, ymin, xmax, ymax = bbox
+    edges = ((0, xmin, 1), (0, xmax, -1), (1, ymin, 1), (1, ymax, -1))
+    pts = list(ring[:-1]) if ring[0] == ring[-1] else list(ring)
+    for axis, bound, sense in edges:
+        if not pts:
+            return None
+        inside = lambda p: (p[axis] - bound) * sense >= 0
+        clipped = []
+        prev = pts[-1]
+        for cur in pts:
+            if inside(cur):
+                if not inside(prev):
+                    clipped.append(_cross_bound(prev, cur, axis, bound))
+                clipped.append(cur)
+            elif inside(prev):
+                clipped.append(_cross_bound(prev, cur, axis, bound))
+            prev = cur
+        pts = clipped
+    if len(pts) < 3:
+        return None
+    return pts + [pts[0]]
+
+def _cross_bound(p, q, axis, bound):
+    t = (bound - p[axis]) / (q[axis] - p[axis])
+    return (p[0] + t * (q[0] - p[0]), p[1] + t * (q[1] - p[1]))
+
+def voronoi_cells(xy, bbox):
+    # Voronoi cell of each point in xy, clipped to bbox.  Returns a list of rings
+    # (None where the cell lies outside bbox) parallel to xy.
+    xy = numpy.asarray(xy, dtype=float).reshape(-1, 2)
+    if len(xy) == 0:
+        return []
+    # Surround the points with four distant sentinels so every real cell is finite
+    cx, cy = (bbox[0] + bbox[2]) / 2.0, (bbox[1] + bbox[3]) / 2.0
+    span = 10.0 * max(bbox[2] - bbox[0], bbox[3] - bbox[1], numpy.ptp(xy[:, 0]), numpy.ptp(xy[:, 1]), 1.0)
+    sentinels = numpy.array([[cx - span, cy - span], [cx + span, cy - span], [cx + span, cy + span], [cx - span, cy + span]])
+    vor = Voronoi(numpy.vstack((xy, sentinels)))
+    cells = []
+    for i in range(len(xy)):
+        region = vor.regions[vor.point_region[i]]
+        if not region or -1 in region:
+            cells.append(None)
+            continue
+        # Order the convex cell's vertices anticlockwise around its centre
+        verts = vor.vertices[region]
+        centre = verts.mean(axis=0)
+        verts = verts[numpy.argsort(numpy.arctan2(verts[:, 1] - centre[1], verts[:, 0] - centre[0]))]
+        ring = [tuple(pt) for pt in verts.tolist()]
+        cells.append(clip_to_bbox(ring + [ring[0]], bbox))
+    return cells
+
+def thiessen_cells(sources, spacing, bbox, tolerance):
+    # Complete Thiessen stage: densify the lines of each source, tag each vertex with
+    # its line's label, drop duplicate vertices and build the clipped Voronoi cells.
+    #
+    # ARGUMENTS:
+    # sources:      List of (lines, labels) pairs in priority order.  Where vertices from
+    #               several sources coincide, the one from the earliest source is kept.
+    # spacing:      Densify spacing in coordinate units, or an (x, y) pair (see densify_part)
+    # bbox:         Extent to clip the cells to
+    # tolerance:    Distance under which two vertices are treated as the same location
+    #
+    # Returns a list of (ring, label) pairs, one per surviving vertex.
+    chunks = []
+    labels = []
+    for lines, linelabels in sources:
+        xy, vertexlabels = densify_vertices(lines, linelabels, spacing)
+        chunks.append(xy)
+        labels.extend(vertexlabels)
+    if not labels:
+        return []
+    xy, labels = dedupe_vertices(numpy.vstack(chunks), labels, tolerance)
+    return [(ring, label) for ring, label in zip(voronoi_cells(xy, bbox), labels) if ring is not None]
+
+def cell_reach(cells, xy, bboxes):
+    # Greatest distance from a point of any cell inside any of bboxes to the nearest point of xy.  For the Voronoi cells of
+    # xy this is how far the seeds reach into the bboxes: the distance to a cell's seed is greatest at a vertex of the
+    # convex cell, so each cell is clipped to each bbox it overlaps and only the vertices are measured.
+    #
+    # ARGUMENTS:
+    # cells:        List of convex rings
+    # xy:           (K, 2) array of the seeds
+    # bboxes:       List of extents
+    #
+    # Returns 0 if no cell overlaps a bbox.
+    xy = numpy.asarray(xy, dtype=float).reshape(-1, 2)
+    if not len(xy) or not cells:
+        return 0.0
+    tree = cKDTree(xy)
+    extents = numpy.array([[min(p[0] for p in ring), min(p[1] for p in ring), max(p[0] for p in ring), max(p[1] for p in ring)] for ring in cells])
+    reach = 0.0
+    for bbox in bboxes:
+        near = numpy.nonzero((extents[:, 0] <= bbox[2]) & (extents[:, 2] >= bbox[0]) & (extents[:, 1] <= bbox[3]) & (extents[:, 3] >= bbox[1]))[0]
+        points = [pt for i in near.tolist() for pt in (clip_to_bbox(cells[i], bbox) or [])]
+        if points:
+            reach = max(reach, float(tree.query(numpy.array(points))[0].max()))
+    return reach